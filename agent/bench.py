@@ -0,0 +1,447 @@
+"""Benchmarks for the iOS agent, runnable on plain Linux with no network.
+
+Drives a copy of agent/bot.py against synthetic iOS repos, with a fake
+chat-completions client and a fake xcodebuild/swiftc, and compares the
+timings against a stored baseline:
+
+    python agent/bench.py                     # quick matrix, compare to baseline
+    python agent/bench.py --full              # 10..5000 files, 1..500 tasks
+    python agent/bench.py --update-baseline   # record the current timings
+
+Exits non-zero when any timing regresses past the tolerance, when there is
+no baseline to compare against (unless --update-baseline records one), or
+when the analyze / apply-patch commands take more than STARTUP_BUDGET_S to
+run, interpreter start-up included.  The committed bench_baseline.json was
+recorded with --repeat 7; timings are machine-specific, so re-record it
+where the comparison runs.
+"""
+import argparse, asyncio, contextlib, difflib, importlib.util, io, itertools, json, os, platform, random, shutil, statistics, subprocess, sys, tempfile, time, types
+from pathlib import Path
+
+AGENT_DIR = Path(__file__).resolve().parent
+REPO_ROOT = AGENT_DIR.parent
+BASELINE_PATH = AGENT_DIR / "bench_baseline.json"
+APP_NAME = "BenchApp"
+
+QUICK_FILES = [10, 500]
+QUICK_TASKS = [1, 20]
+FULL_FILES = [10, 100, 1000, 5000]
+FULL_TASKS = [1, 10, 100, 500]
+
+# Slowdowns smaller than this are timer noise, whatever the relative change
+MIN_REGRESSION_S = 0.005
+
+# Wall-time allowance for a whole run of the lightweight CLI commands, interpreter included
+STARTUP_BUDGET_S = 0.1
+STARTUP_COMMANDS = ("analyze", "apply-patch")
+
+# Stand-in for both xcodebuild and swiftc: answers -version / -list, sleeps for builds
+FAKE_TOOL = f'''import os, sys, time
+args = sys.argv[1:]
+if "-version" in args:
+    print("Xcode 15.4")
+elif "-list" in args:
+    print("Information about project:\\n    Schemes:\\n        {APP_NAME}\\n")
+elif "-typecheck" in args:
+    time.sleep(float(os.environ.get("BENCH_BUILD_LATENCY", "0")) / 4)
+else:
+    time.sleep(float(os.environ.get("BENCH_BUILD_LATENCY", "0")))
+'''
+
+
+# ---------------------------------------------------------------------------
+# Synthetic repos
+# ---------------------------------------------------------------------------
+
+def _swift_view(name: str, rng: random.Random) -> str:
+    rows = "\n".join(
+        f'            Text("{name} row {i}")\n                .font(.body)\n                .padding(.horizontal, {rng.randint(4, 16)})'
+        for i in range(rng.randint(3, 8))
+    )
+    return (f"import SwiftUI\n\nstruct {name}: View {{\n    @State private var isExpanded = false\n\n"
+            f"    var body: some View {{\n        VStack(alignment: .leading, spacing: 12) {{\n{rows}\n"
+            f"        }}\n        .navigationTitle(\"{name}\")\n    }}\n}}\n\n"
+            f"#Preview {{\n    {name}()\n}}\n")
+
+
+def _swift_model(name: str, rng: random.Random) -> str:
+    fields = "\n".join(f"    var field{i}: {rng.choice(['String', 'Int', 'Double', 'Bool', 'Date'])}"
+                       for i in range(rng.randint(3, 10)))
+    return f"import Foundation\n\nstruct {name}: Identifiable, Codable {{\n    let id: UUID\n{fields}\n}}\n"
+
+
+def _swift_service(name: str, rng: random.Random) -> str:
+    funcs = "\n\n".join(
+        f"    func operation{i}(_ input: Int) -> Int {{\n        let scaled = input * {rng.randint(2, 9)}\n"
+        f"        return scaled + {rng.randint(0, 99)}\n    }}"
+        for i in range(rng.randint(2, 6))
+    )
+    return f"import Foundation\n\nfinal class {name} {{\n    static let shared = {name}()\n\n{funcs}\n}}\n"
+
+
+def make_synthetic_repo(root: Path, n_files: int) -> Path:
+    """Lay out a repo with agent/bot.py, the prompts and an iOS app of *n_files* Swift files."""
+    (root / "agent" / "tasks" / "queued").mkdir(parents=True)
+    shutil.copy2(AGENT_DIR / "bot.py", root / "agent" / "bot.py")
+    shutil.copy2(AGENT_DIR / "cli.py", root / "agent" / "cli.py")
+    shutil.copytree(REPO_ROOT / "prompts", root / "prompts")
+    (root / "agent" / "fake_tool.py").write_text(FAKE_TOOL, encoding="utf-8")
+
+    app = root / "ios" / APP_NAME
+    (app / f"{APP_NAME}.xcodeproj").mkdir(parents=True)
+    (app / f"{APP_NAME}.xcodeproj" / "project.pbxproj").write_text(
+        "// !$*UTF8*$!\n{\n\tobjectVersion = 77;\n\tobjects = {\n\t};\n}\n", encoding="utf-8"
+    )
+    src = app / APP_NAME
+    src.mkdir()
+    (src / f"{APP_NAME}App.swift").write_text(
+        f"import SwiftUI\n\n@main\nstruct {APP_NAME}App: App {{\n    var body: some Scene {{\n"
+        f"        WindowGroup {{\n            ContentView()\n        }}\n    }}\n}}\n", encoding="utf-8"
+    )
+    (src / "ContentView.swift").write_text(_swift_view("ContentView", random.Random(0)), encoding="utf-8")
+
+    makers = [("Views", "View", _swift_view), ("Models", "Model", _swift_model), ("Services", "Service", _swift_service)]
+    for i in range(max(0, n_files - 2)):
+        folder, suffix, make = makers[i % len(makers)]
+        name = f"Sample{i}{suffix}"
+        (src / folder).mkdir(exist_ok=True)
+        (src / folder / f"{name}.swift").write_text(make(name, random.Random(i)), encoding="utf-8")
+    return root
+
+
+def load_bot(root: Path, llm_latency: float):
+    """Import *root*/agent/bot.py as a fresh module wired to the fake backends."""
+    os.environ["AGENT_LLM_CACHE"] = "off"
+    spec = importlib.util.spec_from_file_location(f"bench_bot_{abs(hash(root))}", root / "agent" / "bot.py")
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+
+    tool = [sys.executable, str(root / "agent" / "fake_tool.py")]
+    bot._build_toolchain = bot.BuildToolchain(xcodebuild=tool, swiftc=tool, sdk_path="/bench/iPhoneSimulator.sdk")
+    bot._get_client = lambda: FakeChatClient(llm_latency, is_async=False)
+    bot._get_async_client = lambda: FakeChatClient(llm_latency, is_async=True)
+    return bot
+
+
+# ---------------------------------------------------------------------------
+# Fake chat completions
+# ---------------------------------------------------------------------------
+
+def fake_completion(messages: list) -> str:
+    """Deterministic response: design reviews pass, generations create every deliverable."""
+    if "Design Reviewer" in messages[0]["content"]:
+        return json.dumps({"passes": True, "score": 8, "issues": [], "summary": "Benchmark review."})
+    try:
+        task = json.loads(messages[-1]["content"]).get("task", {})
+    except ValueError:
+        task = {}
+    changes = []
+    for i, d in enumerate(task.get("deliverables", [])):
+        if d.get("path"):
+            name = Path(d["path"]).stem
+            changes.append({"path": d["path"], "action": "create", "content": _swift_model(name, random.Random(i))})
+    return json.dumps({"title": task.get("title", "bench"), "summary": "Benchmark change.", "changes": changes})
+
+
+class FakeChatClient:
+    """Stand-in for ``OpenAI``/``AsyncOpenAI`` with a fixed per-call latency.
+
+    Supports plain and streamed (``stream=True``) completions and reports
+    token usage estimated from the request and response sizes.
+    """
+
+    def __init__(self, latency: float, is_async: bool):
+        self.latency = latency
+        self.is_async = is_async
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, stream: bool = False, **kwargs):
+        content = fake_completion(kwargs["messages"])
+        usage = types.SimpleNamespace(prompt_tokens=len(json.dumps(kwargs["messages"])) // 4,
+                                      completion_tokens=len(content) // 4)
+        if self.is_async:
+            return self._acreate(content, usage, stream)
+        time.sleep(self.latency)
+        return self._response(content, usage)
+
+    @staticmethod
+    def _response(content: str, usage):
+        message = types.SimpleNamespace(content=content)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+
+    async def _acreate(self, content: str, usage, stream: bool):
+        if not stream:
+            await asyncio.sleep(self.latency)
+            return self._response(content, usage)
+        return self._astream(content, usage)
+
+    async def _astream(self, content: str, usage):
+        pieces = [content[i:i + 64] for i in range(0, len(content), 64)] or [""]
+        for piece in pieces:
+            await asyncio.sleep(self.latency / len(pieces))
+            delta = types.SimpleNamespace(content=piece)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)], usage=None)
+        yield types.SimpleNamespace(choices=[], usage=usage)
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+def _median_time(fn, repeat: int, setup=None) -> float:
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def bench_analyze(bot, repeat: int) -> dict:
+    def cold():
+        bot.PROJECT_INDEX_PATH.unlink(missing_ok=True)
+        bot._project_index = None
+
+    def warm():
+        bot._project_index = None
+
+    return {
+        "cold": _median_time(bot.analyze_ios_project, repeat, setup=cold),
+        "warm": _median_time(bot.analyze_ios_project, repeat, setup=warm),
+    }
+
+
+def bench_symbols(bot, repeat: int, n_lookups: int = 1000) -> dict:
+    """Extract the Swift symbol index from scratch, then resolve *n_lookups* names."""
+    def cold():
+        bot.PROJECT_INDEX_PATH.unlink(missing_ok=True)
+        bot._project_index = None
+        bot._get_project_index()
+
+    extract = _median_time(lambda: bot._get_project_index().definitions("ContentView"), repeat, setup=cold)
+    index = bot._get_project_index()
+    names = [Path(p).stem for p in index.paths_with_suffix(".swift")]
+    names = list(itertools.islice(itertools.cycle(names), n_lookups))
+    return {
+        "extract": extract,
+        f"lookup{n_lookups}": _median_time(lambda: [index.definitions(n) for n in names], repeat),
+    }
+
+
+def bench_apply_patches(bot, work: Path, repeat: int) -> dict:
+    path = work / "Patched.swift"
+    original = "import SwiftUI\n\nstruct Patched {\n" + "".join(
+        f"    // step {i}\n    let value{i} = compute({i}, scale: {i % 7})\n" for i in range(2000)
+    ) + "}\n"
+    exact = [{"find": f"    let value{i} = compute({i}, scale: {i % 7})\n",
+              "replace": f"    let value{i} = compute({i}, scale: {i % 7} + 1)\n"} for i in range(0, 2000, 40)]
+    # Drifted indentation and a typo force the normalized and fuzzy matchers
+    fuzzy = [{"find": f"  // step {i}\n  let valeu{i} = compute({i}, scale: {i % 7})",
+              "replace": f"    // step {i}\n    let value{i} = compute({i}, scale: 0)"} for i in range(5, 2000, 200)]
+
+    # The exact edits as a unified diff, applied to a copy whose lines have shifted
+    edited = original
+    for patch in exact:
+        edited = edited.replace(patch["find"], patch["replace"])
+    diff = "".join(difflib.unified_diff(original.splitlines(keepends=True), edited.splitlines(keepends=True)))
+    shifted = "// header\n" * 3 + original
+
+    def reset():
+        path.write_text(original, encoding="utf-8")
+
+    return {
+        "exact": _median_time(lambda: bot.apply_patches(path, exact), repeat, setup=reset),
+        "fuzzy": _median_time(lambda: bot.apply_patches(path, fuzzy), repeat, setup=reset),
+        "diff": _median_time(lambda: bot.apply_unified_diff(shifted, diff), repeat),
+    }
+
+
+def bench_write_changes(bot, repeat: int, n_files: int = 50) -> float:
+    ios_context = bot.analyze_ios_project()
+    folder = f"ios/{APP_NAME}/{APP_NAME}/BenchWrites"
+    changes = [{"path": f"{folder}/Written{i}.swift", "action": "create",
+                "content": _swift_view(f"Written{i}", random.Random(i))} for i in range(n_files)]
+
+    def clean():
+        shutil.rmtree(bot.REPO_ROOT / folder, ignore_errors=True)
+        bot._refresh_project_index([ch["path"] for ch in changes])
+
+    elapsed = _median_time(lambda: bot.write_changes(changes, ios_context), repeat, setup=clean)
+    clean()
+    return elapsed
+
+
+def bench_snapshot(bot, repeat: int) -> float:
+    """Materialize a workspace snapshot of ios/ with a few pending edits."""
+    workspace = bot.Workspace()
+    for i in range(5):
+        workspace.write_text(f"ios/{APP_NAME}/{APP_NAME}/Snapshot{i}.swift", f"struct Snapshot{i} {{}}\n")
+    snapshots = []
+    elapsed = _median_time(lambda: snapshots.append(workspace.snapshot()), repeat)
+    for root in snapshots:
+        shutil.rmtree(root, ignore_errors=True)
+    return elapsed
+
+
+def bench_startup(root: Path, repeat: int) -> dict:
+    """Wall time of fresh ``cli.py analyze`` / ``apply-patch`` processes, and of a bare interpreter."""
+    cli_py = str(root / "agent" / "cli.py")
+    target = root / "Startup.swift"
+    patches = root / "startup_patches.json"
+    patches.write_text(json.dumps([{"find": "let value = 1", "replace": "let value = 2"}]), encoding="utf-8")
+    # Time the normal path, with compiled bytecode cached after the warm-up run
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    commands = {
+        "interpreter": [sys.executable, "-c", "pass"],
+        "analyze": [sys.executable, cli_py, "analyze"],
+        "apply-patch": [sys.executable, cli_py, "apply-patch", str(target), str(patches)],
+    }
+
+    def reset():
+        target.write_text("let value = 1\n", encoding="utf-8")
+
+    def run(cmd):
+        subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, check=True)
+
+    timings = {}
+    for name, cmd in commands.items():
+        reset()
+        run(cmd)
+        timings[name] = _median_time(lambda: run(cmd), repeat, setup=reset)
+    return timings
+
+
+def bench_pipeline(bot, n_tasks: int, concurrency: int) -> float:
+    """Run *n_tasks* queued tasks end to end; returns wall seconds."""
+    folder = f"ios/{APP_NAME}/{APP_NAME}/Bench"
+    task_paths = []
+    for i in range(n_tasks):
+        task = {
+            "id": f"bench-{i}", "type": "ios_feature", "title": f"Bench feature {i}",
+            "description": "Synthetic benchmark task.",
+            "deliverables": [{"path": f"{folder}/BenchFeature{i}.swift", "type": "new"}],
+        }
+        path = bot.QUEUED_DIR / f"bench-{i:04d}.json"
+        path.write_text(json.dumps(task), encoding="utf-8")
+        task_paths.append(path)
+
+    started = time.perf_counter()
+    asyncio.run(bot.run_task_queue(task_paths, concurrency))
+    elapsed = time.perf_counter() - started
+
+    shutil.rmtree(bot.REPO_ROOT / folder, ignore_errors=True)
+    shutil.rmtree(bot.PROCESSED_DIR, ignore_errors=True)
+    bot._project_index = None
+    return elapsed
+
+
+def run_benchmarks(file_counts, task_counts, repeat: int, concurrency: int,
+                   llm_latency: float, build_latency: float) -> dict:
+    os.environ["BENCH_BUILD_LATENCY"] = str(build_latency)
+    results = {}
+    for i, n_files in enumerate(file_counts):
+        with tempfile.TemporaryDirectory(prefix="agent-bench-") as tmp:
+            root = make_synthetic_repo(Path(tmp), n_files)
+            print(f"Repo with {n_files} Swift files:")
+            measured = {}
+            with contextlib.redirect_stdout(io.StringIO()):
+                bot = load_bot(root, llm_latency)
+                if i == 0:  # independent of the repo size
+                    for mode, seconds in bench_apply_patches(bot, Path(tmp), repeat).items():
+                        measured[f"apply_patches[{mode}]"] = seconds
+                    for command, seconds in bench_startup(root, repeat).items():
+                        measured[f"startup[{command}]"] = seconds
+                for mode, seconds in bench_analyze(bot, repeat).items():
+                    measured[f"analyze_ios_project[{mode},files={n_files}]"] = seconds
+                for mode, seconds in bench_symbols(bot, repeat).items():
+                    measured[f"symbols[{mode},files={n_files}]"] = seconds
+                measured[f"write_changes[50,files={n_files}]"] = bench_write_changes(bot, repeat)
+                measured[f"snapshot[files={n_files}]"] = bench_snapshot(bot, repeat)
+            for name, seconds in measured.items():
+                print(f"  {name:<46} {seconds * 1000:10.1f} ms")
+            results.update(measured)
+
+            for n_tasks in task_counts:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    elapsed = bench_pipeline(bot, n_tasks, concurrency)
+                name = f"process_task[files={n_files},tasks={n_tasks}]"
+                results[name] = elapsed
+                print(f"  {name:<46} {elapsed * 1000:10.1f} ms  ({n_tasks / elapsed:.1f} tasks/s)")
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Baselines
+# ---------------------------------------------------------------------------
+
+def startup_over_budget(results: dict) -> list:
+    """Commands that take longer than STARTUP_BUDGET_S to run."""
+    return [c for c in STARTUP_COMMANDS if results.get(f"startup[{c}]", 0) > STARTUP_BUDGET_S]
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Names of results slower than their baseline by more than *tolerance*."""
+    regressions = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if seconds > base * (1 + tolerance) and seconds - base > MIN_REGRESSION_S:
+            regressions.append(name)
+            print(f"REGRESSION {name}: {seconds * 1000:.1f} ms vs baseline {base * 1000:.1f} ms "
+                  f"(+{(seconds / base - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the iOS agent against fake LLM and build backends.")
+    parser.add_argument("--full", action="store_true", help="run the full 10..5000 files x 1..500 tasks matrix")
+    parser.add_argument("--files", help="comma-separated Swift file counts (overrides the matrix)")
+    parser.add_argument("--tasks", help="comma-separated queue sizes (overrides the matrix)")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions per micro-benchmark (median is kept)")
+    parser.add_argument("--concurrency", type=int, default=4, help="tasks in flight for process_task runs")
+    parser.add_argument("--llm-latency", type=float, default=0.02, help="seconds per fake chat completion")
+    parser.add_argument("--build-latency", type=float, default=0.02, help="seconds per fake xcodebuild build")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs baseline (0.25 = 25%%)")
+    parser.add_argument("--update-baseline", action="store_true", help="store these timings as the new baseline")
+    parser.add_argument("--output", type=Path, help="also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    file_counts = [int(n) for n in args.files.split(",")] if args.files else (FULL_FILES if args.full else QUICK_FILES)
+    task_counts = [int(n) for n in args.tasks.split(",")] if args.tasks else (FULL_TASKS if args.full else QUICK_TASKS)
+    results = run_benchmarks(file_counts, task_counts, max(1, args.repeat), max(1, args.concurrency),
+                             args.llm_latency, args.build_latency)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+    slow_start = startup_over_budget(results)
+    for command in slow_start:
+        print(f"'{command}' takes more than {STARTUP_BUDGET_S * 1000:.0f} ms to run.")
+
+    stored = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    if args.update_baseline:
+        stored.setdefault("results", {}).update(results)
+        stored["meta"] = {"python": platform.python_version(), "platform": platform.platform(),
+                          "llm_latency": args.llm_latency, "build_latency": args.build_latency,
+                          "concurrency": args.concurrency}
+        args.baseline.write_text(json.dumps(stored, indent=2, sort_keys=True), encoding="utf-8")
+        print(f"Baseline updated: {args.baseline}")
+        return 1 if slow_start else 0
+
+    if not stored:
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one.")
+        return 1
+    regressions = compare(results, stored.get("results", {}), args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed beyond {args.tolerance:.0%}.")
+        return 1
+    print(f"No regressions against {args.baseline}.")
+    return 1 if slow_start else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
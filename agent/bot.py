@@ -1,7 +1,59 @@
-import os, json, glob, sys, subprocess, xml.etree.ElementTree as ET, re, time, difflib
+from __future__ import annotations
+
+import os, json, sys, re, time
+import argparse, contextlib, contextvars, hashlib, importlib.util, itertools, threading, types, weakref
 from pathlib import Path
-from openai import OpenAI
-from typing import Dict, List, Optional, Any
+
+# Annotations are never evaluated (see the __future__ import), so typing is
+# only needed by type checkers.  openai and tiktoken are imported on first
+# use so tools that only analyze or patch files start quickly (see
+# _get_client and count_tokens).
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Dict, List, Optional, Any
+    from openai import OpenAI, AsyncOpenAI
+
+
+def _lazy_import(name: str):
+    """Return module *name*, executed on its first attribute access rather than now."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class _LazyPattern:
+    """A module-level regex compiled on first use, so importing bot compiles none of them."""
+
+    __slots__ = ("_args", "_pattern")
+
+    def __init__(self, *args):
+        self._args = args
+        self._pattern = None
+
+    def __getattr__(self, name):
+        if self._pattern is None:
+            self._pattern = re.compile(*self._args)
+        return getattr(self._pattern, name)
+
+
+# Only the pipeline, cache and build commands need these
+asyncio = _lazy_import("asyncio")
+sqlite3 = _lazy_import("sqlite3")
+subprocess = _lazy_import("subprocess")
+ET = _lazy_import("xml.etree.ElementTree")
+difflib = _lazy_import("difflib")
+glob = _lazy_import("glob")
+gzip = _lazy_import("gzip")
+random = _lazy_import("random")
+shlex = _lazy_import("shlex")
+shutil = _lazy_import("shutil")
+signal = _lazy_import("signal")
+tempfile = _lazy_import("tempfile")
 
 REPO_ROOT = Path(__file__).resolve().parents[1]
 PROMPTS_DIR = REPO_ROOT / "prompts"
@@ -10,48 +62,925 @@ QUEUED_DIR = TASKS_DIR / "queued"
 PROCESSED_DIR = TASKS_DIR / "processed"
 IOS_DIR = REPO_ROOT / "ios"
 
-ORCH = (PROMPTS_DIR / "orchestrator.md").read_text()
-IOS  = (PROMPTS_DIR / "ios_dev.md").read_text()
-DESIGN_REVIEW_PROMPT = (PROMPTS_DIR / "design_review.md").read_text()
+# System prompts, read on first use: _prompt("ORCH"), or bot.ORCH from outside
+_PROMPT_FILES = {
+    "ORCH": "orchestrator.md",
+    "IOS": "ios_dev.md",
+    "DESIGN_REVIEW_PROMPT": "design_review.md",
+    "MERGE_PROMPT": "merge.md",
+    "UPDATE_DIFF": "update_diff.md",
+    "DIFF_FALLBACK_PROMPT": "diff_fallback.md",
+}
+_prompts: Dict[str, str] = {}
+
+
+def _prompt(name: str) -> str:
+    if name not in _prompts:
+        _prompts[name] = (PROMPTS_DIR / _PROMPT_FILES[name]).read_text()
+    return _prompts[name]
+
+
+def __getattr__(name: str):
+    if name in _PROMPT_FILES:
+        return _prompt(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 DEFAULT_MODEL = os.environ.get("AGENT_LLM_MODEL", "gpt-4o")
 
+# Model tiering: design reviews and small fixes try the fast model first and
+# escalate to the task's model on malformed output or a fix that doesn't compile
+FAST_MODEL = os.environ.get("AGENT_FAST_MODEL", "gpt-4o-mini")
+SMALL_FIX_MAX_ERRORS = int(os.environ.get("AGENT_SMALL_FIX_MAX_ERRORS", "2"))  # root-cause errors
+
 # Retry budgets
 MAX_BUILD_RETRIES = 4              # Build error fix attempts (up from 2)
 MAX_DESIGN_RETRIES = 2             # Design review improvement iterations
 MAX_POST_DESIGN_BUILD_RETRIES = 2  # Build retries after design fixes
 
+# Fix candidates requested and built in parallel per build retry (1 = serial);
+# tasks can override this with "speculative_fixes"
+SPECULATIVE_FIXES = max(1, int(os.environ.get("AGENT_SPECULATIVE_FIXES", "1")))
+
+# Number of queued tasks processed at the same time (1 = sequential)
+MAX_CONCURRENT_TASKS = max(1, int(os.environ.get("AGENT_CONCURRENCY", "1")))
+
+# Stream the initial generation and write each finished file while the rest arrives
+STREAM_GENERATION = os.environ.get("AGENT_STREAM", "1") != "0"
+
+# How the initial generation returns "update" changes: "diff" (a unified diff
+# against the contents it was shown) or "full" (the complete file)
+UPDATE_FORMAT = os.environ.get("AGENT_UPDATE_FORMAT", "diff").lower()
+# Context lines a diff hunk may drop from each end when it doesn't match as given
+DIFF_MAX_FUZZ = int(os.environ.get("AGENT_DIFF_FUZZ", "2"))
+
+# LLM response cache: "on" (read-write), "off", or "replay" (read-only, misses raise)
+LLM_CACHE_MODE = os.environ.get("AGENT_LLM_CACHE", "on").lower()
+LLM_CACHE_PATH = Path(os.environ.get("AGENT_LLM_CACHE_PATH",
+                                     str(REPO_ROOT / "agent" / ".cache" / "llm_cache.sqlite3")))
+LLM_CACHE_MAX_BYTES = int(float(os.environ.get("AGENT_LLM_CACHE_MAX_MB", "256")) * 1024 * 1024)
+LLM_CACHE_MAX_AGE_DAYS = float(os.environ.get("AGENT_LLM_CACHE_MAX_AGE_DAYS", "14"))
+
+# Per-call token budget for the packed iOS context in generation / fix prompts
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("AGENT_CONTEXT_TOKEN_BUDGET", "24000"))
+FIX_CONTEXT_TOKEN_BUDGET = int(os.environ.get("AGENT_FIX_CONTEXT_TOKEN_BUDGET", "4000"))
+
+# Build check: cached scheme discovery, stable DerivedData, typecheck fast path
+BUILD_CONFIG_CACHE_PATH = REPO_ROOT / "agent" / ".cache" / "build_config.json"
+DERIVED_DATA_DIR = REPO_ROOT / "agent" / ".cache" / "DerivedData"
+TYPECHECK_TARGET = os.environ.get("AGENT_TYPECHECK_TARGET", "arm64-apple-ios17.0-simulator")
+BUILD_DESTINATION = "generic/platform=iOS Simulator"
+
+# Source lines shown above and below each compiler error in fix prompts
+DIAGNOSTIC_CONTEXT_LINES = int(os.environ.get("AGENT_DIAGNOSTIC_CONTEXT_LINES", "8"))
+
+# Persistent per-file index of ios/ (mtime/size/hash, Swift symbols), reused across runs
+PROJECT_INDEX_PATH = REPO_ROOT / "agent" / ".cache" / "project_index.json"
+# Files the symbol index adds to a generation prompt (and declarations to a fix prompt)
+AUTO_CONTEXT_FILES = int(os.environ.get("AGENT_AUTO_CONTEXT_FILES", "6"))
+
+# Client-side LLM rate limiting.  Budgets are learned from the API's
+# x-ratelimit-* headers; these seed them (0 = unknown until the first response)
+LLM_RPM_LIMIT = int(os.environ.get("AGENT_LLM_RPM", "0"))
+LLM_TPM_LIMIT = int(os.environ.get("AGENT_LLM_TPM", "0"))
+LLM_MAX_IN_FLIGHT = max(1, int(os.environ.get("AGENT_LLM_MAX_IN_FLIGHT", "8")))
+
+# Offline batch generation for whole backlogs: "off", "openai" (Batch API) or
+# "local" (in-process stand-in that runs the requests through the chat client)
+BATCH_MODE = os.environ.get("AGENT_BATCH", "off").lower()
+BATCH_POLL_S = float(os.environ.get("AGENT_BATCH_POLL", "30"))
+BATCH_TIMEOUT_S = float(os.environ.get("AGENT_BATCH_TIMEOUT_HOURS", "24")) * 3600
+BATCH_DIR = REPO_ROOT / "agent" / ".cache" / "batches"
+
+# Workspace snapshots for isolated builds; kept inside the repo's filesystem so
+# unchanged files can be hardlinked rather than copied
+SNAPSHOT_DIR = REPO_ROOT / "agent" / ".cache" / "snapshots"
+
+# Telemetry: JSONL trace of timed spans ("" disables the file); AGENT_PROFILE=1
+# also writes a cProfile dump per pipeline phase next to the trace
+TRACE_PATH = os.environ.get("AGENT_TRACE_PATH", str(REPO_ROOT / "agent" / ".cache" / "trace.jsonl"))
+TRACE_PROFILE = os.environ.get("AGENT_PROFILE", "0") == "1"
+
+# Append-only run log: one compressed record per processed task, with an
+# offset index next to it ("" disables)
+RUN_LOG_PATH = os.environ.get("AGENT_RUN_LOG", str(REPO_ROOT / "agent" / "runs.jsonl.gz"))
+
+
+# ---------------------------------------------------------------------------
+# Telemetry — timed spans and counters written as a JSONL trace
+# ---------------------------------------------------------------------------
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("agent_span", default=None)
+
+
+class Tracer:
+    """Records nested, timed spans as JSONL trace records.
+
+    The current span lives in a context variable, so asyncio tasks and
+    ``asyncio.to_thread`` calls started inside a span are attributed to it.
+    Counters (tokens, retries, cache hits) are recorded on the innermost
+    span; :meth:`summary` rolls them up per pipeline phase.
+    """
+
+    def __init__(self, path: Optional[Path]):
+        self.path = path
+        self.run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self.records: List[Dict[str, Any]] = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, task: Optional[str] = None, profile: bool = False, **attrs):
+        parent = _current_span.get()
+        span = {
+            "run": self.run_id, "id": next(self._ids),
+            "parent": parent["id"] if parent else None,
+            "task": task or (parent["task"] if parent else None),
+            "name": name, "attrs": attrs, "counters": {},
+        }
+        token = _current_span.set(span)
+        profiler = self._start_profiler() if profile and TRACE_PROFILE else None
+        span["start"] = time.time()
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span["error"] = type(e).__name__
+            raise
+        finally:
+            span["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            _current_span.reset(token)
+            if profiler is not None:
+                profiler.disable()
+                if self.path is not None:
+                    profiler.dump_stats(str(self.path.with_name(f"profile-{self.run_id}-{span['id']}-{name}.prof")))
+            self._emit(span)
+
+    @staticmethod
+    def _start_profiler():
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # another phase on this thread is already being profiled
+            return None
+        return profiler
+
+    @staticmethod
+    def count(**amounts):
+        """Add to the current span's counters (no-op outside a span)."""
+        span = _current_span.get()
+        if span is None:
+            return
+        for key, amount in amounts.items():
+            span["counters"][key] = span["counters"].get(key, 0) + amount
+
+    def _emit(self, span: dict):
+        with self._lock:
+            self.records.append(span)
+            if self.path is None:
+                return
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with self.path.open("a", encoding="utf-8") as f:
+                    f.write(json.dumps(span, default=str) + "\n")
+            except OSError as e:
+                print(f"  Warning: could not write trace record: {e}")
+                self.path = None
+
+    def summary(self, root_id: int) -> List[Dict[str, Any]]:
+        """Per-phase totals for the direct children of span *root_id*, plus a total row."""
+        with self._lock:
+            records = list(self.records)
+        by_id = {r["id"]: r for r in records}
+        def blank(phase: str) -> Dict[str, Any]:
+            return {"phase": phase, "runs": 0, "wall_s": 0.0, "llm_calls": 0, "prompt_tokens": 0,
+                    "completion_tokens": 0, "retries": 0, "cache_hits": 0, "builds": 0, "build_s": 0.0}
+
+        rows: Dict[str, Dict[str, Any]] = {}
+        total = blank("total")
+
+        def phase_of(rec):
+            while rec is not None and rec["parent"] != root_id:
+                rec = by_id.get(rec["parent"])
+            return rec
+
+        for rec in records:
+            if rec["id"] == root_id:
+                total["runs"] = 1
+                total["wall_s"] = rec["duration_ms"] / 1000
+                continue
+            phase = phase_of(rec)
+            if phase is None:
+                continue
+            row = rows.setdefault(phase["name"], blank(phase["name"]))
+            if rec is phase:
+                row["runs"] += 1
+                row["wall_s"] += rec["duration_ms"] / 1000
+            counters = rec["counters"]
+            for target in (row, total):
+                if rec["name"] == "llm":
+                    target["llm_calls"] += 1
+                if rec["name"] == "build":
+                    target["builds"] += 1
+                    target["build_s"] += rec["duration_ms"] / 1000
+                target["prompt_tokens"] += counters.get("prompt_tokens", 0)
+                target["completion_tokens"] += counters.get("completion_tokens", 0)
+                target["retries"] += counters.get("retries", 0)
+                target["cache_hits"] += counters.get("cache_hits", 0)
+        return list(rows.values()) + [total]
+
+
+def format_trace_summary(rows: List[Dict[str, Any]]) -> str:
+    """Render :meth:`Tracer.summary` rows as a markdown table."""
+    lines = ["| Phase | Runs | Wall (s) | LLM calls | Tokens in | Tokens out | Retries | Cache hits | Builds | Build (s) |",
+             "|---|---:|---:|---:|---:|---:|---:|---:|---:|---:|"]
+    for r in rows:
+        lines.append(
+            f"| {r['phase']} | {r['runs']} | {r['wall_s']:.1f} | {r['llm_calls']} | {r['prompt_tokens']} | "
+            f"{r['completion_tokens']} | {r['retries']} | {r['cache_hits']} | {r['builds']} | {r['build_s']:.1f} |"
+        )
+    return "\n".join(lines)
+
+
+_tracer: Optional[Tracer] = None
+
+
+def _get_tracer() -> Tracer:
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(Path(TRACE_PATH) if TRACE_PATH else None)
+    return _tracer
+
+
+# ---------------------------------------------------------------------------
+# Run log — append-only compressed record of every processed task
+# ---------------------------------------------------------------------------
+
+# The record of the task being processed; phases add to it via _log_run_step.
+_run_record: contextvars.ContextVar = contextvars.ContextVar("agent_run_record", default=None)
+
+
+def _log_run_step(kind: str, **entry):
+    """Append *entry* to the *kind* list of the current task's run record (no-op outside a task)."""
+    record = _run_record.get()
+    if record is not None:
+        record.setdefault(kind, []).append(entry)
+
+
+class RunLog:
+    """Append-only log of task records, each stored as its own gzip member.
+
+    The log is a valid multi-member gzip file of JSONL records (``zcat``
+    reads all of it).  A small JSONL index next to it (``.idx``) records
+    each record's task, run, byte offset and length, so one record is
+    read with a single seek without decompressing the rest.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.index_path = path.with_suffix(".idx")
+        self._lock = threading.Lock()
+
+    def append(self, record: dict) -> dict:
+        data = gzip.compress(json.dumps(record, default=str, separators=(",", ":")).encode("utf-8") + b"\n",
+                             compresslevel=6, mtime=0)
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+            entry = {"task": record.get("task_name"), "run": record.get("run"), "time": record.get("time"),
+                     "offset": offset, "length": len(data)}
+            with self.index_path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        return entry
+
+    def entries(self) -> List[dict]:
+        if not self.index_path.exists():
+            return []
+        with self.index_path.open(encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def read(self, entry: dict) -> dict:
+        with self.path.open("rb") as f:
+            f.seek(entry["offset"])
+            return json.loads(gzip.decompress(f.read(entry["length"])))
+
+    def latest(self, task_name: str) -> Optional[dict]:
+        """The most recent record for *task_name* (file name, with or without .json)."""
+        for entry in reversed(self.entries()):
+            if entry["task"] in (task_name, f"{task_name}.json"):
+                return self.read(entry)
+        return None
+
+
+_run_log: Optional[RunLog] = None
+
+
+def _get_run_log() -> Optional[RunLog]:
+    global _run_log
+    if _run_log is None and RUN_LOG_PATH:
+        _run_log = RunLog(Path(RUN_LOG_PATH))
+    return _run_log
+
+
+def _append_run_record(record: dict):
+    run_log = _get_run_log()
+    if run_log is None:
+        return
+    try:
+        run_log.append(record)
+    except OSError as e:
+        print(f"  Warning: could not append to the run log: {e}")
+
+
+# ---------------------------------------------------------------------------
+# LLM response cache — content-addressed, persisted in SQLite
+# ---------------------------------------------------------------------------
+
+class LLMCacheMiss(RuntimeError):
+    """Raised in replay mode when a request has no cached response."""
+
+
+class LLMResponseCache:
+    """Persistent cache of chat-completion responses keyed by request content.
+
+    Entries are evicted least-recently-used first once the total payload
+    exceeds *max_bytes*, and unconditionally once older than *max_age_s*.
+    A *read_only* cache never writes, not even access times.
+    """
+
+    def __init__(self, path: Path, max_bytes: int, max_age_s: float, read_only: bool = False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if read_only:
+            self._db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False) if path.exists() else None
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, content TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)")
+            self._db.commit()
+
+    @staticmethod
+    def key_for(request: dict) -> str:
+        """Hash of everything that determines the completion."""
+        messages_hash = hashlib.sha256(
+            json.dumps(request.get("messages", []), sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        material = json.dumps({
+            "model": request.get("model"),
+            "temperature": request.get("temperature"),
+            "response_format": request.get("response_format"),
+            "messages": messages_hash,
+        }, sort_keys=True)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = None
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT content, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+            if row is None or now - row[1] > self.max_age_s:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self._db.commit()
+            return row[0]
+
+    def put(self, key: str, content: str):
+        if self.read_only:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, content, size, created, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, content, len(content.encode("utf-8")), now, now),
+            )
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now: float):
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.max_age_s,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "mode": "replay" if self.read_only else "on"}
+
+
+_llm_cache: Optional[LLMResponseCache] = None
+
+
+def _get_llm_cache() -> Optional[LLMResponseCache]:
+    """Process-wide cache instance, or None when caching is off."""
+    global _llm_cache
+    if LLM_CACHE_MODE == "off":
+        return None
+    if _llm_cache is None:
+        _llm_cache = LLMResponseCache(
+            LLM_CACHE_PATH,
+            max_bytes=LLM_CACHE_MAX_BYTES,
+            max_age_s=LLM_CACHE_MAX_AGE_DAYS * 86400,
+            read_only=LLM_CACHE_MODE == "replay",
+        )
+    return _llm_cache
+
+
+def _cache_lookup(kwargs: dict) -> tuple:
+    """Return *(key, parsed_response)*; *parsed_response* is None on a miss."""
+    cache = _get_llm_cache()
+    if cache is None:
+        return None, None
+    key = cache.key_for(kwargs)
+    content = cache.get(key)
+    if content is not None:
+        return key, json.loads(content)
+    if cache.read_only:
+        raise LLMCacheMiss(f"No cached response for request {key[:12]} (model={kwargs.get('model')})")
+    return key, None
+
+
+def _cache_store(key: Optional[str], content: str):
+    cache = _get_llm_cache()
+    if cache is not None and key is not None:
+        cache.put(key, content)
+
 
 # ---------------------------------------------------------------------------
 # OpenAI API retry wrapper
 # ---------------------------------------------------------------------------
 
-def _call_openai_with_retry(client: OpenAI, max_api_retries: int = 3, **kwargs) -> dict:
+def _api_error_headers(e: Exception) -> dict:
+    response = getattr(e, "response", None)
+    return dict(getattr(response, "headers", None) or {})
+
+
+def _is_rate_limit_error(e: Exception) -> bool:
+    if getattr(e, "status_code", None) == 429:
+        return True
+    err_str = str(e).lower()
+    return "rate_limit" in err_str or "rate limit" in err_str
+
+
+def _is_transient_api_error(e: Exception) -> bool:
+    """True for errors worth retrying (rate limits, timeouts, dropped connections, 5xx)."""
+    if _is_rate_limit_error(e):
+        return True
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return status in (408, 409) or status >= 500
+    err_str = str(e).lower()
+    return "timeout" in err_str or "timed out" in err_str or "connection" in err_str
+
+
+def _parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds in an x-ratelimit-reset-* value such as ``"20ms"``, ``"1s"`` or ``"6m0.5s"``."""
+    if not value:
+        return None
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(n) * scale[unit] for n, unit in parts)
+
+
+def _retry_after(headers: dict) -> Optional[float]:
+    """Seconds the server asked us to wait, from Retry-After(-ms) headers."""
+    headers = {k.lower(): v for k, v in headers.items()}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # an HTTP date; fall back to our own backoff
+    return None
+
+
+class RateLimiter:
+    """Paces LLM calls to stay within the account's request and token budgets.
+
+    Shared by every call in the process (threads and event loops alike).
+    Requests and tokens of the last minute are tracked in sliding windows;
+    the limits are learned from ``x-ratelimit-*`` response headers.  A
+    rate-limit error blocks all callers until its ``Retry-After`` has
+    passed and halves the number of calls allowed in flight, which then
+    grows back by one for every window's worth of successful calls.
+    Without limit headers, a rate-limit error caps requests per minute at
+    the number that got through in the last window; the cap doubles with
+    every window free of rate-limit errors until it reaches the configured
+    limit (or, with none, is lifted after :attr:`INFERRED_WINDOWS`).
+    """
+
+    WINDOW_S = 60.0
+    INFERRED_WINDOWS = 3
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, max_in_flight: int = 8):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._limits_from_headers = False
+        self._inferred: Optional[tuple] = None  # (requests per minute, time inferred)
+        self.max_in_flight = max_in_flight
+        self.in_flight_limit = max_in_flight
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.throttled_s = 0.0
+        self.rate_limited = 0
+        self._successes = 0
+        self._requests: List[float] = []
+        self._tokens: List[list] = []  # [timestamp, tokens], updated with actual usage
+        self._lock = threading.Lock()
+
+    def _rpm(self, now: float) -> int:
+        """Requests allowed per minute right now; 0 for no limit.  Call with the lock held."""
+        if self._inferred is None:
+            return self.rpm
+        inferred, since = self._inferred
+        windows = (now - since) / self.WINDOW_S
+        grown = int(inferred * 2 ** windows)
+        if (self.rpm and grown >= self.rpm) or (not self.rpm and windows >= self.INFERRED_WINDOWS):
+            self._inferred = None
+            return self.rpm
+        return grown
+
+    @staticmethod
+    def estimate_tokens(kwargs: dict) -> int:
+        chars = sum(len(str(m.get("content", ""))) for m in kwargs.get("messages", []))
+        return chars // 4 + int(kwargs.get("max_tokens") or 1000)
+
+    def _try_acquire(self, tokens: int) -> tuple:
+        """Reserve a call slot; returns *(slot, 0)* or *(None, seconds to wait)*."""
+        now = time.monotonic()
+        with self._lock:
+            cutoff = now - self.WINDOW_S
+            while self._requests and self._requests[0] <= cutoff:
+                self._requests.pop(0)
+            while self._tokens and self._tokens[0][0] <= cutoff:
+                self._tokens.pop(0)
+            if now < self.blocked_until:
+                return None, self.blocked_until - now
+            if self.in_flight >= self.in_flight_limit:
+                return None, 0.05
+            rpm = self._rpm(now)
+            if rpm and len(self._requests) >= rpm:
+                return None, self._requests[0] + self.WINDOW_S - now
+            if self.tpm and self._tokens and sum(t for _, t in self._tokens) + tokens > self.tpm:
+                return None, self._tokens[0][0] + self.WINDOW_S - now
+            self.in_flight += 1
+            self._requests.append(now)
+            slot = [now, tokens]
+            self._tokens.append(slot)
+            return slot, 0.0
+
+    def acquire(self, kwargs: dict) -> list:
+        tokens = self.estimate_tokens(kwargs)
+        while True:
+            slot, wait = self._try_acquire(tokens)
+            if slot is not None:
+                return slot
+            self._throttled(wait)
+            time.sleep(wait)
+
+    async def acquire_async(self, kwargs: dict) -> list:
+        tokens = self.estimate_tokens(kwargs)
+        while True:
+            slot, wait = self._try_acquire(tokens)
+            if slot is not None:
+                return slot
+            self._throttled(wait)
+            await asyncio.sleep(wait)
+
+    def _throttled(self, wait: float):
+        with self._lock:
+            self.throttled_s += wait
+        Tracer.count(throttle_ms=round(wait * 1000))
+
+    def release(self, slot: list, ok: bool):
+        with self._lock:
+            self.in_flight -= 1
+            if not ok:
+                return
+            self._successes += 1
+            if self.in_flight_limit < self.max_in_flight and self._successes >= self.in_flight_limit:
+                self.in_flight_limit += 1
+                self._successes = 0
+
+    @staticmethod
+    def record_usage(slot: Optional[list], usage):
+        """Replace a slot's estimated tokens with the response's actual usage."""
+        total = getattr(usage, "total_tokens", None) if usage is not None else None
+        if slot is not None and total:
+            slot[1] = total
+
+    def observe(self, headers: dict):
+        """Learn limits and remaining budget from ``x-ratelimit-*`` response headers."""
+        if not headers:
+            return
+        headers = {k.lower(): v for k, v in headers.items()}
+
+        def number(name):
+            try:
+                return int(float(headers[name]))
+            except (KeyError, ValueError):
+                return None
+
+        now = time.monotonic()
+        with self._lock:
+            if number("x-ratelimit-limit-requests") or number("x-ratelimit-limit-tokens"):
+                self._limits_from_headers = True
+                self._inferred = None
+            self.rpm = number("x-ratelimit-limit-requests") or self.rpm
+            self.tpm = number("x-ratelimit-limit-tokens") or self.tpm
+            # Budgets refill continuously, so an exhausted one only needs time
+            # for a single request's worth to come back, not a full reset.
+            for kind, limit in (("requests", self.rpm), ("tokens", self.tpm)):
+                remaining = number(f"x-ratelimit-remaining-{kind}")
+                reset = _parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if remaining == 0 and reset:
+                    refill = self.WINDOW_S / limit if limit else reset
+                    if kind == "tokens" and limit:
+                        refill *= self._tokens[-1][1] if self._tokens else 1
+                    self.blocked_until = max(self.blocked_until, now + min(reset, refill))
+
+    def backoff(self, error: Exception, attempt: int) -> float:
+        """Seconds to wait before retrying after *error*; rate limits pause every caller."""
+        retry_after = _retry_after(_api_error_headers(error))
+        if retry_after is not None:
+            wait = retry_after * random.uniform(1.0, 1.2)
+        else:
+            wait = 5 * 2 ** attempt * random.uniform(0.5, 1.0)  # ~5s, 10s, 20s with jitter
+        if _is_rate_limit_error(error):
+            with self._lock:
+                self.rate_limited += 1
+                if not self._limits_from_headers:
+                    # No advertised limit: the other calls sent this window are the budget.
+                    now = time.monotonic()
+                    sent = sum(1 for t in self._requests if t > now - self.WINDOW_S)
+                    estimate = max(1, sent - 1)
+                    current = self._rpm(now)
+                    self._inferred = (min(current, estimate) if current else estimate, now)
+                self.in_flight_limit = max(1, self.in_flight_limit // 2)
+                self._successes = 0
+                self.blocked_until = max(self.blocked_until, time.monotonic() + wait)
+            Tracer.count(rate_limited=1)
+        return wait
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            rpm = self._rpm(time.monotonic())
+        return {"rpm": rpm, "tpm": self.tpm, "in_flight_limit": self.in_flight_limit,
+                "rate_limited": self.rate_limited, "throttled_s": round(self.throttled_s, 1)}
+
+
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def _get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(LLM_RPM_LIMIT, LLM_TPM_LIMIT, LLM_MAX_IN_FLIGHT)
+    return _rate_limiter
+
+
+def _create_completion(client: "OpenAI", **kwargs) -> tuple:
+    """*(response, headers)*; headers are empty for clients without raw-response access."""
+    raw_api = getattr(client.chat.completions, "with_raw_response", None)
+    if raw_api is None:
+        return client.chat.completions.create(**kwargs), {}
+    raw = raw_api.create(**kwargs)
+    return raw.parse(), dict(raw.headers)
+
+
+async def _acreate_completion(client: "AsyncOpenAI", **kwargs) -> tuple:
+    raw_api = getattr(client.chat.completions, "with_raw_response", None)
+    if raw_api is None:
+        return await client.chat.completions.create(**kwargs), {}
+    raw = await raw_api.create(**kwargs)
+    return raw.parse(), dict(raw.headers)
+
+
+def _call_openai_with_retry(client: "OpenAI", max_api_retries: int = 3, **kwargs) -> dict:
     """Wrapper around OpenAI chat completions with exponential backoff.
 
     Handles transient errors (rate limits, timeouts) and JSON decode failures.
+    Calls are paced by the shared :class:`RateLimiter`, which also decides
+    how long to back off (honoring ``Retry-After``).
+    Responses are served from and saved to the LLM response cache.
     Returns the parsed JSON dict from the response.
     """
+    with _get_tracer().span("llm", model=kwargs.get("model")):
+        return _call_openai(client, max_api_retries, **kwargs)
+
+
+def _record_usage(usage, slot: Optional[list] = None):
+    """Count a response's token usage on the current trace span and its limiter slot."""
+    if usage is not None:
+        Tracer.count(prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+                     completion_tokens=getattr(usage, "completion_tokens", 0) or 0)
+        _get_rate_limiter().record_usage(slot, usage)
+
+
+def _call_openai(client: "OpenAI", max_api_retries: int, **kwargs) -> dict:
+    cache_key, cached = _cache_lookup(kwargs)
+    if cached is not None:
+        Tracer.count(cache_hits=1)
+        return cached
+
+    limiter = _get_rate_limiter()
     last_error = None
     for attempt in range(max_api_retries):
+        if attempt:
+            Tracer.count(retries=1)
+        slot = limiter.acquire(kwargs)
+        ok = False
         try:
-            resp = client.chat.completions.create(**kwargs)
+            resp, headers = _create_completion(client, **kwargs)
+            limiter.observe(headers)
+            _record_usage(getattr(resp, "usage", None), slot)
+            ok = True
             content = resp.choices[0].message.content
-            return json.loads(content)
+            parsed = json.loads(content)
+            _cache_store(cache_key, content)
+            return parsed
         except json.JSONDecodeError as e:
             print(f"  LLM returned invalid JSON (attempt {attempt + 1}/{max_api_retries}): {e}")
             last_error = e
             if attempt == max_api_retries - 1:
                 raise
+            continue
         except Exception as e:
-            err_str = str(e).lower()
-            if "rate_limit" in err_str or "timeout" in err_str or "connection" in err_str:
-                wait_time = 2 ** attempt * 5  # 5s, 10s, 20s
-                print(f"  API error (attempt {attempt + 1}/{max_api_retries}): {e}. Retrying in {wait_time}s...")
-                time.sleep(wait_time)
-                last_error = e
+            if not _is_transient_api_error(e):
+                raise
+            wait_time = limiter.backoff(e, attempt)
+            print(f"  API error (attempt {attempt + 1}/{max_api_retries}): {e}. Retrying in {wait_time:.1f}s...")
+            last_error = e
+        finally:
+            limiter.release(slot, ok)
+        # Only reached after a transient error; the slot is free while we wait.
+        time.sleep(wait_time)
+    raise RuntimeError(f"OpenAI API call failed after {max_api_retries} retries: {last_error}")
+
+
+class ChangesStreamParser:
+    """Incrementally extracts finished entries of a response's top-level ``changes`` array.
+
+    Feed it raw completion text as it streams in; :meth:`feed` returns each
+    ``changes[]`` object as soon as its closing brace arrives.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None  # last string closed directly inside the top-level object
+        self._in_changes = False
+        self._entry_start = None
+
+    def feed(self, chunk: str) -> List[dict]:
+        self._text += chunk
+        done = []
+        text = self._text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = text[self._string_start:i]
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i + 1
+            elif c in "{[":
+                if self._depth == 1 and c == "[" and self._last_string == "changes":
+                    self._in_changes = True
+                elif self._in_changes and self._depth == 2 and c == "{":
+                    self._entry_start = i
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._in_changes and self._depth == 2 and c == "}" and self._entry_start is not None:
+                    try:
+                        entry = json.loads(text[self._entry_start:i + 1])
+                    except json.JSONDecodeError:
+                        entry = None
+                    if isinstance(entry, dict):
+                        done.append(entry)
+                    self._entry_start = None
+                elif self._in_changes and self._depth == 1:
+                    self._in_changes = False
+        self._pos = len(text)
+        return done
+
+
+async def _stream_completion(client: "AsyncOpenAI", kwargs: dict, on_change, slot: Optional[list] = None) -> str:
+    """Stream a completion, awaiting *on_change* for every finished ``changes[]`` entry."""
+    parser = ChangesStreamParser()
+    parts = []
+    stream, headers = await _acreate_completion(
+        client, stream=True, stream_options={"include_usage": True}, **kwargs
+    )
+    _get_rate_limiter().observe(headers)
+    async for chunk in stream:
+        _record_usage(getattr(chunk, "usage", None), slot)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        if not delta:
+            continue
+        parts.append(delta)
+        for change in parser.feed(delta):
+            await on_change(change)
+    return "".join(parts)
+
+
+async def _acall_openai_with_retry(client: "AsyncOpenAI", max_api_retries: int = 3,
+                                   on_change=None, **kwargs) -> dict:
+    """Async counterpart of :func:`_call_openai_with_retry` (same retry semantics).
+
+    With *on_change* the completion is streamed and the coroutine is awaited
+    with each ``changes[]`` entry as soon as it is complete.  A retried
+    attempt streams its entries again, so *on_change* must tolerate repeats.
+    """
+    with _get_tracer().span("llm", model=kwargs.get("model"), stream=on_change is not None):
+        return await _acall_openai(client, max_api_retries, on_change, **kwargs)
+
+
+async def _acall_openai(client: "AsyncOpenAI", max_api_retries: int, on_change, **kwargs) -> dict:
+    cache_key, cached = _cache_lookup(kwargs)
+    if cached is not None:
+        Tracer.count(cache_hits=1)
+        return cached
+
+    limiter = _get_rate_limiter()
+    last_error = None
+    for attempt in range(max_api_retries):
+        if attempt:
+            Tracer.count(retries=1)
+        slot = await limiter.acquire_async(kwargs)
+        ok = False
+        try:
+            if on_change is None:
+                resp, headers = await _acreate_completion(client, **kwargs)
+                limiter.observe(headers)
+                _record_usage(getattr(resp, "usage", None), slot)
+                content = resp.choices[0].message.content
             else:
+                content = await _stream_completion(client, kwargs, on_change, slot)
+            ok = True
+            parsed = json.loads(content)
+            _cache_store(cache_key, content)
+            return parsed
+        except json.JSONDecodeError as e:
+            print(f"  LLM returned invalid JSON (attempt {attempt + 1}/{max_api_retries}): {e}")
+            last_error = e
+            if attempt == max_api_retries - 1:
                 raise
+            continue
+        except Exception as e:
+            if not _is_transient_api_error(e):
+                raise
+            wait_time = limiter.backoff(e, attempt)
+            print(f"  API error (attempt {attempt + 1}/{max_api_retries}): {e}. Retrying in {wait_time:.1f}s...")
+            last_error = e
+        finally:
+            limiter.release(slot, ok)
+        # Only reached after a transient error; the slot is free while we wait.
+        await asyncio.sleep(wait_time)
     raise RuntimeError(f"OpenAI API call failed after {max_api_retries} retries: {last_error}")
 
 
@@ -62,9 +991,10 @@ def _call_openai_with_retry(client: OpenAI, max_api_retries: int = 3, **kwargs)
 class XcodeProjectAnalyzer:
     """Analyzes and manipulates Xcode project files"""
 
-    def __init__(self, project_path: Path):
+    def __init__(self, project_path: Path, index: Optional["ProjectIndex"] = None):
         self.project_path = project_path
         self.pbxproj_path = project_path / "project.pbxproj"
+        self.index = index
 
     def get_project_info(self) -> Dict[str, Any]:
         """Extract key project information"""
@@ -91,6 +1021,8 @@ class XcodeProjectAnalyzer:
 
     def _find_swift_files(self) -> List[str]:
         """Find all Swift files in the project"""
+        if self.index is not None:
+            return self.index.paths_with_suffix(".swift")
         swift_files = []
         if IOS_DIR.exists():
             for swift_file in IOS_DIR.rglob("*.swift"):
@@ -99,6 +1031,8 @@ class XcodeProjectAnalyzer:
 
     def _find_storyboards(self) -> List[str]:
         """Find all Storyboard files"""
+        if self.index is not None:
+            return self.index.paths_with_suffix(".storyboard")
         storyboards = []
         if IOS_DIR.exists():
             for sb_file in IOS_DIR.rglob("*.storyboard"):
@@ -107,6 +1041,8 @@ class XcodeProjectAnalyzer:
 
     def _has_swiftui_imports(self) -> bool:
         """Check if project uses SwiftUI"""
+        if self.index is not None:
+            return self.index.uses_swiftui()
         for swift_file in IOS_DIR.rglob("*.swift") if IOS_DIR.exists() else []:
             try:
                 content = swift_file.read_text()
@@ -224,22 +1160,375 @@ struct {struct_name}: Identifiable, Codable {{
 """
         return template
 
+# ---------------------------------------------------------------------------
+# Project index — one walk of ios/, then per-path refreshes
+# ---------------------------------------------------------------------------
+
+_SWIFT_DECL_RE = _LazyPattern(
+    r'\b(class|struct|enum|protocol|actor|extension|typealias|func)\s+'
+    r'(?!(?:func|var|let|subscript|init)\b)([A-Za-z_]\w*)'
+)
+_SWIFT_REF_RE = _LazyPattern(r'\b[A-Z]\w*|\b[a-z_]\w*(?=\s*\()')
+# Comments and string literals, blanked before symbols are matched (nesting is ignored)
+_SWIFT_NOISE_RE = _LazyPattern(r'//[^\n]*|/\*.*?\*/|"""(?:\\.|[^\\])*?"""|"(?:\\.|[^"\\\n])*"', re.DOTALL)
+_TYPE_KINDS = {"class", "struct", "enum", "protocol", "actor", "typealias"}
+
+
+def _swift_symbols(data: bytes) -> tuple:
+    """*(decls, refs)* for a Swift file: ``[name, kind, line]`` triples and referenced names.
+
+    Names inside comments and string literals are ignored.  References are
+    capitalised identifiers and the names of called functions, minus what
+    the file declares itself.
+    """
+    masked = _SWIFT_NOISE_RE.sub(lambda m: _blank(m.group(0)), data.decode("utf-8", errors="replace"))
+    decls = []
+    line, pos = 1, 0
+    for m in _SWIFT_DECL_RE.finditer(masked):
+        line += masked.count("\n", pos, m.start())
+        pos = m.start()
+        decls.append([m.group(2), m.group(1), line])
+    declared = {d[0] for d in decls if d[1] != "extension"}
+    refs = sorted(set(_SWIFT_REF_RE.findall(masked)) - declared)
+    return decls, refs
+
+
+class ProjectIndex:
+    """Single-pass index of every file under *root*, persisted between runs.
+
+    Each file records its mtime, size, a SHA-1 of its contents and whether
+    it imports SwiftUI.  :meth:`scan` walks the tree once and only re-reads
+    files whose mtime or size changed since the persisted snapshot;
+    :meth:`refresh` updates individual paths without walking at all.
+    Keys are POSIX paths relative to *repo_root*.
+
+    Swift files also record the symbols they declare and reference.  These
+    are extracted on the first :meth:`definitions` / :meth:`references`
+    lookup (only for files changed since they were last persisted) and kept
+    current by :meth:`refresh`; lookups are dictionary hits.
+    """
+
+    VERSION = 2
+
+    def __init__(self, root: Path, repo_root: Path = REPO_ROOT, cache_path: Optional[Path] = None):
+        self.root = root
+        self.repo_root = repo_root
+        self.cache_path = cache_path
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.dirs: set = set()
+        self.scanned = False
+        # name -> {path: [(kind, line), ...]} and name -> {paths}, built on first lookup
+        self._symbols: Optional[Dict[str, Dict[str, list]]] = None
+        self._referrers: Dict[str, set] = {}
+        self._load()
+
+    def _rel(self, path) -> str:
+        return Path(path).relative_to(self.repo_root).as_posix()
+
+    @staticmethod
+    def _entry(path, st, previous: Optional[dict]) -> Dict[str, Any]:
+        if previous and previous["mtime_ns"] == st.st_mtime_ns and previous["size"] == st.st_size:
+            return previous
+        with open(path, "rb") as f:
+            data = f.read()
+        return {
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "sha1": hashlib.sha1(data).hexdigest(),
+            "swiftui": str(path).endswith(".swift") and b"import SwiftUI" in data,
+        }
+
+    def scan(self):
+        """Walk the tree once, re-hashing only files that changed."""
+        files: Dict[str, Dict[str, Any]] = {}
+        dirs = set()
+        stack = [str(self.root)] if self.root.exists() else []
+        while stack:
+            try:
+                it = os.scandir(stack.pop())
+            except (PermissionError, FileNotFoundError):
+                continue
+            with it:
+                for entry in it:
+                    rel = self._rel(entry.path)
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.add(rel)
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        try:
+                            files[rel] = self._entry(entry.path, entry.stat(), self.files.get(rel))
+                        except OSError:
+                            continue
+        self.files, self.dirs, self.scanned = files, dirs, True
+        self._symbols = None
+
+    def refresh(self, rel_paths):
+        """Re-stat only *rel_paths* (e.g. the files write_changes touched)."""
+        root_rel = self._rel(self.root)
+        for rel in rel_paths:
+            if not (rel == root_rel or rel.startswith(root_rel + "/")):
+                continue
+            path = self.repo_root / rel
+            try:
+                st = path.stat()
+            except OSError:
+                self._unlink_symbols(rel, self.files.pop(rel, None))
+                continue
+            if not path.is_file():
+                continue
+            previous = self.files.get(rel)
+            self.files[rel] = self._entry(path, st, previous)
+            if self.files[rel] is not previous:
+                self._unlink_symbols(rel, previous)
+                self._link_symbols(rel, self.files[rel])
+            parent = Path(rel).parent
+            while parent.as_posix() != root_rel and parent.as_posix() not in self.dirs:
+                self.dirs.add(parent.as_posix())
+                parent = parent.parent
+
+    def _link_symbols(self, rel: str, entry: Optional[dict]) -> bool:
+        """Add *entry*'s symbols to the maps; True if they had to be extracted."""
+        if self._symbols is None or not entry or not rel.endswith(".swift"):
+            return False
+        extracted = "decls" not in entry
+        if extracted:
+            try:
+                entry["decls"], entry["refs"] = _swift_symbols((self.repo_root / rel).read_bytes())
+            except OSError:
+                return False
+        for name, kind, line in entry.get("decls", ()):
+            self._symbols.setdefault(name, {}).setdefault(rel, []).append((kind, line))
+        for name in entry.get("refs", ()):
+            self._referrers.setdefault(name, set()).add(rel)
+        return extracted
+
+    def _unlink_symbols(self, rel: str, entry: Optional[dict]):
+        if self._symbols is None or not entry:
+            return
+        for name, _, _ in entry.get("decls", ()):
+            by_path = self._symbols.get(name, {})
+            by_path.pop(rel, None)
+            if not by_path:
+                self._symbols.pop(name, None)
+        for name in entry.get("refs", ()):
+            self._referrers.get(name, set()).discard(rel)
+
+    def _symbol_maps(self) -> Dict[str, Dict[str, list]]:
+        if self._symbols is None:
+            self._symbols, self._referrers = {}, {}
+            extracted = [self._link_symbols(rel, entry) for rel, entry in list(self.files.items())]
+            if any(extracted):
+                self.save()
+        return self._symbols
+
+    def definitions(self, name: str) -> Dict[str, list]:
+        """``{path: [(kind, line), ...]}`` for every file declaring or extending *name*."""
+        return self._symbol_maps().get(name, {})
+
+    def references(self, name: str) -> set:
+        """Paths of the files that mention *name* outside their own declarations."""
+        self._symbol_maps()
+        return self._referrers.get(name, set())
+
+    def paths_with_suffix(self, suffix: str) -> List[str]:
+        return sorted(p for p in self.files if p.endswith(suffix))
+
+    def dirs_with_suffix(self, suffix: str) -> List[str]:
+        return sorted(d for d in list(self.dirs) if d.endswith(suffix))
+
+    def uses_swiftui(self) -> bool:
+        return any(e["swiftui"] for e in self.files.values())
+
+    def directory_structure(self, max_depth: int = 3) -> Dict:
+        """Same shape as :func:`get_directory_structure`, built without touching disk."""
+        root_parts = len(Path(self._rel(self.root)).parts)
+        entries = [(p, False) for p in self.dirs] + [(p, True) for p in self.files]
+        structure: Dict = {}
+        for rel, is_file in sorted(entries, key=lambda e: Path(e[0]).parts):
+            parts = Path(rel).parts[root_parts:]
+            if not parts or len(parts) > max_depth + 1 or any(x.startswith('.') for x in parts):
+                continue
+            node = structure
+            for part in parts[:-1]:
+                node = node.setdefault(part + "/", {})
+            if is_file:
+                node[parts[-1]] = "file"
+            else:
+                node.setdefault(parts[-1] + "/", {})
+        return structure
+
+    def _load(self):
+        if not self.cache_path or not self.cache_path.exists():
+            return
+        try:
+            data = json.loads(self.cache_path.read_text())
+        except (OSError, ValueError):
+            return
+        if data.get("version") == self.VERSION and data.get("root") == str(self.root):
+            # Loaded entries only seed scan(); the tree is still walked once per process.
+            self.files = data.get("files", {})
+
+    def save(self):
+        if not self.cache_path:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"version": self.VERSION, "root": str(self.root), "files": self.files}))
+        tmp.replace(self.cache_path)
+
+
+_project_index: Optional[ProjectIndex] = None
+
+
+def _get_project_index() -> ProjectIndex:
+    """Process-wide project index, scanned on first use."""
+    global _project_index
+    if _project_index is None:
+        _project_index = ProjectIndex(IOS_DIR, cache_path=PROJECT_INDEX_PATH)
+    if not _project_index.scanned:
+        _project_index.scan()
+        _project_index.save()
+    return _project_index
+
+
+def _rescan_project_index():
+    """Pick up files changed outside the agent (reuses hashes of unchanged files)."""
+    if _project_index is not None and _project_index.scanned:
+        _project_index.scan()
+
+
+def _refresh_project_index(rel_paths):
+    """Tell the index about written paths; a no-op until it has been scanned."""
+    if _project_index is not None and _project_index.scanned:
+        _project_index.refresh(rel_paths)
+
+
+# A symbol declared in more files than this is too ambiguous to pull in
+_MAX_SYMBOL_DEFINITIONS = 3
+_MENTION_RE = _LazyPattern(r'([A-Za-z_]\w*)(\s*\()?')
+_QUOTED_RE = _LazyPattern(r"'([^']+)'")
+
+
+def _primary_definitions(index: ProjectIndex, name: str) -> Dict[str, list]:
+    """Definitions of *name*, preferring declarations over extensions; {} when ambiguous."""
+    found = index.definitions(name)
+    primary = {p: [d for d in decls if d[0] != "extension"] for p, decls in found.items()}
+    primary = {p: decls for p, decls in primary.items() if decls} or found
+    return primary if len(primary) <= _MAX_SYMBOL_DEFINITIONS else {}
+
+
+def _mentioned_symbols(text: str, index: ProjectIndex) -> List[str]:
+    """Indexed names in free *text*, in order; functions only when called or camelCase."""
+    names: List[str] = []
+    for m in _MENTION_RE.finditer(text):
+        name = m.group(1)
+        if name in names or not index.definitions(name):
+            continue
+        is_type = any(kind in _TYPE_KINDS or kind == "extension"
+                      for decls in index.definitions(name).values() for kind, _ in decls)
+        if is_type or m.group(2) or name != name.lower():
+            names.append(name)
+    return names
+
+
+def _related_files(task: dict, exclude: set) -> Dict[str, str]:
+    """Contents of up to ``AUTO_CONTEXT_FILES`` files defining symbols *task* needs.
+
+    Symbols named in the task come first, then those referenced by the files
+    it updates.  Paths in *exclude* are already in the context.
+    """
+    if AUTO_CONTEXT_FILES <= 0:
+        return {}
+    index = _get_project_index()
+    names = _mentioned_symbols(_compact_json(task), index)
+    for deliverable in task.get("deliverables", []):
+        if (deliverable.get("type") or "").lower() == "update":
+            names += index.files.get(deliverable["path"], {}).get("refs", [])
+
+    related: Dict[str, str] = {}
+    for name in names:
+        for path in _primary_definitions(index, name):
+            if path in exclude or path in related:
+                continue
+            try:
+                related[path] = (REPO_ROOT / path).read_text()
+            except OSError:
+                continue
+            if len(related) >= AUTO_CONTEXT_FILES:
+                return related
+    return related
+
+
+def _declaration_excerpt(path: str, line: int, kind: str, max_lines: int = 60) -> Optional[dict]:
+    """The declaration at *line* of *path* through its closing brace, in code_windows form."""
+    try:
+        text = (REPO_ROOT / path).read_text(encoding="utf-8")
+    except (OSError, UnicodeDecodeError):
+        return None
+    lines = text.split("\n")
+    if not 1 <= line <= len(lines):
+        return None
+    masked = _scan_swift(text)[0].split("\n")
+    end, depth, opened = line, 0, False
+    for end in range(line, min(len(lines), line + max_lines - 1) + 1):
+        depth += masked[end - 1].count("{") - masked[end - 1].count("}")
+        opened = opened or "{" in masked[end - 1]
+        if kind == "typealias" or (opened and depth <= 0):
+            break
+        if depth < 0:  # left the enclosing scope: a body-less requirement
+            end -= 1
+            break
+    return {"start_line": line, "end_line": end, "code": "\n".join(lines[line - 1:end])}
+
+
+def _diagnostic_definitions(messages: List[str], skip: set) -> Dict[str, List[dict]]:
+    """Declarations of the project symbols quoted in compiler *messages*.
+
+    Returns ``{name: [{"file", "start_line", "end_line", "code"}, ...]}`` for
+    at most ``AUTO_CONTEXT_FILES`` names; files in *skip* are left out.
+    """
+    if AUTO_CONTEXT_FILES <= 0:
+        return {}
+    index = _get_project_index()
+    definitions: Dict[str, List[dict]] = {}
+    for message in messages:
+        for quoted in _QUOTED_RE.findall(message):
+            for m in _MENTION_RE.finditer(quoted):
+                name = m.group(1)
+                if name in definitions:
+                    continue
+                excerpts = []
+                for path, decls in _primary_definitions(index, name).items():
+                    if path in skip:
+                        continue
+                    for kind, line in decls:
+                        excerpt = _declaration_excerpt(path, line, kind)
+                        if excerpt:
+                            excerpts.append({"file": path, **excerpt})
+                if excerpts:
+                    definitions[name] = excerpts
+                    if len(definitions) >= AUTO_CONTEXT_FILES:
+                        return definitions
+    return definitions
+
+
 def analyze_ios_project() -> Dict[str, Any]:
     """Analyze the iOS project and return context"""
     context = {"has_ios_project": False}
+    index = _get_project_index()
 
     # Find Xcode project
-    xcode_projects = list(IOS_DIR.rglob("*.xcodeproj")) if IOS_DIR.exists() else []
+    xcode_projects = [REPO_ROOT / p for p in index.dirs_with_suffix(".xcodeproj")]
 
     if xcode_projects:
         context["has_ios_project"] = True
-        analyzer = XcodeProjectAnalyzer(xcode_projects[0])
+        analyzer = XcodeProjectAnalyzer(xcode_projects[0], index)
         context.update(analyzer.get_project_info())
         context["project_path"] = str(xcode_projects[0].relative_to(REPO_ROOT))
 
     # Get existing iOS file structure
     if IOS_DIR.exists():
-        context["ios_structure"] = get_directory_structure(IOS_DIR)
+        context["ios_structure"] = index.directory_structure()
 
     return context
 
@@ -266,16 +1555,185 @@ def load_task(task_path: Path) -> dict:
     return json.loads(task_path.read_text())
 
 
+# ---------------------------------------------------------------------------
+# Context packing — fit the iOS context into a per-call token budget
+# ---------------------------------------------------------------------------
+
+# Sections dropped or trimmed first when a context is over budget, lowest value first.
+# existing_file_contents and content_view_swift are never trimmed: "update"
+# deliverables and ContentView.swift are rewritten from them.
+_CONTEXT_TRIM_ORDER = [
+    "ios_structure", "storyboards", "dependencies", "related_files_contents",
+    "context_files_contents", "swift_files",
+]
+_MIN_TRIMMED_CHARS = 1500
+
+_encodings: Dict[str, Any] = {}
+_tiktoken: Any = None  # the module once imported; False when it isn't installed
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Token count for *model*; estimated as len/4 when tiktoken is unavailable."""
+    global _tiktoken
+    if _tiktoken is None:
+        try:
+            import tiktoken as _tiktoken
+        except ImportError:  # optional: falls back to a ~4 chars/token estimate
+            _tiktoken = False
+    if _tiktoken is False:
+        return (len(text) + 3) // 4
+    tiktoken = _tiktoken
+    enc = _encodings.get(model)
+    if enc is None:
+        try:
+            enc = tiktoken.encoding_for_model(model)
+        except KeyError:
+            enc = tiktoken.get_encoding("o200k_base")
+        _encodings[model] = enc
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def _compact_json(value) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def _truncate_text(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + f"\n// ... truncated {len(text) - max_chars} chars to fit the context budget"
+
+
+def pack_context(context: dict, budget: int, model: str = DEFAULT_MODEL, pinned=()) -> tuple:
+    """Shrink *context* until its compact JSON fits in *budget* tokens.
+
+    Sections in ``_CONTEXT_TRIM_ORDER`` are trimmed in turn: file contents
+    are halved down to ``_MIN_TRIMMED_CHARS`` and then dropped, everything
+    else is dropped outright.  Files in *pinned* (the ones the task will
+    write) are kept whole wherever they appear.  Returns *(packed_context,
+    trimmed_keys)*.
+    """
+    packed = dict(context)
+    trimmed: List[str] = []
+
+    def tokens() -> int:
+        return count_tokens(_compact_json(packed), model)
+
+    for key in _CONTEXT_TRIM_ORDER:
+        if key not in packed or tokens() <= budget:
+            continue
+        value = packed[key]
+        if isinstance(value, str):
+            limit = len(value) // 2
+            while limit >= _MIN_TRIMMED_CHARS:
+                packed[key] = _truncate_text(value, limit)
+                if tokens() <= budget:
+                    break
+                limit //= 2
+            else:
+                del packed[key]
+        elif isinstance(value, dict) and key.endswith("_contents"):
+            files = dict(value)
+            for path in sorted((p for p in files if p not in pinned), key=lambda p: len(files[p]), reverse=True):
+                files[path] = _truncate_text(files[path], _MIN_TRIMMED_CHARS)
+                packed[key] = files
+                if tokens() <= budget:
+                    break
+            else:
+                kept = {p: c for p, c in value.items() if p in pinned}
+                if kept:
+                    packed[key] = kept
+                else:
+                    del packed[key]
+        else:
+            del packed[key]
+        trimmed.append(key)
+    return packed, trimmed
+
+
+def _report_packing(label: str, naive_tokens: int, packed_tokens: int, trimmed: List[str]):
+    saved = naive_tokens - packed_tokens
+    detail = f"; trimmed {', '.join(trimmed)}" if trimmed else ""
+    print(f"  Context packer [{label}]: {naive_tokens} -> {packed_tokens} tokens ({saved} saved{detail})")
+
+
 # ---------------------------------------------------------------------------
 # LLM calling functions
 # ---------------------------------------------------------------------------
 
-def _get_client() -> OpenAI:
-    """Get an OpenAI client, raising if no API key is set."""
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY not set")
-    return OpenAI(api_key=api_key)
+_client: Optional["OpenAI"] = None
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = weakref.WeakKeyDictionary()
+
+
+def _get_client() -> "OpenAI":
+    """Get the shared OpenAI client (one connection pool per process), raising if no API key is set."""
+    global _client
+    if _client is None:
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("OPENAI_API_KEY not set")
+        from openai import OpenAI
+        _client = OpenAI(api_key=api_key, max_retries=0)  # retries go through the rate limiter
+    return _client
+
+
+def _get_async_client() -> "AsyncOpenAI":
+    """Get the async OpenAI client for the running event loop, raising if no API key is set.
+
+    Async clients hold connections bound to their loop, so one is kept per loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("OPENAI_API_KEY not set")
+        from openai import AsyncOpenAI
+        client = _async_clients[loop] = AsyncOpenAI(api_key=api_key, max_retries=0)
+    return client
+
+
+PIPELINE_PHASES = ("generation", "fix", "design_review", "design_fix", "merge")
+_TIERED_PHASES = ("fix", "design_review", "merge")
+
+
+def phase_models(task: dict, phase: str) -> List[str]:
+    """Models to try for *phase*, cheapest first.
+
+    ``task["models"][phase]`` names one model or a cascade (a list).  By
+    default design reviews, fixes and merges cascade from FAST_MODEL to the
+    task's model; every other phase uses the task's model alone.
+    """
+    base = task.get("model", DEFAULT_MODEL)
+    configured = (task.get("models") or {}).get(phase)
+    if configured:
+        models = [configured] if isinstance(configured, str) else list(configured)
+    elif phase in _TIERED_PHASES and FAST_MODEL:
+        models = [FAST_MODEL, base]
+    else:
+        models = [base]
+    return list(dict.fromkeys(m for m in models if m)) or [base]
+
+
+async def _with_escalation(models: List[str], call, valid=None) -> dict:
+    """Await ``call(model)`` for each model in turn until one gives a usable response.
+
+    A response is unusable when it is not valid JSON or *valid* rejects it;
+    the last model's response is returned (or its error raised) regardless.
+    """
+    for i, model in enumerate(models):
+        last = i == len(models) - 1
+        try:
+            result = await call(model)
+        except json.JSONDecodeError:
+            if last:
+                raise
+            reason = "malformed JSON"
+        else:
+            if last or valid is None or valid(result):
+                return result
+            reason = "an unusable response"
+        print(f"  {model} returned {reason}; escalating to {models[i + 1]}")
+        Tracer.count(escalations=1)
 
 
 def _build_enriched_context(task: dict, ios_context: dict) -> dict:
@@ -286,6 +1744,7 @@ def _build_enriched_context(task: dict, ios_context: dict) -> dict:
     content_view_path = REPO_ROOT / "ios" / "PT-Helper" / "PT-Helper" / "ContentView.swift"
     if content_view_path.exists():
         ios_context_enriched["content_view_swift"] = content_view_path.read_text()
+        _note_merge_base(CONTENT_VIEW_PATH, ios_context_enriched["content_view_swift"])
     else:
         ios_context_enriched["content_view_swift"] = ""
 
@@ -296,6 +1755,7 @@ def _build_enriched_context(task: dict, ios_context: dict) -> dict:
             d_path = REPO_ROOT / deliverable["path"]
             if d_path.exists():
                 existing_file_contents[deliverable["path"]] = d_path.read_text()
+                _note_merge_base(deliverable["path"], existing_file_contents[deliverable["path"]])
     if existing_file_contents:
         ios_context_enriched["existing_file_contents"] = existing_file_contents
 
@@ -308,23 +1768,41 @@ def _build_enriched_context(task: dict, ios_context: dict) -> dict:
     if context_files_contents:
         ios_context_enriched["context_files_contents"] = context_files_contents
 
+    # Files defining the symbols the task mentions, found via the symbol index
+    included = {CONTENT_VIEW_PATH, *existing_file_contents, *context_files_contents}
+    related_files_contents = _related_files(task, included)
+    if related_files_contents:
+        ios_context_enriched["related_files_contents"] = related_files_contents
+
     return ios_context_enriched
 
 
-def call_llm(task: dict, ios_context: dict, model_name: str = DEFAULT_MODEL) -> dict:
-    """Initial code generation call to LLM."""
-    client = _get_client()
+def _generation_request(task: dict, ios_context: dict, model_name: str) -> dict:
+    """Build the chat-completion kwargs for the initial generation call."""
     ios_context_enriched = _build_enriched_context(task, ios_context)
-
-    system_prompt = ORCH + "\n\n" + IOS + f"\n\n## iOS Project Context\n{json.dumps(ios_context_enriched, indent=2)}"
-
-    user_prompt = json.dumps({
+    packed, trimmed = pack_context(ios_context_enriched, CONTEXT_TOKEN_BUDGET, model_name,
+                                   pinned=_task_write_set(task))
+
+    # The context is sent once, in the user message; the system prompt stays
+    # static so every call shares the same prefix.
+    system_prompt = _prompt("ORCH") + "\n\n" + _prompt("IOS")
+    if UPDATE_FORMAT == "diff":
+        system_prompt += "\n\n" + _prompt("UPDATE_DIFF")
+    system_prompt += "\n\n## iOS Project Context\nProvided as `ios_context` in the user message."
+    user_prompt = _compact_json({
         "task": task,
-        "ios_context": ios_context_enriched
-    }, indent=2)
+        "ios_context": packed
+    })
+
+    naive_context = json.dumps(ios_context_enriched, indent=2)
+    _report_packing(
+        "generation",
+        count_tokens(naive_context, model_name) * 2 + count_tokens(json.dumps(task, indent=2), model_name),
+        count_tokens(user_prompt, model_name),
+        trimmed,
+    )
 
-    return _call_openai_with_retry(
-        client,
+    return dict(
         model=model_name,
         temperature=0.2,
         response_format={"type": "json_object"},
@@ -335,6 +1813,19 @@ def call_llm(task: dict, ios_context: dict, model_name: str = DEFAULT_MODEL) ->
     )
 
 
+def call_llm(task: dict, ios_context: dict, model_name: str = DEFAULT_MODEL) -> dict:
+    """Initial code generation call to LLM."""
+    return _call_openai_with_retry(_get_client(), **_generation_request(task, ios_context, model_name))
+
+
+async def call_llm_async(task: dict, ios_context: dict, model_name: str = DEFAULT_MODEL,
+                         on_change=None) -> dict:
+    """Async variant of :func:`call_llm`; streams when *on_change* is given."""
+    return await _acall_openai_with_retry(
+        _get_async_client(), on_change=on_change, **_generation_request(task, ios_context, model_name)
+    )
+
+
 def _extract_file_path_from_error(error_line: str) -> Optional[str]:
     """Extract a relative file path from an Xcode error line.
 
@@ -352,49 +1843,72 @@ def _extract_file_path_from_error(error_line: str) -> Optional[str]:
     return None
 
 
-def call_llm_fix(task: dict, ios_context: dict, previous_result: dict,
-                  errors: list, model_name: str = DEFAULT_MODEL) -> dict:
-    """Ask LLM to fix compile errors from a previous attempt.
+def _fix_request(task: dict, ios_context: dict, previous_result: dict,
+                 errors: list, model_name: str, diagnostics: Optional[list] = None) -> dict:
+    """Build the chat-completion kwargs for a compile-error fix call.
 
-    Now reads the contents of pre-existing files referenced in errors and
-    instructs the LLM to use ``action: "patch"`` for surgical edits on those
-    files instead of rewriting them from scratch.
+    *diagnostics* are the grouped records from the build check; without them
+    *errors* are parsed instead.  Each root-cause error is sent with a window
+    of the surrounding source rather than whole files.  The LLM is instructed to use
+    ``action: "patch"`` for surgical edits on pre-existing files instead of
+    rewriting them from scratch.
     """
-    client = _get_client()
-    system_prompt = ORCH + "\n\n" + IOS + f"\n\n## iOS Project Context\n{json.dumps(ios_context, indent=2)}"
+    packed, trimmed = pack_context(ios_context, FIX_CONTEXT_TOKEN_BUDGET, model_name)
+    packed_json = _compact_json(packed)
+    system_prompt = _prompt("ORCH") + "\n\n" + _prompt("IOS") + f"\n\n## iOS Project Context\n{packed_json}"
 
     # Files the agent created/updated in this task
     agent_file_paths = set()
     for ch in previous_result.get("changes", []):
         agent_file_paths.add(ch["path"])
 
-    # Read the current contents of external files referenced in errors
-    error_file_contents = {}
-    for err_line in errors:
-        file_path = _extract_file_path_from_error(err_line)
-        if file_path and file_path not in agent_file_paths and file_path not in error_file_contents:
-            full_path = REPO_ROOT / file_path
-            if full_path.exists():
-                error_file_contents[file_path] = full_path.read_text(encoding="utf-8")
-
-    fix_prompt = json.dumps({
+    roots = diagnostics or group_diagnostics(parse_diagnostics("\n".join(errors)))
+    diagnostics = []
+    for rec in roots:
+        path = _extract_file_path_from_error(format_diagnostic(rec)) if rec["file"] else None
+        entry = {"file": path or rec["file"], "line": rec["line"], "column": rec["column"],
+                 "message": rec["message"]}
+        if rec.get("notes"):
+            entry["notes"] = rec["notes"]
+        if rec.get("related"):
+            entry["related"] = [r.replace(f"{REPO_ROOT}/", "") for r in rec["related"]]
+        diagnostics.append(entry)
+    code_windows = _code_windows(roots)
+    pre_existing_files = sorted(p for p in code_windows if p not in agent_file_paths)
+    definitions = _diagnostic_definitions([rec["message"] for rec in roots], agent_file_paths)
+
+    fix_payload = {
         "instruction": (
             "The code you previously generated has compile errors. Fix them and return the corrected changes JSON.\n"
             "IMPORTANT RULES FOR FIXES:\n"
+            "- Each entry in diagnostics is a root-cause error; errors listed under 'related' are likely consequences of it.\n"
+            "- code_windows shows the current source around each error, keyed by file, with 1-based start_line/end_line.\n"
+            "- definitions shows the declarations of project symbols the errors mention, in the same form, for reference.\n"
             "- For files YOU created in this task (listed in previous_changes), use action 'create' or 'update' with FULL file contents.\n"
-            "- For PRE-EXISTING files you did NOT create (listed in error_file_contents), use action 'patch' with targeted find-and-replace edits.\n"
+            "- For PRE-EXISTING files you did NOT create (listed in pre_existing_files), use action 'patch' with targeted find-and-replace edits.\n"
             "- NEVER rewrite a pre-existing file from scratch. Use 'patch' to make the SMALLEST change that fixes the error.\n"
-            "- Each patch has 'find' (exact text currently in the file) and 'replace' (the corrected text).\n"
+            "- Each patch has 'find' (exact text copied from code_windows) and 'replace' (the corrected text).\n"
             "- Include 2-3 surrounding lines in 'find' to ensure the match is unique."
         ),
         "previous_changes": previous_result.get("changes", []),
-        "error_file_contents": error_file_contents,
-        "compile_errors": errors,
+        "pre_existing_files": pre_existing_files,
+        "diagnostics": diagnostics,
+        "code_windows": code_windows,
         "task": task
-    }, indent=2)
+    }
+    if definitions:
+        fix_payload["definitions"] = definitions
+    fix_prompt = _compact_json(fix_payload)
+
+    _report_packing(
+        "fix",
+        count_tokens(json.dumps(ios_context, indent=2), model_name)
+        + count_tokens(json.dumps(fix_payload, indent=2), model_name),
+        count_tokens(packed_json, model_name) + count_tokens(fix_prompt, model_name),
+        trimmed,
+    )
 
-    return _call_openai_with_retry(
-        client,
+    return dict(
         model=model_name,
         temperature=0.2,
         response_format={"type": "json_object"},
@@ -405,52 +1919,163 @@ def call_llm_fix(task: dict, ios_context: dict, previous_result: dict,
     )
 
 
-def design_review(task: dict, ios_context: dict, changes: list,
-                   model_name: str = DEFAULT_MODEL) -> dict:
-    """Evaluate the design quality of generated SwiftUI views.
+def call_llm_fix(task: dict, ios_context: dict, previous_result: dict,
+                  errors: list, model_name: str = DEFAULT_MODEL,
+                  diagnostics: Optional[list] = None) -> dict:
+    """Ask LLM to fix compile errors from a previous attempt."""
+    request = _fix_request(task, ios_context, previous_result, errors, model_name, diagnostics)
+    return _call_openai_with_retry(_get_client(), **request)
 
-    Returns a dict with: passes (bool), score (int 1-10), issues (list), summary (str).
-    """
-    client = _get_client()
 
-    # Read the actual written file contents from disk (post-enhance_swift_code)
+async def call_llm_fix_async(task: dict, ios_context: dict, previous_result: dict,
+                             errors: list, model_name: str = DEFAULT_MODEL,
+                             diagnostics: Optional[list] = None) -> dict:
+    """Async variant of :func:`call_llm_fix`."""
+    request = _fix_request(task, ios_context, previous_result, errors, model_name, diagnostics)
+    return await _acall_openai_with_retry(_get_async_client(), **request)
+
+
+_NO_DESIGN_FILES_RESULT = {"passes": True, "score": 7, "issues": [], "summary": "No Swift view files to review."}
+
+# Per-file review results keyed by model, task requirements and file content hash
+_design_review_cache: Dict[str, dict] = {}
+
+# A type conforming to SwiftUI's View; only files declaring one get a design review
+_SWIFTUI_VIEW_RE = _LazyPattern(r'\b(?:struct|class)\s+\w+\s*:[^{]*\bView\b')
+
+# A merged design review passes at this size-weighted score (the prompt's threshold)
+DESIGN_PASS_SCORE = 7
+
+
+def _design_review_files(changes: list) -> Dict[str, str]:
+    """Read the written SwiftUI view files from disk (post-enhance_swift_code).
+
+    Models, services and other non-view Swift files have no visual design
+    to review, so they are left out.
+    """
     file_contents = {}
     for ch in changes:
         file_path = REPO_ROOT / ch["path"]
         if file_path.exists() and file_path.suffix == ".swift":
-            file_contents[ch["path"]] = file_path.read_text()
+            content = file_path.read_text()
+            if _SWIFTUI_VIEW_RE.search(_SWIFT_NOISE_RE.sub(" ", content)):
+                file_contents[ch["path"]] = content
+    return file_contents
+
+
+def _design_review_key(task: dict, path: str, content: str, model_name: str) -> str:
+    material = json.dumps([model_name, task.get("requirements", []), task.get("description", ""), path])
+    return hashlib.sha256(material.encode("utf-8") + b"\0" + content.encode("utf-8")).hexdigest()
 
-    if not file_contents:
-        return {"passes": True, "score": 7, "issues": [], "summary": "No Swift view files to review."}
 
-    user_prompt = json.dumps({
+def _design_review_request(task: dict, path: str, content: str, model_name: str) -> dict:
+    """Build the chat-completion kwargs for reviewing a single file."""
+    user_prompt = _compact_json({
         "instruction": "Review the following SwiftUI files for design quality. Return your assessment as JSON.",
         "task_requirements": task.get("requirements", []),
         "task_description": task.get("description", ""),
-        "files": file_contents
-    }, indent=2)
+        "files": {path: content}
+    })
 
-    return _call_openai_with_retry(
-        client,
+    return dict(
         model=model_name,
         temperature=0.2,
         response_format={"type": "json_object"},
         messages=[
-            {"role": "system", "content": DESIGN_REVIEW_PROMPT},
+            {"role": "system", "content": _prompt("DESIGN_REVIEW_PROMPT")},
             {"role": "user", "content": user_prompt}
         ],
     )
 
 
-def call_llm_design_fix(task: dict, ios_context: dict, previous_result: dict,
-                         design_feedback: dict, model_name: str = DEFAULT_MODEL) -> dict:
-    """Ask LLM to improve design quality based on review feedback.
+def _merge_design_reviews(reviews: Dict[str, dict], weights: Optional[Dict[str, int]] = None) -> dict:
+    """Combine per-file reviews into the single ``{passes, score, issues, summary}`` shape.
 
-    Returns the same JSON schema as call_llm (title, summary, changes).
-    Uses slightly higher temperature (0.4) for more creative design.
+    The task passes only if every file's review passes with a score of at
+    least :data:`DESIGN_PASS_SCORE` and no high-severity issue is left, so
+    a weak new view can't hide behind a large file that scores well.  The
+    reported score is the mean of the file scores weighted by *weights*
+    (file sizes; equal by default).
+    """
+    issues = []
+    summaries = []
+    for path, review in reviews.items():
+        for issue in review.get("issues", []) or []:
+            if isinstance(issue, dict):
+                issues.append({"file": path, **issue} if "file" not in issue else issue)
+        if review.get("summary"):
+            summaries.append(f"{Path(path).name}: {review['summary']}")
+    scored = {p: r["score"] for p, r in reviews.items() if isinstance(r.get("score"), (int, float))}
+    total = sum(max(1, (weights or {}).get(p, 1)) for p in scored)
+    score = round(sum(s * max(1, (weights or {}).get(p, 1)) for p, s in scored.items()) / total) if scored else 0
+    high = any(str(i.get("severity", "")).lower() == "high" for i in issues)
+    every_file_passes = bool(reviews) and all(
+        r.get("passes") is True and scored.get(p, 0) >= DESIGN_PASS_SCORE for p, r in reviews.items()
+    )
+    return {
+        "passes": every_file_passes and not high,
+        "score": score,
+        "issues": issues,
+        "summary": " ".join(summaries),
+    }
+
+
+def _valid_design_review(review: dict) -> bool:
+    return isinstance(review.get("passes"), bool) and isinstance(review.get("score"), (int, float))
+
+
+def design_review(task: dict, ios_context: dict, changes: list,
+                  model_name: Optional[str] = None) -> dict:
+    """Evaluate the design quality of generated SwiftUI views.
+
+    Uses *model_name* if given, otherwise the task's design_review models
+    (see :func:`phase_models`).
+    Returns a dict with: passes (bool), score (int 1-10), issues (list), summary (str).
+    """
+    return asyncio.run(design_review_async(task, ios_context, changes, model_name))
+
+
+async def design_review_async(task: dict, ios_context: dict, changes: list,
+                              model_name: Optional[str] = None) -> dict:
+    """Async variant of :func:`design_review`.
+
+    Each SwiftUI view file is reviewed in its own concurrent call and the
+    results are merged (see :func:`_merge_design_reviews`).  A review that comes back malformed is retried on the next
+    model of the cascade.  Reviews are cached by file content hash, so a
+    file is never sent for review twice in the same state.
     """
-    client = _get_client()
+    file_contents = _design_review_files(changes)
+    if not file_contents:
+        return dict(_NO_DESIGN_FILES_RESULT)
+    models = [model_name] if model_name else phase_models(task, "design_review")
+    model_name = "|".join(models)
+
+    async def review_one(path: str, content: str) -> dict:
+        key = _design_review_key(task, path, content, model_name)
+        if key not in _design_review_cache:
+            client = _get_async_client()
+            _design_review_cache[key] = await _with_escalation(
+                models,
+                lambda m: _acall_openai_with_retry(client, **_design_review_request(task, path, content, m)),
+                _valid_design_review,
+            )
+        return _design_review_cache[key]
 
+    paths = list(file_contents)
+    cached = sum(1 for p in paths if _design_review_key(task, p, file_contents[p], model_name) in _design_review_cache)
+    if cached:
+        print(f"  Design review: {cached}/{len(paths)} file(s) unchanged since last review")
+    results = await asyncio.gather(*(review_one(p, file_contents[p]) for p in paths))
+    return _merge_design_reviews(dict(zip(paths, results)),
+                                 {p: file_contents[p].count("\n") + 1 for p in paths})
+
+
+def _design_fix_request(task: dict, ios_context: dict, previous_result: dict,
+                        design_feedback: dict, model_name: str) -> dict:
+    """Build the chat-completion kwargs for a design improvement call.
+
+    Uses slightly higher temperature (0.4) for more creative design.
+    """
     # Read current file contents from disk so the LLM sees post-enhancement code
     current_file_contents = {}
     for ch in previous_result.get("changes", []):
@@ -462,7 +2087,7 @@ def call_llm_design_fix(task: dict, ios_context: dict, previous_result: dict,
     ios_context_enriched["current_file_contents"] = current_file_contents
 
     system_prompt = (
-        ORCH + "\n\n" + IOS
+        _prompt("ORCH") + "\n\n" + _prompt("IOS")
         + f"\n\n## iOS Project Context\n{json.dumps(ios_context_enriched, indent=2)}"
     )
 
@@ -487,8 +2112,7 @@ def call_llm_design_fix(task: dict, ios_context: dict, previous_result: dict,
         "task": task
     }, indent=2)
 
-    return _call_openai_with_retry(
-        client,
+    return dict(
         model=model_name,
         temperature=0.4,
         response_format={"type": "json_object"},
@@ -499,19 +2123,398 @@ def call_llm_design_fix(task: dict, ios_context: dict, previous_result: dict,
     )
 
 
+def call_llm_design_fix(task: dict, ios_context: dict, previous_result: dict,
+                         design_feedback: dict, model_name: str = DEFAULT_MODEL) -> dict:
+    """Ask LLM to improve design quality based on review feedback.
+
+    Returns the same JSON schema as call_llm (title, summary, changes).
+    """
+    request = _design_fix_request(task, ios_context, previous_result, design_feedback, model_name)
+    return _call_openai_with_retry(_get_client(), **request)
+
+
+async def call_llm_design_fix_async(task: dict, ios_context: dict, previous_result: dict,
+                                    design_feedback: dict, model_name: str = DEFAULT_MODEL) -> dict:
+    """Async variant of :func:`call_llm_design_fix`."""
+    request = _design_fix_request(task, ios_context, previous_result, design_feedback, model_name)
+    return await _acall_openai_with_retry(_get_async_client(), **request)
+
+
+# ---------------------------------------------------------------------------
+# Workspace overlay — staged writes, atomic commit, cheap snapshots
+# ---------------------------------------------------------------------------
+
+class Workspace:
+    """Copy-on-write overlay over the files under *root*.
+
+    Writes and deletes are held in memory until :meth:`commit`, which
+    renames every file into place and restores the originals if any step
+    fails; :meth:`rollback` simply drops them.  :meth:`snapshot` lays out a
+    private copy of a subtree with the pending changes applied, for
+    isolated builds.
+    """
+
+    def __init__(self, root: Path = REPO_ROOT):
+        self.root = root
+        self.pending: Dict[str, Optional[str]] = {}  # repo-relative path -> content, None = delete
+
+    def _rel(self, path) -> str:
+        path = Path(path)
+        return (path.relative_to(self.root) if path.is_absolute() else path).as_posix()
+
+    def exists(self, path) -> bool:
+        rel = self._rel(path)
+        if rel in self.pending:
+            return self.pending[rel] is not None
+        return (self.root / rel).exists()
+
+    def read_text(self, path) -> str:
+        rel = self._rel(path)
+        if rel in self.pending:
+            if self.pending[rel] is None:
+                raise FileNotFoundError(self.root / rel)
+            return self.pending[rel]
+        return (self.root / rel).read_text(encoding="utf-8")
+
+    def write_text(self, path, content: str):
+        self.pending[self._rel(path)] = content
+
+    def delete(self, path):
+        self.pending[self._rel(path)] = None
+
+    def rollback(self):
+        self.pending.clear()
+
+    def commit(self) -> List[str]:
+        """Write the pending changes to *root*; returns the paths committed.
+
+        New contents are written to temporary files next to their targets
+        first, then renamed over them.  The originals are kept as hardlinks
+        until every rename has succeeded, so a failure part-way restores
+        the tree as it was, removing any folders created for new files.
+        """
+        staged: List[tuple] = []  # (target, temp file or None for a delete)
+        created: List[Path] = []  # folders made for new files
+
+        def remove_created():
+            for folder in sorted(created, key=lambda d: len(d.parts), reverse=True):
+                try:
+                    folder.rmdir()
+                except OSError:
+                    pass
+
+        try:
+            for rel, content in self.pending.items():
+                target = self.root / rel
+                if content is None:
+                    staged.append((target, None))
+                    continue
+                missing = []
+                folder = target.parent
+                while not folder.exists():
+                    missing.append(folder)
+                    folder = folder.parent
+                target.parent.mkdir(parents=True, exist_ok=True)
+                created += reversed(missing)
+                fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.", suffix=".tmp")
+                staged.append((target, Path(tmp)))
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(content)
+                if target.exists():
+                    shutil.copymode(target, tmp)
+        except BaseException:
+            for _, tmp in staged:
+                if tmp is not None:
+                    tmp.unlink(missing_ok=True)
+            remove_created()
+            raise
+
+        backups: List[tuple] = []  # (target, original kept aside or None)
+        try:
+            for target, tmp in staged:
+                backup = None
+                if target.exists():
+                    backup = target.with_name(f".{target.name}.{os.getpid()}.orig")
+                    backup.unlink(missing_ok=True)
+                    os.link(target, backup)
+                backups.append((target, backup))
+                if tmp is None:
+                    target.unlink(missing_ok=True)
+                else:
+                    os.replace(tmp, target)
+        except BaseException:
+            for target, backup in reversed(backups):
+                if backup is not None:
+                    # rename() is a no-op when both names link the same file
+                    os.replace(backup, target)
+                    backup.unlink(missing_ok=True)
+                else:
+                    target.unlink(missing_ok=True)
+            for _, tmp in staged:
+                if tmp is not None:
+                    tmp.unlink(missing_ok=True)
+            remove_created()
+            raise
+        for _, backup in backups:
+            if backup is not None:
+                backup.unlink(missing_ok=True)
+
+        committed = list(self.pending)
+        self.pending.clear()
+        return committed
+
+    def snapshot(self, subtree: Path = IOS_DIR) -> Path:
+        """Materialize *subtree* plus the pending changes in a fresh root laid out like the repo.
+
+        Unchanged files are hardlinked (copied where the filesystem can't
+        link them), so a snapshot costs one directory walk however large
+        the files are.  Because of the shared links, files in a snapshot
+        must be replaced rather than modified in place — writing through a
+        :class:`Workspace` rooted at the snapshot does that.
+        """
+        SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+        dest = Path(tempfile.mkdtemp(prefix="snapshot-", dir=SNAPSHOT_DIR))
+        place = os.link
+        for dirpath, dirnames, filenames in os.walk(subtree):
+            out_dir = dest / Path(dirpath).relative_to(self.root)
+            out_dir.mkdir(parents=True, exist_ok=True)
+            for name in list(dirnames):
+                src = os.path.join(dirpath, name)
+                if os.path.islink(src):
+                    os.symlink(os.readlink(src), out_dir / name)
+                    dirnames.remove(name)
+            for name in filenames:
+                src = os.path.join(dirpath, name)
+                if os.path.islink(src):
+                    os.symlink(os.readlink(src), out_dir / name)
+                    continue
+                try:
+                    place(src, out_dir / name)
+                except OSError:
+                    place = shutil.copy2
+                    place(src, out_dir / name)
+
+        prefix = subtree.relative_to(self.root).as_posix() + "/"
+        overlay = Workspace(dest)
+        for rel, content in self.pending.items():
+            if not rel.startswith(prefix):
+                continue
+            if content is None:
+                overlay.delete(rel)
+            else:
+                overlay.write_text(rel, content)
+        overlay.commit()
+        return dest
+
+
+# ---------------------------------------------------------------------------
+# Three-way merge — concurrent edits to shared files such as ContentView.swift
+# ---------------------------------------------------------------------------
+
+# Per-task record of the version of each file the task last saw or wrote
+# (repo path -> content).  Set by the task queue; None outside a queued task,
+# which disables merging.
+_merge_bases: contextvars.ContextVar = contextvars.ContextVar("agent_merge_bases", default=None)
+
+# Per-task record of the files the task has written to the repo (repo path ->
+# [content before its first write, content it last wrote]; None where the
+# file did not exist).  Set by the task queue so other tasks' builds can
+# leave unfinished work out (see PipelineLocks.track).
+_task_edits: contextvars.ContextVar = contextvars.ContextVar("agent_task_edits", default=None)
+
+
+def _note_merge_base(path: str, content: str):
+    """Record *content* as the version of *path* the current task's prompt showed, if none is yet."""
+    bases = _merge_bases.get()
+    if bases is not None:
+        bases.setdefault(path, content)
+
+
+def _diff_hunks(base: list, other: list) -> List[tuple]:
+    return [(i1, i2, other[j1:j2])
+            for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, base, other, autojunk=False).get_opcodes()
+            if tag != "equal"]
+
+
+def _apply_hunks(base: list, start: int, end: int, hunks: list) -> list:
+    out, pos = [], start
+    for i1, i2, lines in hunks:
+        out += base[pos:i1] + lines
+        pos = i2
+    return out + base[pos:end]
+
+
+def merge3(base: str, current: str, incoming: str) -> tuple:
+    """Line-based three-way merge of *current* and *incoming*, both edited from *base*.
+
+    Non-overlapping hunks from both sides are combined, identical edits
+    are taken once, and pure insertions at the same point are both kept
+    (current first).  Returns *(merged, conflicts)*; each remaining
+    conflict is left in *merged* between ``<<<<<<< current`` /
+    ``=======`` / ``>>>>>>> task`` markers.
+    """
+    if current == base or current == incoming:
+        return incoming, 0
+    if incoming == base:
+        return current, 0
+    b = base.splitlines(keepends=True)
+    if b and not b[-1].endswith("\n"):
+        b[-1] += "\n"
+    o = current.splitlines(keepends=True)
+    t = incoming.splitlines(keepends=True)
+    for lines in (o, t):
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+    hunks = sorted([(h, 0) for h in _diff_hunks(b, o)] + [(h, 1) for h in _diff_hunks(b, t)],
+                   key=lambda x: (x[0][0], x[0][1], x[1]))
+
+    out: List[str] = []
+    conflicts = 0
+    pos = 0
+    k = 0
+    while k < len(hunks):
+        (start, end, _), _ = hunks[k]
+        cluster = [hunks[k]]
+        k += 1
+        # Hunks overlapping the cluster's base range (or starting at the same
+        # point) have to be resolved together.
+        while k < len(hunks) and (hunks[k][0][0] < end or hunks[k][0][0] == start):
+            end = max(end, hunks[k][0][1])
+            cluster.append(hunks[k])
+            k += 1
+        out += b[pos:start]
+        pos = end
+        sides = [[h for h, side in cluster if side == s] for s in (0, 1)]
+        if not sides[1]:
+            out += _apply_hunks(b, start, end, sides[0])
+            continue
+        if not sides[0]:
+            out += _apply_hunks(b, start, end, sides[1])
+            continue
+        ours = _apply_hunks(b, start, end, sides[0])
+        theirs = _apply_hunks(b, start, end, sides[1])
+        if ours == theirs:
+            out += ours
+        elif start == end:
+            out += ours + theirs
+        else:
+            conflicts += 1
+            out += ["<<<<<<< current\n"] + ours + ["=======\n"] + theirs + [">>>>>>> task\n"]
+    out += b[pos:]
+    merged = "".join(out)
+    if not incoming.endswith("\n") and merged.endswith("\n") and not conflicts:
+        merged = merged[:-1]
+    return merged, conflicts
+
+
+class MergeConflict(Exception):
+    """Writing *incoming* over *current* (both edited from *base*) left *conflicts* in *marked*."""
+
+    def __init__(self, path: str, base: str, current: str, incoming: str, marked: str, conflicts: int):
+        super().__init__(f"{conflicts} merge conflict(s) in {path}")
+        self.path, self.base, self.current, self.incoming = path, base, current, incoming
+        self.marked, self.conflicts = marked, conflicts
+
+
+async def resolve_merge_conflicts(path: str, base: str, marked: str, models: List[str]) -> Optional[str]:
+    """Ask *models* in turn for patches resolving the conflict blocks in *marked*; None if none can."""
+    client = _get_async_client()
+    for model in models:
+        request = dict(
+            model=model,
+            temperature=0,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": _prompt("MERGE_PROMPT")},
+                {"role": "user", "content": _compact_json({"path": path, "base": base, "file_with_conflicts": marked})},
+            ],
+        )
+        try:
+            with _get_tracer().span("merge", path=path, model=model):
+                result = await _acall_openai_with_retry(client, **request)
+        except json.JSONDecodeError:
+            continue
+        resolved, errors, _ = plan_patches(marked, result.get("patches", []), Path(path).name)
+        if not errors and "<<<<<<< current" not in resolved:
+            return resolved
+        print(f"  Merge resolution from {model} incomplete for {path}")
+    return None
+
+
+def _merge_with_current(path: str, content: str, workspace: "Workspace",
+                        resolved: Optional[Dict[str, tuple]] = None) -> str:
+    """Three-way merge the current task's *content* for *path* with the version in *workspace*.
+
+    The base is the version the task last saw or wrote; without one (or
+    outside a queued task) *content* is returned unchanged, as is the case
+    when nothing else touched the file in between.  Writes into snapshots
+    are never merged: the real tree is merged when the change lands there.
+
+    Conflicts are never resolved here, since writes hold the tree lock:
+    *resolved* maps a path to *(current, incoming, text)* worked out
+    beforehand, and any other conflict raises :class:`MergeConflict`.
+    """
+    bases = _merge_bases.get()
+    if bases is None or workspace.root != REPO_ROOT:
+        return content
+    base = bases.get(path)
+    if base is None or not workspace.exists(path):
+        return content
+    current = workspace.read_text(path)
+    if current == base:
+        return content
+    merged, conflicts = merge3(base, current, content)
+    if not conflicts:
+        return merged
+    resolution = (resolved or {}).get(path)
+    if resolution is not None and resolution[:2] == (current, content):
+        return resolution[2]
+    raise MergeConflict(path, base, current, content, merged, conflicts)
+
+
 # ---------------------------------------------------------------------------
 # File writing and code enhancement
 # ---------------------------------------------------------------------------
 
-def write_changes(changes: list, ios_context: dict):
-    """Enhanced write_changes with iOS-specific handling and patch support."""
+def write_changes(changes: list, ios_context: dict, root: Path = REPO_ROOT,
+                  resolved: Optional[Dict[str, tuple]] = None):
+    """Enhanced write_changes with iOS-specific handling and patch support.
+
+    *root* lets the same changes be written into an isolated copy of the repo.
+    All changes are staged in a :class:`Workspace` and committed together,
+    so an error part-way through (including a :class:`MergeConflict` not
+    covered by *resolved*) leaves the tree untouched.
+    """
+    workspace = Workspace(root)
+    written: Dict[str, str] = {}
+    edits = _task_edits.get() if root == REPO_ROOT else None
+    try:
+        _write_changes(changes, ios_context, workspace, written, resolved)
+        staged = dict(workspace.pending)
+        preimages = {rel: (root / rel).read_text(encoding="utf-8") if (root / rel).exists() else None
+                     for rel in staged if edits is not None and rel not in edits}
+        workspace.commit()
+    finally:
+        if root == REPO_ROOT:
+            _refresh_project_index(ch["path"] for ch in changes)
+    bases = _merge_bases.get()
+    if bases is not None and root == REPO_ROOT:
+        bases.update(written)  # the task's next edit of these files builds on its own version
+    if edits is not None:
+        for rel, content in staged.items():
+            edits.setdefault(rel, [preimages.get(rel), None])[1] = content
+
+
+def _write_changes(changes: list, ios_context: dict, workspace: Workspace, written: Dict[str, str],
+                   resolved: Optional[Dict[str, tuple]] = None):
+    """Stage *changes* in *workspace*; *written* collects the task's own version of each full write."""
     for ch in changes:
-        path = REPO_ROOT / ch["path"]
+        path = workspace.root / ch["path"]
         action = ch["action"]
 
         if action == "delete":
-            if path.exists():
-                path.unlink()
+            if workspace.exists(path):
+                workspace.delete(path)
             continue
 
         # ── Patch action: surgical find-and-replace ──────────────
@@ -520,7 +2523,9 @@ def write_changes(changes: list, ios_context: dict):
             if not patches:
                 print(f"  Warning: patch action for {ch['path']} has no patches")
                 continue
-            success, errors = apply_patches(path, patches)
+            with _get_tracer().span("patch", path=ch["path"], edits=len(patches)) as span:
+                success, errors, diff = apply_patches(path, patches, workspace)
+                span["attrs"]["success"] = success
             if not success:
                 for err in errors:
                     print(f"  Patch error: {err}")
@@ -530,28 +2535,64 @@ def write_changes(changes: list, ios_context: dict):
                     content = ch["content"]
                     if path.suffix == ".swift":
                         content = enhance_swift_code(content, ios_context)
-                    path.write_text(content, encoding="utf-8")
+                    workspace.write_text(path, content)
             else:
+                print(f"  Patched {ch['path']} ({len(patches)} edit(s)):")
+                print(diff.rstrip("\n"))
                 # Re-run enhance_swift_code on the patched file
                 if path.suffix == ".swift":
-                    patched = path.read_text(encoding="utf-8")
+                    patched = workspace.read_text(path)
                     enhanced = enhance_swift_code(patched, ios_context)
                     if enhanced != patched:
-                        path.write_text(enhanced, encoding="utf-8")
+                        workspace.write_text(path, enhanced)
             continue
 
-        # ── Create / Update: full file replacement (unchanged) ───
-        path.parent.mkdir(parents=True, exist_ok=True)
+        # ── Create / Update: full file replacement ───────────────
+        content = _full_content(ch, ios_context, workspace)
+        if content is None:
+            continue
+        written[ch["path"]] = content
+        merged = _merge_with_current(ch["path"], content, workspace, resolved)
+        if merged != content:
+            print(f"  Merged {ch['path']} with concurrent changes")
+        workspace.write_text(path, merged)
+
+
+def _full_content(ch: dict, ios_context: dict, workspace: Workspace) -> Optional[str]:
+    """The text a create/update change writes before merging; None to skip the change."""
+    path = workspace.root / ch["path"]
+    content = ch.get("content", "")
+    if ch["action"] == "update" and not content and ch.get("diff"):
+        content = _content_from_diff(ch["path"], ch["diff"], workspace)
+        if content is None:
+            return None
+    if path.suffix == ".swift":
+        content = enhance_swift_code(content, ios_context)
+    elif path.suffix == ".storyboard":
+        content = validate_storyboard_content(content)
+    elif path.name == "Info.plist":
+        content = validate_plist_content(content)
+    return content
 
-        content = ch.get("content", "")
-        if path.suffix == ".swift":
-            content = enhance_swift_code(content, ios_context)
-        elif path.suffix == ".storyboard":
-            content = validate_storyboard_content(content)
-        elif path.name == "Info.plist":
-            content = validate_plist_content(content)
 
-        path.write_text(content, encoding="utf-8")
+def _merge_conflicts(changes: list, ios_context: dict, resolved: Dict[str, tuple]) -> List[MergeConflict]:
+    """Conflicts that writing *changes* to the repo now would hit and *resolved* doesn't cover."""
+    bases = _merge_bases.get()
+    if not bases:
+        return []
+    workspace = Workspace()
+    conflicts = []
+    for ch in changes:
+        if ch["action"] not in ("create", "update") or bases.get(ch["path"]) is None:
+            continue
+        content = _full_content(ch, ios_context, workspace)
+        if content is None:
+            continue
+        try:
+            _merge_with_current(ch["path"], content, workspace, resolved)
+        except MergeConflict as conflict:
+            conflicts.append(conflict)
+    return conflicts
 
 def enhance_swift_code(content: str, ios_context: dict) -> str:
     """Ensure Swift code has necessary imports without duplication."""
@@ -582,28 +2623,64 @@ def enhance_swift_code(content: str, ios_context: dict) -> str:
 # Patch helpers — surgical find-and-replace edits for existing files
 # ---------------------------------------------------------------------------
 
-def _normalize_whitespace(text: str) -> str:
-    """Normalize whitespace for fuzzy matching: strip trailing per line."""
-    lines = text.split('\n')
-    return '\n'.join(line.rstrip() for line in lines)
-
-
-def _replace_by_normalized_match(content: str, find_str: str, replace_str: str) -> Optional[str]:
-    """Replace using line-by-line stripped comparison.
-
-    Returns the new content if a match was found, else None.
+def _find_fuzzy_window(content_lines: List[str], find_str: str, threshold: float,
+                       prefix: Optional[List[int]] = None) -> int:
+    """Index of the window :func:`_fuzzy_replace` should replace, or -1.
+
+    Picks exactly what a full ``SequenceMatcher.ratio()`` scan over every
+    window would: the earliest window with the highest ratio, provided that
+    ratio reaches *threshold*.  Windows sharing the most stripped lines with
+    *find_str* are scored first so a strong match is found early; every
+    other window is then pruned by the length-only ``real_quick_ratio``
+    bound and the ``quick_ratio`` bound before paying for ``ratio()``.
+    *prefix* (cumulative line lengths) may be passed in when already built.
     """
-    content_lines = content.split('\n')
-    find_lines = find_str.rstrip('\n').split('\n')
+    target = find_str.rstrip('\n')
+    find_lines = target.split('\n')
     n = len(find_lines)
+    count = len(content_lines) - n + 1
+    if count <= 0:
+        return -1
+
+    # Window character lengths in O(1) each via prefix sums ('\n' joins add n - 1).
+    if prefix is None:
+        prefix = [0]
+        for line in content_lines:
+            prefix.append(prefix[-1] + len(line))
+    lb = len(target)
+
+    # Line-hash anchors: how many lines of each window also occur in find_str.
+    anchors = {line.strip() for line in find_lines if line.strip()}
+    hits = [1 if line.strip() in anchors else 0 for line in content_lines]
+    anchor_counts = []
+    running = sum(hits[:n])
+    for i in range(count):
+        anchor_counts.append(running)
+        if i + n < len(hits):
+            running += hits[i + n] - hits[i]
+    order = sorted(range(count), key=lambda i: (-anchor_counts[i], i))
+
+    matcher = difflib.SequenceMatcher(None, "", target)
+    best_ratio = 0.0
+    best_idx = -1
 
-    for i in range(len(content_lines) - n + 1):
-        window = content_lines[i:i + n]
-        if all(a.strip() == b.strip() for a, b in zip(window, find_lines)):
-            replace_lines = replace_str.rstrip('\n').split('\n')
-            new_lines = content_lines[:i] + replace_lines + content_lines[i + n:]
-            return '\n'.join(new_lines)
-    return None
+    def could_win(bound: float, i: int) -> bool:
+        if bound <= 0.0 or bound < threshold:
+            return False
+        return bound > best_ratio or (bound == best_ratio and i < best_idx)
+
+    for i in order:
+        la = prefix[i + n] - prefix[i] + n - 1
+        if la + lb and not could_win(2.0 * min(la, lb) / (la + lb), i):
+            continue
+        matcher.set_seq1('\n'.join(content_lines[i:i + n]))
+        if not could_win(matcher.quick_ratio(), i):
+            continue
+        ratio = matcher.ratio()
+        if could_win(ratio, i):
+            best_ratio = ratio
+            best_idx = i
+    return best_idx
 
 
 def _fuzzy_replace(content: str, find_str: str, replace_str: str,
@@ -611,26 +2688,16 @@ def _fuzzy_replace(content: str, find_str: str, replace_str: str,
     """Fuzzy find-and-replace using SequenceMatcher on line windows.
 
     Slides a window of the same line count as *find_str* across *content*
-    and picks the best match above *threshold*.
+    and picks the best match above *threshold* (see :func:`_find_fuzzy_window`).
     """
     content_lines = content.split('\n')
-    find_lines = find_str.rstrip('\n').split('\n')
-    n = len(find_lines)
+    n = len(find_str.rstrip('\n').split('\n'))
 
     if n > len(content_lines):
         return None
 
-    best_ratio = 0.0
-    best_idx = -1
-
-    for i in range(len(content_lines) - n + 1):
-        window = '\n'.join(content_lines[i:i + n])
-        ratio = difflib.SequenceMatcher(None, window, find_str.rstrip('\n')).ratio()
-        if ratio > best_ratio:
-            best_ratio = ratio
-            best_idx = i
-
-    if best_ratio >= threshold and best_idx >= 0:
+    best_idx = _find_fuzzy_window(content_lines, find_str, threshold)
+    if best_idx >= 0:
         replace_lines = replace_str.rstrip('\n').split('\n')
         new_lines = content_lines[:best_idx] + replace_lines + content_lines[best_idx + n:]
         return '\n'.join(new_lines)
@@ -638,17 +2705,122 @@ def _fuzzy_replace(content: str, find_str: str, replace_str: str,
     return None
 
 
-def apply_patches(file_path: Path, patches: list) -> tuple:
-    """Apply find-and-replace patches to an existing file.
+class _LineIndex:
+    """Line offsets of a text, built once and shared by every patch lookup."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self._built = False
+
+    def _build(self):
+        # Deferred: patch sets that only use exact matches never split the text.
+        self._lines = self.text.split('\n')
+        self._starts: List[int] = []
+        self._prefix = [0]
+        self._by_stripped: Dict[str, List[int]] = {}
+        pos = 0
+        for i, line in enumerate(self._lines):
+            self._starts.append(pos)
+            pos += len(line) + 1
+            self._prefix.append(self._prefix[-1] + len(line))
+            self._by_stripped.setdefault(line.strip(), []).append(i)
+        self._built = True
+
+    @property
+    def lines(self) -> List[str]:
+        if not self._built:
+            self._build()
+        return self._lines
+
+    @property
+    def prefix(self) -> List[int]:
+        if not self._built:
+            self._build()
+        return self._prefix
+
+    @property
+    def by_stripped(self) -> Dict[str, List[int]]:
+        if not self._built:
+            self._build()
+        return self._by_stripped
+
+    def line_span(self, i: int, n: int) -> tuple:
+        """Character span covering lines ``i .. i + n - 1`` (without the final newline)."""
+        if not self._built:
+            self._build()
+        last = i + n - 1
+        return self._starts[i], self._starts[last] + len(self._lines[last])
+
+
+def _overlaps(span: tuple, taken: List[tuple]) -> Optional[tuple]:
+    start, end = span
+    for other in taken:
+        if (start < other[1] and other[0] < end) or start == other[0]:
+            return other
+    return None
 
-    Returns *(success, errors)* where *success* is ``True`` only when every
-    patch was applied.  The file is written back to disk only on full success.
-    """
-    if not file_path.exists():
-        return False, [f"File not found: {file_path}"]
 
-    content = file_path.read_text(encoding="utf-8")
-    errors: list[str] = []
+def _locate_patch(index: _LineIndex, find_str: str, taken: List[tuple]) -> tuple:
+    """Find where *find_str* applies in the original text.
+
+    Tries an exact match, then a whitespace-normalized line match, then a
+    fuzzy line match (0.85 threshold).  Among repeated exact or normalized
+    matches the first one not already claimed by an earlier patch wins, so
+    edits to repeated boilerplate are deterministic.
+
+    Returns *(span, method, candidates)*; *span* is None when nothing
+    matched, and overlaps a claimed span when every candidate was claimed.
+    """
+    # Attempt 1: exact match — stop scanning at the first unclaimed occurrence
+    spans = []
+    pos = index.text.find(find_str)
+    while pos != -1:
+        spans.append((pos, pos + len(find_str)))
+        if _overlaps(spans[-1], taken) is None:
+            if index.text.find(find_str, pos + 1) != -1:
+                spans.append(None)  # more occurrences exist; only the count matters
+            break
+        pos = index.text.find(find_str, pos + 1)
+    method = "exact"
+
+    # Attempt 2: whitespace-normalized match
+    if not spans:
+        find_lines = find_str.rstrip('\n').split('\n')
+        n = len(find_lines)
+        stripped = [line.strip() for line in find_lines]
+        for i in index.by_stripped.get(stripped[0], []):
+            window = index.lines[i:i + n]
+            if len(window) == n and all(a.strip() == b for a, b in zip(window, stripped)):
+                spans.append(index.line_span(i, n))
+        method = "normalized"
+
+    # Attempt 3: fuzzy match (0.85 threshold)
+    if not spans:
+        n = len(find_str.rstrip('\n').split('\n'))
+        if n <= len(index.lines):
+            best = _find_fuzzy_window(index.lines, find_str, 0.85, prefix=index.prefix)
+            if best >= 0:
+                spans.append(index.line_span(best, n))
+        method = "fuzzy"
+
+    if not spans:
+        return None, method, 0
+    free = [span for span in spans if span is not None and _overlaps(span, taken) is None]
+    return (free or spans)[0], method, len(spans)
+
+
+def plan_patches(content: str, patches: list, label: str = "file") -> tuple:
+    """Locate every patch against the original *content* and apply them in one pass.
+
+    Returns *(new_content, errors, notes)*.  Patches that match nothing or
+    overlap an earlier patch's target are reported in *errors* and left out;
+    *notes* records which fallback matched and any ambiguous targets.
+    """
+    index = _LineIndex(content)
+    errors: List[str] = []
+    notes: List[str] = []
+    edits: List[tuple] = []  # (start, end, replacement)
+    taken: List[tuple] = []
 
     for i, patch in enumerate(patches):
         find_str = patch.get("find", "")
@@ -658,29 +2830,300 @@ def apply_patches(file_path: Path, patches: list) -> tuple:
             errors.append(f"Patch {i}: empty 'find' string")
             continue
 
-        # Attempt 1: exact match
-        if find_str in content:
-            content = content.replace(find_str, replace_str, 1)
+        span, method, candidates = _locate_patch(index, find_str, taken)
+        if span is None:
+            errors.append(f"Patch {i}: could not find target string in {label}")
+            continue
+        clash = _overlaps(span, taken)
+        if clash is not None:
+            line = content.count('\n', 0, span[0]) + 1
+            errors.append(f"Patch {i}: target at line {line} overlaps an earlier patch in {label}")
+            continue
+        if candidates > 1:
+            line = content.count('\n', 0, span[0]) + 1
+            notes.append(f"Patch {i}: multiple {method} matches, applied at line {line}")
+        elif method != "exact":
+            notes.append(f"Patch {i}: applied via {method} match")
+
+        replacement = replace_str if method == "exact" else replace_str.rstrip('\n')
+        taken.append(span)
+        edits.append((span[0], span[1], replacement))
+
+    return _splice(content, edits), errors, notes
+
+
+def _splice(content: str, edits: List[tuple]) -> str:
+    """Apply non-overlapping *(start, end, replacement)* edits to *content* in one pass."""
+    pieces = []
+    cursor = 0
+    for start, end, replacement in sorted(edits):
+        pieces.append(content[cursor:start])
+        pieces.append(replacement)
+        cursor = end
+    pieces.append(content[cursor:])
+    return ''.join(pieces)
+
+
+def apply_patches(file_path: Path, patches: list, workspace: Optional[Workspace] = None) -> tuple:
+    """Apply find-and-replace patches to an existing file.
+
+    All targets are located against the original contents and applied in a
+    single pass (see :func:`plan_patches`).  Returns *(success, errors, diff)*
+    where *success* is ``True`` only when every patch was applied and *diff*
+    is a unified diff of the change.  The file is written back only on full
+    success: staged in *workspace* when given, otherwise renamed into place
+    on disk.
+    """
+    ws = workspace or Workspace(file_path.parent)
+    if not ws.exists(file_path):
+        return False, [f"File not found: {file_path}"], ""
+
+    content = ws.read_text(file_path)
+    new_content, errors, notes = plan_patches(content, patches, file_path.name)
+    for note in notes:
+        print(f"  {note}")
+
+    if errors:
+        return False, errors, ""
+
+    ws.write_text(file_path, new_content)
+    if workspace is None:
+        ws.commit()
+    diff = ''.join(difflib.unified_diff(
+        content.splitlines(keepends=True), new_content.splitlines(keepends=True),
+        fromfile=f"a/{file_path.name}", tofile=f"b/{file_path.name}",
+    ))
+    return True, [], diff
+
+
+_HUNK_HEADER_RE = _LazyPattern(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@')
+
+
+def _parse_unified_diff(diff: str) -> List[dict]:
+    """Hunks of a unified diff as ``{"start", "lines"}``.
+
+    *start* is the 0-based line of the original the hunk begins at (None
+    when the header has no line numbers) and *lines* are *(tag, text)*
+    pairs with tag ``" "``, ``"-"`` or ``"+"``.  Header line counts are
+    ignored, since model-written diffs often get them wrong: a hunk runs
+    until the next header.  Lines missing their leading space are read as
+    context.
+    """
+    hunks: List[dict] = []
+    hunk = None
+    lines = diff.rstrip("\n").split("\n")
+    for i, line in enumerate(lines):
+        if line.startswith("@@"):
+            m = _HUNK_HEADER_RE.match(line)
+            start = None
+            if m:
+                start = int(m.group(1)) if m.group(2) == "0" else max(int(m.group(1)) - 1, 0)
+            hunk = {"start": start, "lines": []}
+            hunks.append(hunk)
+        elif line.startswith("--- ") and i + 1 < len(lines) and lines[i + 1].startswith("+++ "):
+            hunk = None  # file header; the change already names the file
+        elif hunk is None or line.startswith("\\"):
             continue
+        elif line[:1] in ("-", "+", " "):
+            hunk["lines"].append((line[0], line[1:]))
+        else:
+            hunk["lines"].append((" ", line))
+    return [h for h in hunks if any(tag != " " for tag, _ in h["lines"])]
+
 
-        # Attempt 2: whitespace-normalized match
-        result = _replace_by_normalized_match(content, find_str, replace_str)
-        if result is not None:
-            content = result
+def _locate_hunk(index: _LineIndex, old: List[str], taken: List[tuple], near: int) -> tuple:
+    """First line where the *old* side of a hunk applies, as *(line, method)*; line is -1 if nowhere.
+
+    Uses the :func:`_locate_patch` fallbacks on whole lines: exact, then
+    whitespace-normalized, then fuzzy.  Among several exact or normalized
+    matches the unclaimed one nearest *near* wins.
+    """
+    n = len(old)
+    if n > len(index.lines):
+        return -1, None
+    stripped = [line.strip() for line in old]
+    exact, normalized = [], []
+    for i in index.by_stripped.get(stripped[0], []):
+        window = index.lines[i:i + n]
+        if len(window) == n and all(a.strip() == b for a, b in zip(window, stripped)):
+            (exact if window == old else normalized).append(i)
+    for method, starts in (("exact", exact), ("normalized", normalized)):
+        free = [i for i in starts if _overlaps(index.line_span(i, n), taken) is None]
+        if free:
+            return min(free, key=lambda i: (abs(i - near), i)), method
+    best = _find_fuzzy_window(index.lines, "\n".join(old), 0.85, prefix=index.prefix)
+    if best >= 0 and _overlaps(index.line_span(best, n), taken) is None:
+        return best, "fuzzy"
+    return -1, None
+
+
+def _place_hunk(index: _LineIndex, hunk: dict, taken: List[tuple]) -> Optional[tuple]:
+    """*(span, replacement, note)* for one hunk, dropping context lines if needed; None if it fits nowhere."""
+    lines = hunk["lines"]
+    lead = next((k for k, (tag, _) in enumerate(lines) if tag != " "), len(lines))
+    trail = next((k for k, (tag, _) in enumerate(reversed(lines)) if tag != " "), len(lines))
+    hint = hunk["start"]
+
+    if not any(tag != "+" for tag, _ in lines):
+        # Pure insertion without context: only the line number says where
+        if hint is None:
+            return None
+        added = "\n".join(text for _, text in lines)
+        if hint < len(index.lines):
+            pos = index.line_span(hint, 1)[0]
+            return (pos, pos), added + "\n", None
+        return (len(index.text), len(index.text)), "\n" + added, None
+
+    for fuzz in range(DIFF_MAX_FUZZ + 1):
+        head, tail = min(fuzz, lead), min(fuzz, trail)
+        if fuzz and head + tail == 0:
+            break
+        body = lines[head:len(lines) - tail]
+        old = [text for tag, text in body if tag != "+"]
+        new = [text for tag, text in body if tag != "-"]
+        near = (hint or 0) + head
+        line, method = _locate_hunk(index, old, taken, near)
+        if line < 0:
             continue
+        span = index.line_span(line, len(old))
+        if method == "normalized":
+            # Re-indent added lines the way the matched lines are indented
+            k = next((k for k, text in enumerate(old) if text.strip()), 0)
+            have, want = old[k], index.lines[line + k]
+            have, want = have[:len(have) - len(have.lstrip())], want[:len(want) - len(want.lstrip())]
+            new = [want + text[len(have):] if text.startswith(have) else text for text in new]
+        if not new:  # pure deletion: take a line break with the lines
+            span = (span[0], span[1] + 1) if span[1] < len(index.text) else (max(span[0] - 1, 0), span[1])
+        notes = []
+        if method != "exact":
+            notes.append(f"{method} match")
+        if hint is not None and line != near:
+            notes.append(f"offset {line - near:+d} lines")
+        if fuzz:
+            notes.append(f"fuzz {fuzz}")
+        return span, "\n".join(new), ", ".join(notes) or None
+    return None
+
+
+def apply_unified_diff(content: str, diff: str, label: str = "file") -> tuple:
+    """Apply a unified *diff* to *content*, tolerating drifted line numbers and context.
 
-        # Attempt 3: fuzzy match (0.85 threshold)
-        result = _fuzzy_replace(content, find_str, replace_str, threshold=0.85)
-        if result is not None:
-            content = result
+    Every hunk is located against the original *content*, preferring the
+    match nearest its header's line number, with the same exact /
+    normalized / fuzzy fallbacks as :func:`plan_patches`.  A hunk that
+    matches nowhere is retried with up to ``DIFF_MAX_FUZZ`` context lines
+    dropped from each end, like ``patch --fuzz``.  Returns *(new_content,
+    errors, notes)*; hunks that could not be placed are listed in *errors*
+    and left out.
+    """
+    hunks = _parse_unified_diff(diff)
+    if not hunks:
+        return content, [f"No hunks in the diff for {label}"], []
+    index = _LineIndex(content)
+    errors: List[str] = []
+    notes: List[str] = []
+    edits: List[tuple] = []
+    taken: List[tuple] = []
+    for i, hunk in enumerate(hunks):
+        placed = _place_hunk(index, hunk, taken)
+        if placed is None:
+            errors.append(f"Hunk {i}: its context does not match {label}")
+            continue
+        span, replacement, note = placed
+        if note:
+            notes.append(f"Hunk {i}: applied with {note}")
+        taken.append(span)
+        edits.append((span[0], span[1], replacement))
+    return _splice(content, edits), errors, notes
+
+
+async def request_full_content(path: str, content: str, diff: str, errors: List[str],
+                               models: List[str]) -> Optional[str]:
+    """Ask *models* in turn to apply *diff* to *content* and return the whole file; None if none can."""
+    client = _get_async_client()
+    for model in models:
+        request = dict(
+            model=model,
+            temperature=0,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": _prompt("DIFF_FALLBACK_PROMPT")},
+                {"role": "user", "content": _compact_json({"path": path, "file": content, "diff": diff,
+                                                          "errors": errors})},
+            ],
+        )
+        try:
+            with _get_tracer().span("diff_fallback", path=path, model=model):
+                result = await _acall_openai_with_retry(client, **request)
+        except json.JSONDecodeError:
             continue
+        if isinstance(result.get("content"), str) and result["content"].strip():
+            return result["content"]
+        print(f"  Full-content fallback from {model} returned no file for {path}")
+    return None
+
+
+def _apply_change_diff(path: str, diff: str, workspace: Workspace) -> tuple:
+    """Apply an ``update`` change's *diff*; returns *(content, base, errors)*, content None on failure.
+
+    The diff is applied to the version the task's prompt showed when known
+    (any concurrent edits are merged in afterwards), else to the current file.
+    """
+    base = (_merge_bases.get() or {}).get(path)
+    if base is None:
+        if not workspace.exists(path):
+            return None, None, [f"diff for {path}, which does not exist"]
+        base = workspace.read_text(path)
+    with _get_tracer().span("diff", path=path) as span:
+        content, errors, notes = apply_unified_diff(base, diff, Path(path).name)
+        span["attrs"]["failed_hunks"] = len(errors)
+    for note in notes:
+        print(f"  {note}")
+    if errors:
+        return None, base, errors
+    print(f"  Applied diff to {path} ({len(_parse_unified_diff(diff))} hunk(s))")
+    return content, base, []
+
+
+def _content_from_diff(path: str, diff: str, workspace: Workspace) -> Optional[str]:
+    """Full new contents of *path* for an ``update`` that carries a *diff*; None if it doesn't apply.
+
+    The pipeline converts diffs with :func:`_resolve_diffs` before writing;
+    this covers direct callers of :func:`write_changes`.
+    """
+    content, _, errors = _apply_change_diff(path, diff, workspace)
+    for err in errors:
+        print(f"  Diff error: {err}")
+    if content is None:
+        print(f"  Warning: could not apply the diff for {path}; leaving it unchanged")
+    return content
 
-        errors.append(f"Patch {i}: could not find target string in {file_path.name}")
 
-    if not errors:
-        file_path.write_text(content, encoding="utf-8")
+async def _resolve_diffs(task: dict, changes: list) -> list:
+    """*changes* with every diff ``update`` turned into full contents.
 
-    return len(errors) == 0, errors
+    Runs before the tree lock is taken: when a hunk doesn't apply, the
+    task's merge models are asked for the complete file instead.  Updates
+    that can't be resolved either way are dropped.
+    """
+    resolved = []
+    for ch in changes:
+        if ch.get("action") != "update" or ch.get("content") or not ch.get("diff"):
+            resolved.append(ch)
+            continue
+        content, base, errors = await asyncio.to_thread(_apply_change_diff, ch["path"], ch["diff"], Workspace())
+        if content is None:
+            for err in errors:
+                print(f"  Diff error: {err}")
+            if base is not None:
+                print(f"  Falling back to full file contents for {ch['path']}")
+                content = await request_full_content(ch["path"], base, ch["diff"], errors,
+                                                     phase_models(task, "merge"))
+        if content is None:
+            print(f"  Warning: could not apply the diff for {ch['path']}; leaving it unchanged")
+            continue
+        resolved.append(dict(ch, content=content))
+    return resolved
 
 
 def validate_storyboard_content(content: str) -> str:
@@ -750,43 +3193,533 @@ def synthesize_ios_content(path: str, ios_context: dict, task: dict) -> str:
             class_name = fname.replace('-', '_').replace(' ', '_')
             return f"""import Foundation
 
-class {class_name} {{
-    // MARK: - Properties
+class {class_name} {{
+    // MARK: - Properties
+
+    // MARK: - Initialization
+    init() {{
+        // TODO: Initialize {class_name}
+    }}
+
+    // MARK: - Methods
+
+}}
+"""
+
+    elif path.endswith(".storyboard"):
+        return validate_storyboard_content("")
+
+    elif path.endswith(".md"):
+        return f"# {path_obj.stem}\n\nThis iOS component was generated by the agent.\n\n## Usage\n\nTODO: Add usage instructions.\n"
+
+    elif path.name == "Info.plist":
+        return validate_plist_content("")
+
+    # Default fallback
+    return f"// {path_obj.name} generated by iOS agent\n// TODO: Implement functionality\n"
+
+
+# ---------------------------------------------------------------------------
+# Swift pre-flight checks — catch obvious breakage before xcodebuild
+# ---------------------------------------------------------------------------
+
+_CODE_TOKEN_RE = _LazyPattern(r'//|/\*|(#*)("""|")|[{}()\[\]]')
+_BLOCK_COMMENT_TOKEN_RE = _LazyPattern(r'/\*|\*/')
+_CLOSERS = {")": "(", "]": "[", "}": "{"}
+_string_token_res: Dict[tuple, Any] = {}
+
+_TOP_LEVEL_DECL_RE = _LazyPattern(
+    r'\b((?:(?:public|private|fileprivate|internal|open|final|indirect)\s+)*)'
+    r'(struct|class|enum|protocol|actor)\s+([A-Za-z_]\w*)|[{}]'
+)
+_NOT_TYPE_NAMES = {"func", "var", "let", "subscript", "init"}
+_IMPORT_RE = _LazyPattern(
+    r'^[ \t]*(?:@\w+[ \t]+)?import[ \t]+(?:(?:typealias|struct|class|enum|protocol|let|var|func)[ \t]+)?(\w+)',
+    re.MULTILINE,
+)
+
+# Module -> usage that requires importing it (matched against code only).
+_IMPORT_RULES = [
+    ("SwiftUI", "View", _LazyPattern(r':\s*(?:some\s+)?View\b|@(?:State|StateObject|ObservedObject|EnvironmentObject|Binding)\b')),
+    ("FirebaseAuth", "Auth", _LazyPattern(r'\bAuth\.auth\(\)')),
+    ("FirebaseFirestore", "Firestore", _LazyPattern(r'\bFirestore\.firestore\(\)')),
+    ("Charts", "Chart", _LazyPattern(r'\b(?:Chart\s*[({]|(?:Bar|Line|Point|Area|Rule)Mark\s*\()')),
+]
+_STRAY_LINE_RE = _LazyPattern(r'^\s*(```|<{7}|>{7}|={7}$)', re.MULTILINE)
+_PLACEHOLDER_RE = _LazyPattern(r'//\s*\.\.\.\s*(?:rest of|existing|full file|remaining|unchanged)', re.IGNORECASE)
+
+
+def _blank(text: str) -> str:
+    return re.sub(r'[^\n]', ' ', text)
+
+
+def _string_token_re(close: str, escape: str, multiline: bool):
+    key = (close, escape, multiline)
+    if key not in _string_token_res:
+        pattern = re.escape(escape) + r'(\(|.)|' + re.escape(close) + ('' if multiline else r'|\n')
+        _string_token_res[key] = re.compile(pattern, re.DOTALL)
+    return _string_token_res[key]
+
+
+def _scan_swift(text: str) -> tuple:
+    r"""Lex *text* just enough to check bracket balance.
+
+    Handles line and nested block comments, single-line, multi-line and raw
+    string literals, and ``\(...)`` interpolation.  Returns *(masked,
+    problems)*: *masked* is *text* with comments and string contents blanked
+    (newlines kept, so offsets still map to lines) and *problems* is a list
+    of *(offset, message)*.
+    """
+    pieces: List[str] = []
+    problems: List[tuple] = []
+    brackets: List[tuple] = []  # (opener, offset); "\\(" marks an interpolation
+    suspended: List[tuple] = []  # string literals waiting for an interpolation to close
+    string = None  # (close, escape, multiline, offset) while inside a literal
+    pos, n = 0, len(text)
+
+    while pos < n:
+        if string is not None:
+            close, escape, multiline, opened = string
+            m = _string_token_re(close, escape, multiline).search(text, pos)
+            if m is None or m.group(0) == "\n":
+                problems.append((opened, "unterminated string literal"))
+                end = n if m is None else m.start()
+                pieces.append(_blank(text[pos:end]))
+                pos, string = end, None
+                continue
+            pieces.append(_blank(text[pos:m.start()]))
+            if m.group(0) == close:
+                pieces.append(close)
+                string = None
+            elif m.group(1) == "(":
+                pieces.append(_blank(m.group(0)[:-1]) + "(")
+                brackets.append(("\\(", m.start()))
+                suspended.append(string)
+                string = None
+            else:
+                pieces.append(_blank(m.group(0)))
+            pos = m.end()
+            continue
+
+        m = _CODE_TOKEN_RE.search(text, pos)
+        if m is None:
+            pieces.append(text[pos:])
+            break
+        start, tok = m.start(), m.group(0)
+        pieces.append(text[pos:start])
+        pos = m.end()
+        if tok == "//":
+            end = text.find("\n", start)
+            end = n if end == -1 else end
+            pieces.append(_blank(text[start:end]))
+            pos = end
+        elif tok == "/*":
+            depth = 1
+            while depth:
+                bm = _BLOCK_COMMENT_TOKEN_RE.search(text, pos)
+                if bm is None:
+                    problems.append((start, "unterminated '/*' comment"))
+                    pos = n
+                    break
+                depth += 1 if bm.group(0) == "/*" else -1
+                pos = bm.end()
+            pieces.append(_blank(text[start:pos]))
+        elif m.group(2):
+            hashes, quote = m.group(1), m.group(2)
+            string = (quote + hashes, "\\" + hashes, quote == '"""', start)
+            pieces.append(tok)
+        elif tok in "([{":
+            pieces.append(tok)
+            brackets.append((tok, start))
+        else:
+            pieces.append(tok)
+            if not brackets:
+                problems.append((start, f"extraneous '{tok}'"))
+                continue
+            opener, opened_at = brackets.pop()
+            if opener == "\\(":
+                if tok == ")":
+                    string = suspended.pop()
+                    continue
+                opener = "("
+            if opener != _CLOSERS[tok]:
+                problems.append((start, f"expected closing for '{opener}' before '{tok}'"))
+                brackets.append((opener, opened_at))
+
+    if string is not None:
+        problems.append((string[3], "unterminated string literal"))
+    for opener, opened_at in brackets:
+        problems.append((opened_at, f"'{opener[-1]}' is never closed"))
+    return ''.join(pieces), problems
+
+
+def _top_level_types(masked: str) -> List[tuple]:
+    """*(name, offset, private)* for types declared at file scope."""
+    decls = []
+    depth = 0
+    for m in _TOP_LEVEL_DECL_RE.finditer(masked):
+        tok = m.group(0)
+        if tok == "{":
+            depth += 1
+        elif tok == "}":
+            depth = max(0, depth - 1)
+        elif depth == 0 and m.group(3) not in _NOT_TYPE_NAMES:
+            private = bool(re.search(r'\b(?:private|fileprivate)\b', m.group(1)))
+            decls.append((m.group(3), m.start(3), private))
+    return decls
+
+
+_preflight_scans: Dict[str, tuple] = {}
+
+
+def _preflight_scan(text: str, digest: str) -> tuple:
+    """Cached *(masked, problems, top_level_types)* for a file's contents."""
+    if digest not in _preflight_scans:
+        masked, problems = _scan_swift(text)
+        _preflight_scans[digest] = (masked, problems, _top_level_types(masked))
+    return _preflight_scans[digest]
+
+
+def _diagnostic(path: str, text: str, offset: int, message: str) -> str:
+    """Format like xcodebuild so downstream error handling treats both alike."""
+    line = text.count('\n', 0, offset) + 1
+    col = offset - (text.rfind('\n', 0, offset) + 1) + 1
+    return f"{REPO_ROOT / path}:{line}:{col}: error: {message}"
+
+
+def _snapshot_sha1(root: Path, path: str, sha1: str) -> Optional[str]:
+    """Hash of *path* in the snapshot *root*; the index's *sha1* while it is still linked to the repo's copy."""
+    try:
+        st = os.stat(root / path)
+    except OSError:
+        return None
+    try:
+        if os.path.samestat(st, os.stat(REPO_ROOT / path)):
+            return sha1
+    except OSError:
+        pass
+    try:
+        return hashlib.sha1((root / path).read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+def preflight_check(changed_paths, root: Path = REPO_ROOT) -> List[str]:
+    """Cheap static checks of changed Swift files, in xcodebuild error format.
+
+    Flags unbalanced brackets or unterminated literals, top-level types
+    declared in more than one file, missing imports for well-known
+    framework APIs, and stray markdown fences, conflict markers or
+    placeholder comments left behind by a patch.  Unchanged files are only
+    consulted (via cached scans keyed on the project index's hashes) to
+    detect duplicate type declarations.  Files are read from *root*, which
+    may be an isolated copy of the repo: one that differs from the repo's
+    copy there is hashed afresh, one missing there is skipped.
+    """
+    index = _get_project_index()
+    files = dict(index.files)  # other tasks' writes may refresh the index meanwhile
+    changed = sorted({p for p in changed_paths
+                      if p.endswith(".swift") and (root / p).is_file()
+                      and (root != REPO_ROOT or p in files)})
+    if not changed:
+        return []
+
+    # Duplicate declarations only matter within one target: the folder named
+    # after an .xcodeproj (Xcode's synchronized root) is compiled as a unit.
+    target_roots = [d[:-len(".xcodeproj")] + "/" for d in index.dirs_with_suffix(".xcodeproj")]
+
+    def target_of(path: str) -> Optional[str]:
+        return next((root for root in target_roots if path.startswith(root)), None)
+
+    changed_targets = {target_of(p) for p in changed} - {None}
+
+    diagnostics: List[str] = []
+    declared: Dict[str, List[tuple]] = {}
+    for path, entry in files.items():
+        if not path.endswith(".swift") or path in changed or target_of(path) not in changed_targets:
+            continue
+        sha1 = entry["sha1"] if root == REPO_ROOT else _snapshot_sha1(root, path, entry["sha1"])
+        if sha1 is None:
+            continue
+        if sha1 not in _preflight_scans:
+            try:
+                text = (root / path).read_text(encoding="utf-8")
+            except (OSError, UnicodeDecodeError):
+                continue
+            _preflight_scan(text, sha1)
+        for name, _, private in _preflight_scans[sha1][2]:
+            if not private:
+                declared.setdefault(name, []).append((path, None))
+
+    for path in changed:
+        try:
+            raw = (root / path).read_bytes()
+            text = raw.decode("utf-8")
+        except (OSError, UnicodeDecodeError):
+            continue
+        masked, problems, decls = _preflight_scan(text, hashlib.sha1(raw).hexdigest())
+
+        for offset, message in problems:
+            diagnostics.append(_diagnostic(path, text, offset, message))
+
+        for name, offset, private in decls:
+            if private or target_of(path) is None:
+                continue
+            others = declared.setdefault(name, [])
+            if others:
+                where = others[0][0]
+                diagnostics.append(_diagnostic(path, text, offset, f"invalid redeclaration of '{name}' (also declared in {where})"))
+            others.append((path, offset))
+
+        imports = set(_IMPORT_RE.findall(masked))
+        for module, symbol, usage in _IMPORT_RULES:
+            if module in imports or (module.startswith("Firebase") and "Firebase" in imports):
+                continue
+            if symbol in declared and any(p == path or o is None for p, o in declared[symbol]):
+                continue  # the project defines its own type of that name
+            m = usage.search(masked)
+            if m:
+                diagnostics.append(_diagnostic(path, text, m.start(), f"cannot find '{symbol}' in scope (missing 'import {module}')"))
+
+        for m in _STRAY_LINE_RE.finditer(masked):
+            diagnostics.append(_diagnostic(path, text, m.start(1), f"stray text '{m.group(1)}' left in file"))
+        for m in _PLACEHOLDER_RE.finditer(text):
+            diagnostics.append(_diagnostic(path, text, m.start(), "placeholder comment left in file instead of real code"))
+
+    return diagnostics
+
+
+# ---------------------------------------------------------------------------
+# Build diagnostics — structured compiler errors, cascades folded together
+# ---------------------------------------------------------------------------
+
+_DIAGNOSTIC_RE = _LazyPattern(
+    r'^(?P<file>[^:\n]+):(?P<line>\d+):(?P<column>\d+): (?P<severity>error|warning|note): (?P<message>.*)$'
+)
+_BARE_DIAGNOSTIC_RE = _LazyPattern(r'^(?:(?P<tool>[^:\n]+): )?(?P<severity>error|warning|note): (?P<message>.*)$')
+_UNDEFINED_SYMBOL_RE = _LazyPattern(r"^cannot find (?:type )?'([^']+)' in scope")
+_SYNTAX_ERROR_RE = _LazyPattern(r"^(?:expected |extraneous |unexpected |consecutive (?:statements|declarations) )")
+
+
+def parse_diagnostics(output: str) -> List[Dict[str, Any]]:
+    """Parse compiler/xcodebuild output into diagnostic records.
+
+    Each record has ``file``, ``line``, ``column``, ``severity``, ``message``
+    and ``notes``; notes are attached to the diagnostic they follow.
+    Repeated diagnostics (xcodebuild prints some twice) are dropped.
+    """
+    records: List[Dict[str, Any]] = []
+    seen = set()
+    last = None
+    for raw in output.split("\n"):
+        line = raw.strip()
+        m = _DIAGNOSTIC_RE.match(line)
+        if m:
+            rec = {"file": m.group("file"), "line": int(m.group("line")), "column": int(m.group("column")),
+                   "severity": m.group("severity"), "message": m.group("message").strip(), "notes": []}
+        else:
+            m = _BARE_DIAGNOSTIC_RE.match(line)
+            if not m:
+                continue
+            message = m.group("message").strip()
+            if m.group("tool"):
+                message = f"{m.group('tool')}: {message}"
+            rec = {"file": None, "line": None, "column": None,
+                   "severity": m.group("severity"), "message": message, "notes": []}
+        if rec["severity"] == "note":
+            if last is not None:
+                where = f"{Path(rec['file']).name}:{rec['line']}: " if rec["file"] else ""
+                last["notes"].append(where + rec["message"])
+            continue
+        key = (rec["file"], rec["line"], rec["column"], rec["message"])
+        if key in seen:
+            last = None  # notes of a duplicate were already recorded
+            continue
+        seen.add(key)
+        records.append(rec)
+        last = rec
+    return records
+
 
-    // MARK: - Initialization
-    init() {{
-        // TODO: Initialize {class_name}
-    }}
+def group_diagnostics(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Fold cascading errors into the error that most likely caused them.
 
-    // MARK: - Methods
+    An error is treated as a consequence of an earlier one when it is on the
+    same line, reports the same undefined symbol, or follows a syntax error
+    further down the same file.  Returns the root errors in output order,
+    each with the folded messages under ``related``.
+    """
+    roots: List[Dict[str, Any]] = []
+    by_line: Dict[tuple, Dict[str, Any]] = {}
+    by_symbol: Dict[str, Dict[str, Any]] = {}
+    syntax_root: Dict[str, Dict[str, Any]] = {}
+    for rec in records:
+        if rec["severity"] != "error":
+            continue
+        symbol = _UNDEFINED_SYMBOL_RE.match(rec["message"])
+        cause = None
+        if rec["file"]:
+            cause = by_line.get((rec["file"], rec["line"]))
+            if cause is None and rec["file"] in syntax_root and rec["line"] > syntax_root[rec["file"]]["line"]:
+                cause = syntax_root[rec["file"]]
+        if cause is None and symbol:
+            cause = by_symbol.get(symbol.group(1))
+        if cause is not None:
+            cause["related"].append(format_diagnostic(rec))
+            continue
 
-}}
-"""
+        root = dict(rec, related=[])
+        roots.append(root)
+        if rec["file"]:
+            by_line[(rec["file"], rec["line"])] = root
+            if _SYNTAX_ERROR_RE.match(rec["message"]) and rec["file"] not in syntax_root:
+                syntax_root[rec["file"]] = root
+        if symbol:
+            by_symbol.setdefault(symbol.group(1), root)
+    return roots
 
-    elif path.endswith(".storyboard"):
-        return validate_storyboard_content("")
 
-    elif path.endswith(".md"):
-        return f"# {path_obj.stem}\n\nThis iOS component was generated by the agent.\n\n## Usage\n\nTODO: Add usage instructions.\n"
+def format_diagnostic(rec: Dict[str, Any]) -> str:
+    """Render a diagnostic record back into xcodebuild's one-line format."""
+    if rec.get("file"):
+        return f"{rec['file']}:{rec['line']}:{rec['column']}: {rec['severity']}: {rec['message']}"
+    return f"{rec['severity']}: {rec['message']}"
 
-    elif path.name == "Info.plist":
-        return validate_plist_content("")
 
-    # Default fallback
-    return f"// {path_obj.name} generated by iOS agent\n// TODO: Implement functionality\n"
+def _error_diagnostics(output: str) -> List[Dict[str, Any]]:
+    return group_diagnostics(parse_diagnostics(output))
+
+
+def _code_windows(records: List[Dict[str, Any]], radius: int = DIAGNOSTIC_CONTEXT_LINES) -> Dict[str, List[dict]]:
+    """Source excerpts around each diagnostic, merged per file.
+
+    Returns ``{repo_path: [{"start_line", "end_line", "code"}, ...]}`` with
+    overlapping windows in the same file joined into one.
+    """
+    spans: Dict[str, List[List[int]]] = {}
+    for rec in records:
+        path = _extract_file_path_from_error(format_diagnostic(rec)) if rec.get("file") else None
+        if path and rec.get("line"):
+            spans.setdefault(path, []).append([max(1, rec["line"] - radius), rec["line"] + radius])
+
+    windows: Dict[str, List[dict]] = {}
+    for path, ranges in spans.items():
+        try:
+            lines = (REPO_ROOT / path).read_text(encoding="utf-8").split("\n")
+        except (OSError, UnicodeDecodeError):
+            continue
+        merged: List[List[int]] = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        windows[path] = [
+            {"start_line": start, "end_line": min(end, len(lines)),
+             "code": "\n".join(lines[start - 1:end])}
+            for start, end in merged if start <= len(lines)
+        ]
+    return windows
 
 
 # ---------------------------------------------------------------------------
 # Xcode build check
 # ---------------------------------------------------------------------------
 
-def _ensure_xcode_selected() -> Optional[str]:
-    """Ensure xcode-select points to a full Xcode installation. Returns error string or None."""
+class BuildToolchain:
+    """Commands the build check runs, pluggable so it can be driven by fakes.
+
+    ``xcodebuild`` and ``swiftc`` default to the real tools and can be
+    overridden with the ``AGENT_XCODEBUILD`` / ``AGENT_SWIFTC`` environment
+    variables (shell-split), e.g. to point at a fake compiler on Linux.
+    ``AGENT_IOS_SDK`` skips the ``xcrun`` SDK lookup.
+    """
+
+    def __init__(self, xcodebuild: Optional[List[str]] = None, swiftc: Optional[List[str]] = None,
+                 sdk_path: Optional[str] = None, runner=None):
+        self.xcodebuild = xcodebuild or shlex.split(os.environ.get("AGENT_XCODEBUILD", "xcodebuild"))
+        self.swiftc = swiftc or shlex.split(os.environ.get("AGENT_SWIFTC", "xcrun swiftc"))
+        self._sdk_path = sdk_path or os.environ.get("AGENT_IOS_SDK")
+        self.runner = runner or subprocess.run
+        self.xcode_ready = False
+
+    def run(self, args: List[str], timeout: int):
+        return self.runner(args, capture_output=True, text=True, timeout=timeout)
+
+    def sdk_path(self) -> Optional[str]:
+        if self._sdk_path is None:
+            try:
+                proc = self.run(["xcrun", "--sdk", "iphonesimulator", "--show-sdk-path"], timeout=10)
+                self._sdk_path = proc.stdout.strip() if proc.returncode == 0 else ""
+            except (OSError, subprocess.TimeoutExpired):
+                self._sdk_path = ""
+        return self._sdk_path or None
+
+    def with_runner(self, runner) -> "BuildToolchain":
+        """Same commands and Xcode state, executed through *runner*."""
+        clone = BuildToolchain(self.xcodebuild, self.swiftc, self._sdk_path, runner)
+        clone.xcode_ready = self.xcode_ready
+        return clone
+
+
+class CancellableRunner:
+    """``subprocess.run`` stand-in whose in-flight processes can be killed.
+
+    Used for speculative builds so losing candidates stop consuming CPU as
+    soon as another candidate compiles.
+    """
+
+    def __init__(self):
+        self._procs = set()
+        self._lock = threading.Lock()
+        self.cancelled = False
+
+    def __call__(self, args, capture_output=True, text=True, timeout=None):
+        with self._lock:
+            if self.cancelled:
+                return subprocess.CompletedProcess(args, -9, "", "cancelled")
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=text)
+            self._procs.add(proc)
+        try:
+            out, err = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        finally:
+            with self._lock:
+                self._procs.discard(proc)
+        return subprocess.CompletedProcess(args, proc.returncode, out, err)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for proc in self._procs:
+                proc.kill()
+
+
+_build_toolchain: Optional[BuildToolchain] = None
+
+
+def _get_build_toolchain() -> BuildToolchain:
+    global _build_toolchain
+    if _build_toolchain is None:
+        _build_toolchain = BuildToolchain()
+    return _build_toolchain
+
+
+def _ensure_xcode_selected(toolchain: Optional[BuildToolchain] = None) -> Optional[str]:
+    """Ensure xcode-select points to a full Xcode installation. Returns error string or None.
+
+    Only checked once per toolchain; later build checks skip straight to the build.
+    """
+    toolchain = toolchain or _get_build_toolchain()
+    if toolchain.xcode_ready:
+        return None
     try:
-        check = subprocess.run(
-            ["xcodebuild", "-version"], capture_output=True, text=True, timeout=10
-        )
+        check = toolchain.run(toolchain.xcodebuild + ["-version"], timeout=10)
         if check.returncode == 0:
+            toolchain.xcode_ready = True
             return None  # Already working
 
         # Try to auto-fix by selecting Xcode.app
@@ -803,6 +3736,7 @@ def _ensure_xcode_selected() -> Optional[str]:
                 )
                 if fix.returncode == 0:
                     print(f"Auto-selected Xcode at: {path}")
+                    toolchain.xcode_ready = True
                     return None
         return "xcodebuild requires full Xcode, not just Command Line Tools. Run: sudo xcode-select -s /Applications/Xcode.app/Contents/Developer"
     except Exception as e:
@@ -832,74 +3766,187 @@ def _parse_scheme(proc_result) -> Optional[str]:
     return None
 
 
-def run_ios_build_check() -> Dict[str, Any]:
-    """Run actual Xcode build to validate generated code compiles."""
+def _discover_build_config(project_path: str, toolchain: BuildToolchain,
+                           cache_key: Optional[str] = None) -> tuple:
+    """Scheme and destination for *project_path*, cached on a hash of project.pbxproj.
+
+    Returns *(config, error)*; ``xcodebuild -list`` only runs when the
+    project file changed since the cached discovery.  *cache_key* (the
+    repo-relative project path) lets isolated copies share the cache.
+    """
+    cache_key = cache_key or project_path
+    pbxproj = Path(project_path) / "project.pbxproj"
+    try:
+        project_hash = hashlib.sha256(pbxproj.read_bytes()).hexdigest()
+    except OSError:
+        project_hash = None
+
+    cache = {}
+    if BUILD_CONFIG_CACHE_PATH.exists():
+        try:
+            cache = json.loads(BUILD_CONFIG_CACHE_PATH.read_text())
+        except ValueError:
+            cache = {}
+    cached = cache.get(cache_key)
+    if project_hash and cached and cached.get("pbxproj_sha256") == project_hash:
+        return cached, None
+
+    # Check for workspace (SPM projects often need -workspace)
+    workspace_path = None
+    standalone_workspaces = sorted(Path(project_path).parent.glob("*.xcworkspace"))
+    if standalone_workspaces:
+        workspace_path = str(standalone_workspaces[0])
+
+    # Discover the scheme — try workspace first, then project
+    if workspace_path:
+        list_cmd = toolchain.xcodebuild + ["-list", "-workspace", workspace_path]
+    else:
+        list_cmd = toolchain.xcodebuild + ["-list", "-project", project_path]
+    list_proc = toolchain.run(list_cmd, timeout=30)
+
+    scheme = _parse_scheme(list_proc)
+
+    # Fallback: try -project if workspace didn't yield a scheme
+    if not scheme and workspace_path:
+        list_cmd = toolchain.xcodebuild + ["-list", "-project", project_path]
+        list_proc = toolchain.run(list_cmd, timeout=30)
+        scheme = _parse_scheme(list_proc)
+
+    if not scheme:
+        err_detail = list_proc.stderr.strip() if list_proc.returncode != 0 else "No schemes listed"
+        return None, f"No scheme found in project. xcodebuild output: {err_detail}"
+
+    config = {
+        "pbxproj_sha256": project_hash,
+        "scheme": scheme,
+        "destination": BUILD_DESTINATION,
+    }
+    if project_hash:
+        cache[cache_key] = config
+        BUILD_CONFIG_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        BUILD_CONFIG_CACHE_PATH.write_text(json.dumps(cache, indent=2))
+    return config, None
+
+
+def _typecheck_changed_files(project_path: str, scheme: str, changed_paths,
+                             toolchain: BuildToolchain, root: Path = REPO_ROOT,
+                             derived_data: Path = DERIVED_DATA_DIR) -> Optional[List[Dict[str, Any]]]:
+    """Type-check only the changed Swift files, parsing the rest of the target.
+
+    Returns the grouped compiler diagnostics, an empty list when the changed files
+    type-check, or None when the fast path is not applicable or inconclusive
+    (e.g. package modules not built into DerivedData yet).
+    """
+    source_root = Path(project_path).parent / scheme
+    source_prefix = source_root.relative_to(root).as_posix() + "/"
+    sources = set(_get_project_index().paths_with_suffix(".swift"))
+    sources |= {p for p in changed_paths or [] if p.endswith(".swift")}
+    sources = sorted(p for p in sources if p.startswith(source_prefix) and (root / p).is_file())
+    primaries = sorted({p for p in changed_paths or [] if p in sources})
+    sdk = toolchain.sdk_path()
+    if not primaries or not sdk:
+        return None
+
+    products = derived_data / "Build" / "Products" / "Debug-iphonesimulator"
+    cmd = toolchain.swiftc + ["-frontend", "-typecheck"]
+    for p in primaries:
+        cmd += ["-primary-file", str(root / p)]
+    cmd += [str(root / p) for p in sources if p not in primaries]
+    cmd += ["-sdk", sdk, "-target", TYPECHECK_TARGET,
+            "-module-name", re.sub(r'\W', '_', scheme),
+            "-F", str(products), "-I", str(products)]
+    try:
+        proc = toolchain.run(cmd, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if proc.returncode == 0:
+        return []
+    diagnostics = _error_diagnostics(proc.stderr + proc.stdout)
+    if not diagnostics or any("no such module" in d["message"] for d in diagnostics):
+        return None
+    return diagnostics
+
+
+def run_ios_build_check(changed_paths=None, toolchain: Optional[BuildToolchain] = None,
+                        root: Path = REPO_ROOT, derived_data: Path = DERIVED_DATA_DIR) -> Dict[str, Any]:
+    """Run actual Xcode build to validate generated code compiles.
+
+    Scheme discovery is cached per project.pbxproj hash and builds reuse a
+    stable DerivedData directory.  When *changed_paths* is given, those
+    Swift files are type-checked first and their errors returned without
+    paying for a full build; a full build still runs once they pass.
+
+    *root* builds an isolated copy of the repo instead; error paths are
+    reported as if the build had run in the repo itself.
+    """
+    toolchain = toolchain or _get_build_toolchain()
+    with _get_tracer().span("build", isolated=root != REPO_ROOT) as span:
+        result = _run_ios_build_check(changed_paths, toolchain, root, derived_data)
+        span["attrs"].update(stage=result.get("stage"), can_build=result["can_build"],
+                             errors=len(result["errors"]))
+    if root != REPO_ROOT:
+        result["errors"] = [e.replace(str(root), str(REPO_ROOT)) for e in result["errors"]]
+        for d in result.get("diagnostics", []):
+            if d["file"]:
+                d["file"] = d["file"].replace(str(root), str(REPO_ROOT))
+            d["related"] = [r.replace(str(root), str(REPO_ROOT)) for r in d["related"]]
+    return result
+
+
+def _run_ios_build_check(changed_paths, toolchain: BuildToolchain,
+                         root: Path, derived_data: Path) -> Dict[str, Any]:
     result = {"can_build": False, "errors": []}
 
     # Ensure xcode-select points to full Xcode
-    xcode_err = _ensure_xcode_selected()
+    xcode_err = _ensure_xcode_selected(toolchain)
     if xcode_err:
         result["errors"].append(xcode_err)
         return result
 
     try:
-        xcode_projects = list(IOS_DIR.rglob("*.xcodeproj")) if IOS_DIR.exists() else []
+        xcode_projects = _get_project_index().dirs_with_suffix(".xcodeproj")
         if not xcode_projects:
             result["errors"].append("No Xcode project found")
             return result
 
-        project_path = str(xcode_projects[0])
-
-        # Check for workspace (SPM projects often need -workspace)
-        workspace_path = None
-        workspace_dir = Path(project_path) / "project.xcworkspace"
-        standalone_workspaces = list(Path(project_path).parent.glob("*.xcworkspace"))
-        if standalone_workspaces:
-            workspace_path = str(standalone_workspaces[0])
+        project_path = str(root / xcode_projects[0])
 
-        # Discover the scheme — try workspace first, then project
-        if workspace_path:
-            list_cmd = ["xcodebuild", "-list", "-workspace", workspace_path]
-        else:
-            list_cmd = ["xcodebuild", "-list", "-project", project_path]
-        list_proc = subprocess.run(list_cmd, capture_output=True, text=True, timeout=30)
-
-        scheme = _parse_scheme(list_proc)
-
-        # Fallback: try -project if workspace didn't yield a scheme
-        if not scheme and workspace_path:
-            list_cmd = ["xcodebuild", "-list", "-project", project_path]
-            list_proc = subprocess.run(list_cmd, capture_output=True, text=True, timeout=30)
-            scheme = _parse_scheme(list_proc)
-
-        if not scheme:
-            err_detail = list_proc.stderr.strip() if list_proc.returncode != 0 else "No schemes listed"
-            result["errors"].append(f"No scheme found in project. xcodebuild output: {err_detail}")
+        config, err = _discover_build_config(project_path, toolchain, cache_key=xcode_projects[0])
+        if err:
+            result["errors"].append(err)
+            return result
+        scheme = config["scheme"]
+
+        typecheck_errors = _typecheck_changed_files(project_path, scheme, changed_paths, toolchain,
+                                                    root, derived_data)
+        if typecheck_errors:
+            print(f"Typecheck of changed files failed ({len(typecheck_errors)} error(s)); skipping full build.")
+            result["stage"] = "typecheck"
+            result["diagnostics"] = typecheck_errors[:20]
+            result["errors"] = [format_diagnostic(d) for d in result["diagnostics"]]
             return result
 
         print(f"Building with scheme: {scheme}")
 
         # Run actual build (simulator, no code signing)
-        build_cmd = [
-            "xcodebuild", "build",
+        build_cmd = toolchain.xcodebuild + [
+            "build",
             "-project", project_path,
             "-scheme", scheme,
-            "-destination", "generic/platform=iOS Simulator",
+            "-destination", config["destination"],
+            "-derivedDataPath", str(derived_data),
             "-quiet",
             "CODE_SIGNING_ALLOWED=NO"
         ]
-        build_proc = subprocess.run(
-            build_cmd, capture_output=True, text=True, timeout=180
-        )
+        build_proc = toolchain.run(build_cmd, timeout=180)
+        result["stage"] = "build"
 
         if build_proc.returncode == 0:
             result["can_build"] = True
         else:
-            error_lines = []
-            for line in (build_proc.stderr + build_proc.stdout).split('\n'):
-                if ": error:" in line:
-                    error_lines.append(line.strip())
-            result["errors"] = error_lines[:20] if error_lines else [
+            result["diagnostics"] = _error_diagnostics(build_proc.stderr + build_proc.stdout)[:20]
+            error_lines = [format_diagnostic(d) for d in result["diagnostics"]]
+            result["errors"] = error_lines if error_lines else [
                 f"Build failed with exit code {build_proc.returncode}. Last output: {build_proc.stderr[-500:]}"
             ]
 
@@ -913,15 +3960,398 @@ def run_ios_build_check() -> Dict[str, Any]:
     return result
 
 
+# ---------------------------------------------------------------------------
+# Concurrency — lets independent tasks overlap while matching a serial run
+# ---------------------------------------------------------------------------
+
+CONTENT_VIEW_PATH = "ios/PT-Helper/PT-Helper/ContentView.swift"
+
+# Shared files that concurrent tasks may both edit: their versions are merged
+# three-way on write instead of the tasks running one after another
+# (comma-separated repo paths)
+MERGE_PATHS = set(filter(None, os.environ.get("AGENT_MERGE_PATHS", CONTENT_VIEW_PATH).split(",")))
+
+
+class PipelineLocks:
+    """Locks shared by tasks that run concurrently in one agent process.
+
+    ``claim`` is held by a task for its whole pipeline over the files it is
+    expected to write, so tasks with overlapping write sets run in queue
+    order.  ``tree`` is held around every write and every read of the
+    tree.  Each running task registers its edits with :meth:`track`;
+    xcodebuild compiles the whole tree, so while another task's edits are
+    unfinished a build runs in a snapshot with them taken out.
+    """
+
+    def __init__(self):
+        self.tree = asyncio.Lock()
+        self._path_locks: Dict[str, asyncio.Lock] = {}
+        self.in_flight: List[Optional[dict]] = []  # running tasks' edits; the index is the build slot
+
+    @contextlib.contextmanager
+    def track(self, edits: dict):
+        """Register a running task's *edits* (see ``_task_edits``) for the duration of the block."""
+        slot = next((i for i, e in enumerate(self.in_flight) if e is None), len(self.in_flight))
+        if slot == len(self.in_flight):
+            self.in_flight.append(None)
+        self.in_flight[slot] = edits
+        try:
+            yield
+        finally:
+            self.in_flight[slot] = None
+
+    def others_in_flight(self, edits: Optional[dict]) -> List[dict]:
+        """Edits of running tasks other than the owner of *edits* that have written anything."""
+        return [e for e in self.in_flight if e and e is not edits]
+
+    def build_slot(self, edits: Optional[dict]) -> int:
+        return next((i for i, e in enumerate(self.in_flight) if e is not None and e is edits), 0)
+
+    @contextlib.asynccontextmanager
+    async def claim(self, paths):
+        # Acquire in sorted order so two tasks can never deadlock on each other.
+        acquired = []
+        try:
+            for p in sorted(set(paths)):
+                lock = self._path_locks.setdefault(p, asyncio.Lock())
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+
+def _task_write_set(task: dict) -> set:
+    """Repo paths a task is expected to write, derived from its deliverables."""
+    paths = set()
+    creates_view = False
+    for d in task.get("deliverables", []):
+        p = d.get("path")
+        if not p:
+            continue
+        paths.add(p)
+        if (d.get("type") or "new").lower() == "new" and Path(p).stem.endswith("View"):
+            creates_view = True
+    # The orchestrator prompt makes every task that creates a view rewrite ContentView.swift
+    if creates_view:
+        paths.add(CONTENT_VIEW_PATH)
+    return paths
+
+
+def _task_conflict_set(task: dict) -> set:
+    """Paths in a task's write set that another task must not write at the same time."""
+    return _task_write_set(task) - MERGE_PATHS
+
+
+def _task_read_set(task: dict) -> set:
+    """Repo paths a task reads for context before writing anything."""
+    return set(task.get("context_files", []))
+
+
+def _topological_order(after: List[set]) -> List[int]:
+    """Order task indices so each comes after the ones in *after*, otherwise by queue position.
+
+    A dependency cycle is broken by running the earliest remaining task
+    first, ignoring its unmet dependencies.
+    """
+    remaining = {i: set(deps) for i, deps in enumerate(after)}
+    order: List[int] = []
+    while remaining:
+        ready = [i for i, deps in remaining.items() if not deps]
+        if not ready:
+            i = min(remaining)
+            print(f"  Warning: dependency cycle; running queued task {i + 1} without waiting for "
+                  f"{sorted(d + 1 for d in remaining[i])}")
+            ready = [i]
+        i = min(ready)
+        order.append(i)
+        del remaining[i]
+        for deps in remaining.values():
+            deps.discard(i)
+    return order
+
+
+def task_dependencies(tasks: List[dict], names: List[str]) -> tuple:
+    """Work out which queued tasks must wait for which.
+
+    A task waits for the tasks named in its ``depends_on`` (by ``id`` or
+    file name), for earlier tasks that write a file it writes (except the
+    MERGE_PATHS hotspots, which are merged three-way), and for earlier
+    tasks that write a file it reads through ``context_files`` or read a
+    file it writes.  Returns
+    *(order, deps)*: the index order a serial run would use and, per task,
+    the set of indices it waits for.  Independent tasks commute, so any
+    schedule that respects *deps* matches the serial run.
+    """
+    ids: Dict[str, int] = {}
+    for i, (task, name) in enumerate(zip(tasks, names)):
+        for key in (task.get("id"), name, Path(name).stem):
+            if key:
+                ids.setdefault(str(key), i)
+    explicit: List[set] = [set() for _ in tasks]
+    for i, task in enumerate(tasks):
+        for dep in task.get("depends_on", []):
+            j = ids.get(str(dep))
+            if j is None:
+                print(f"  Warning: {names[i]} depends on unknown task '{dep}'; ignoring")
+            elif j != i:
+                explicit[i].add(j)
+
+    order = _topological_order(explicit)
+    position = {i: k for k, i in enumerate(order)}
+    writes = [_task_conflict_set(t) for t in tasks]
+    reads = [_task_read_set(t) for t in tasks]
+    deps = [{j for j in explicit[i] if position[j] < position[i]} for i in range(len(tasks))]
+    for k, i in enumerate(order):
+        for j in order[:k]:
+            if writes[i] & (writes[j] | reads[j]) or reads[i] & writes[j]:
+                deps[i].add(j)
+    return order, deps
+
+
+def plan_waves(order: List[int], deps: List[set]) -> List[List[int]]:
+    """Group task indices into waves; every task's dependencies are in earlier waves."""
+    level: Dict[int, int] = {}
+    for i in order:
+        level[i] = 1 + max((level[j] for j in deps[i]), default=-1)
+    waves: List[List[int]] = [[] for _ in range(max(level.values(), default=-1) + 1)]
+    for i in order:
+        waves[level[i]].append(i)
+    return waves
+
+
+async def _prepare_changes(changes: list, ios_context: dict, task: dict, resolved: Dict[str, tuple]) -> list:
+    """Resolve diffs and merge conflicts in *changes* without the tree lock.
+
+    Returns the changes with diffs turned into full contents; conflict
+    resolutions are recorded in *resolved* for :func:`write_changes`.
+    """
+    changes = await _resolve_diffs(task, changes)
+    for conflict in await asyncio.to_thread(_merge_conflicts, changes, ios_context, resolved):
+        resolved[conflict.path] = (conflict.current, conflict.incoming,
+                                   await _resolve_conflict(task, conflict))
+    return changes
+
+
+async def _write_changes_async(changes: list, ios_context: dict, locks: PipelineLocks, task: dict,
+                               resolved: Optional[Dict[str, tuple]] = None) -> list:
+    """Write *changes* to the repo under the tree lock; returns them as written.
+
+    Diffs that don't apply and merge conflicts with other tasks' edits are
+    resolved with the task's merge models before the lock is taken, so no
+    LLM call ever holds it.  If the file changes again in between, the
+    write is retried.  *resolved* carries resolutions already made by
+    :func:`_prepare_changes`.  In the returned changes every diff has been
+    turned into full contents, so later prompts show whole files.
+    """
+    resolved = {} if resolved is None else resolved
+    while True:
+        changes = await _prepare_changes(changes, ios_context, task, resolved)
+        try:
+            async with locks.tree:
+                with _get_tracer().span("write", files=len(changes)):
+                    await asyncio.to_thread(write_changes, changes, ios_context, REPO_ROOT, resolved)
+            return changes
+        except MergeConflict as conflict:
+            print(f"  {conflict.path} changed again before the write; merging once more")
+
+
+async def _discard_staged(preps: list):
+    """Cancel the streamed-change preparations in *preps* and wait for them to stop."""
+    for prep in preps:
+        prep.cancel()
+    await asyncio.gather(*preps, return_exceptions=True)
+
+
+async def _resolve_conflict(task: dict, conflict: MergeConflict) -> str:
+    print(f"  {conflict}; asking the LLM to resolve them")
+    resolved = await resolve_merge_conflicts(conflict.path, conflict.base, conflict.marked,
+                                             phase_models(task, "merge"))
+    if resolved is None:
+        print(f"  Warning: could not resolve merge conflicts in {conflict.path}; keeping this task's version")
+        return conflict.incoming
+    return resolved
+
+
+async def _build_check_async(locks: PipelineLocks, changes: list) -> Dict[str, Any]:
+    """Pre-flight and build the tree with *changes* written.
+
+    While other running tasks have unfinished edits, the build runs in a
+    snapshot with those edits taken out (see :func:`_isolated_snapshot`)
+    so the task only sees its own errors; otherwise it builds the repo in
+    place, under the tree lock.
+    """
+    changed_paths = [ch["path"] for ch in changes if ch.get("action") != "delete"]
+    edits = _task_edits.get()
+    if not locks.others_in_flight(edits):
+        async with locks.tree:
+            return await asyncio.to_thread(_preflight_and_build, changed_paths, REPO_ROOT, DERIVED_DATA_DIR)
+    async with locks.tree:
+        root = await asyncio.to_thread(_isolated_snapshot, locks)
+    try:
+        # A stable DerivedData per slot keeps this task's later builds incremental.
+        derived_data = DERIVED_DATA_DIR.with_name(f"{DERIVED_DATA_DIR.name}-task{locks.build_slot(edits)}")
+        return await asyncio.to_thread(_preflight_and_build, changed_paths, root, derived_data)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, root, True)
+
+
+def _preflight_and_build(changed_paths: list, root: Path, derived_data: Path) -> Dict[str, Any]:
+    with _get_tracer().span("preflight", files=len(changed_paths)) as span:
+        diagnostics = preflight_check(changed_paths, root)
+        span["attrs"]["problems"] = len(diagnostics)
+    if diagnostics:
+        print(f"Pre-flight found {len(diagnostics)} problem(s); skipping xcodebuild.")
+        errors = [d.replace(str(root), str(REPO_ROOT)) for d in diagnostics[:20]]
+        return {"can_build": False, "errors": errors, "stage": "preflight"}
+    return run_ios_build_check(changed_paths, root=root, derived_data=derived_data)
+
+
+def _isolated_snapshot(locks: PipelineLocks) -> Path:
+    """Snapshot ios/ with the unfinished edits of other running tasks taken out.
+
+    Each file another task has written is reverted with a three-way merge,
+    so changes the current task (or a finished one) made to the same file
+    are kept; a file whose revert conflicts is left as it is.
+    """
+    workspace = Workspace()
+    for edits in locks.others_in_flight(_task_edits.get()):
+        for rel, (preimage, latest) in edits.items():
+            current = workspace.read_text(rel) if workspace.exists(rel) else None
+            if current == latest:
+                reverted = preimage
+            elif None in (current, latest, preimage):
+                continue  # created or deleted by one side and changed since
+            else:
+                reverted, conflicts = merge3(latest, current, preimage)
+                if conflicts:
+                    continue
+            if reverted is None:
+                workspace.delete(rel)
+            else:
+                workspace.write_text(rel, reverted)
+    return workspace.snapshot(IOS_DIR)
+
+
+# ---------------------------------------------------------------------------
+# Speculative fixes — several candidates built in parallel, first green wins
+# ---------------------------------------------------------------------------
+
+def _check_candidate(root: Path, changes: list, toolchain: BuildToolchain, slot: int) -> Dict[str, Any]:
+    changed_paths = [ch["path"] for ch in changes if ch.get("action") != "delete"]
+    diagnostics = preflight_check(changed_paths, root)
+    if diagnostics:
+        errors = [d.replace(str(root), str(REPO_ROOT)) for d in diagnostics[:20]]
+        return {"can_build": False, "errors": errors, "stage": "preflight"}
+    # One DerivedData per slot: parallel xcodebuilds cannot share one, and a
+    # stable slot path keeps later retries incremental.
+    derived_data = DERIVED_DATA_DIR.with_name(f"{DERIVED_DATA_DIR.name}-candidate{slot}")
+    return run_ios_build_check(changed_paths, toolchain, root=root, derived_data=derived_data)
+
+
+async def _speculative_fix(task: dict, ios_context: dict, result: dict, errors: list,
+                           model_name: str, candidates: int, locks: PipelineLocks,
+                           diagnostics: Optional[list] = None) -> Optional[tuple]:
+    """Request *candidates* fixes at once and build each in an isolated copy.
+
+    The first candidate that compiles wins and the others are cancelled
+    (including their running compiler processes).  If none compiles, the
+    one with the fewest errors is kept so the next retry builds on it.
+    The chosen candidate is then written to the real repo.  Returns
+    *(build_result, fix_result, changes)*, or None if no candidate
+    returned any changes.
+    """
+    client = _get_async_client()
+    base = _fix_request(task, ios_context, result, errors, model_name, diagnostics)
+    runners = [CancellableRunner() for _ in range(candidates)]
+    workspaces: List[Path] = []
+    threads: List[asyncio.Future] = []
+
+    async def in_thread(fn, *args):
+        # Cancelling a candidate can't stop work already running in a thread,
+        # so it is shielded and tracked; cleanup waits for all of it.
+        fut = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+        threads.append(fut)
+        return await asyncio.shield(fut)
+
+    def snapshot() -> Path:
+        root = _isolated_snapshot(locks)
+        workspaces.append(root)  # recorded even if the candidate is cancelled meanwhile
+        return root
+
+    async def attempt(k: int) -> tuple:
+        # Vary temperature so candidates differ (and get distinct cache keys).
+        request = dict(base, temperature=min(1.0, base["temperature"] + 0.3 * k))
+        fix = await _acall_openai_with_retry(client, **request)
+        new_changes = await _resolve_diffs(task, fix.get("changes", []))
+        if not new_changes:
+            return k, fix, new_changes, None
+        async with locks.tree:
+            root = await in_thread(snapshot)
+        await in_thread(write_changes, new_changes, ios_context, root)
+        toolchain = _get_build_toolchain().with_runner(runners[k])
+        build = await in_thread(_check_candidate, root, new_changes, toolchain, k)
+        return k, fix, new_changes, build
+
+    pending = [asyncio.ensure_future(attempt(k)) for k in range(candidates)]
+    outcomes = []
+    winner = None
+    try:
+        for next_done in asyncio.as_completed(pending):
+            try:
+                outcome = await next_done
+            except Exception as e:
+                print(f"  Speculative candidate failed: {e}")
+                continue
+            outcomes.append(outcome)
+            if outcome[3] is not None and outcome[3].get("can_build"):
+                winner = outcome
+                break
+    finally:
+        for runner in runners:
+            runner.cancel()
+        for fut in pending:
+            fut.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # The runners were cancelled first, so any build still running ends
+        # promptly; no thread may still be using a workspace when it is removed.
+        await asyncio.gather(*threads, return_exceptions=True)
+        for root in workspaces:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if winner is None:
+        built = [o for o in outcomes if o[3] is not None]
+        if not built:
+            return None
+        winner = min(built, key=lambda o: (len(o[3].get("errors", [])), o[0]))
+    k, fix, new_changes, build = winner
+    print(f"  Speculative fix: candidate {k + 1}/{candidates} selected "
+          f"({'compiles' if build.get('can_build') else str(len(build.get('errors', []))) + ' error(s)'})")
+    new_changes = await _write_changes_async(new_changes, ios_context, locks, task)
+    return build, dict(fix, changes=new_changes), new_changes
+
+
 # ---------------------------------------------------------------------------
 # Build retry helper (used in multiple places)
 # ---------------------------------------------------------------------------
 
-def _run_build_retry_loop(task: dict, ios_context: dict, result: dict,
-                           changes: list, model_name: str,
-                           max_retries: int, label: str = "") -> tuple:
-    """Run build-check-and-fix loop. Returns (build_result, result, changes)."""
-    build_result = run_ios_build_check()
+async def _run_build_retry_loop(task: dict, ios_context: dict, result: dict,
+                                changes: list, max_retries: int, locks: PipelineLocks,
+                                label: str = "") -> tuple:
+    """Run build-check-and-fix loop. Returns (build_result, result, changes).
+
+    Small fixes (at most SMALL_FIX_MAX_ERRORS root-cause errors) start on
+    the cheapest fix model; once a fix fails to compile or comes back
+    empty, later attempts use the next model up.  With more than one
+    speculative fix configured, each retry races that many fix candidates
+    (see :func:`_speculative_fix`).
+    """
+    candidates = max(1, int(task.get("speculative_fixes", SPECULATIVE_FIXES)))
+    fix_models = phase_models(task, "fix")
+    escalation = 0
+    build_result = await _build_check_async(locks, changes)
+    _log_run_step("builds", label=label or "Build", attempt=0, result=build_result)
     retry_count = 0
 
     while (not build_result.get("can_build")
@@ -933,15 +4363,46 @@ def _run_build_retry_loop(task: dict, ios_context: dict, result: dict,
         for err in build_result["errors"]:
             print(f"  {err}")
 
-        result = call_llm_fix(task, ios_context, result, build_result["errors"], model_name)
-        new_changes = result.get("changes", [])
-        if new_changes:
-            write_changes(new_changes, ios_context)
-            changes = new_changes
-            build_result = run_ios_build_check()
-        else:
-            print(f"{prefix}LLM returned no fix changes, stopping build retries.")
-            break
+        root_errors = len(build_result.get("diagnostics") or build_result["errors"])
+        tier = escalation if root_errors <= SMALL_FIX_MAX_ERRORS else len(fix_models) - 1
+        models = fix_models[tier:]
+        if tier < len(fix_models) - 1:
+            print(f"{prefix}Small fix ({root_errors} error(s)): trying {models[0]} first")
+
+        with _get_tracer().span("fix", attempt=retry_count, errors=len(build_result["errors"]),
+                                candidates=candidates, model=models[0]):
+            if candidates > 1:
+                outcome = await _with_escalation(
+                    models,
+                    lambda m: _speculative_fix(task, ios_context, result, build_result["errors"],
+                                               m, candidates, locks, build_result.get("diagnostics")),
+                    lambda o: o is not None,
+                )
+                if outcome is None:
+                    print(f"{prefix}LLM returned no fix changes, stopping build retries.")
+                    break
+                build_result, result, changes = outcome
+            else:
+                fix = await _with_escalation(
+                    models,
+                    lambda m: call_llm_fix_async(task, ios_context, result, build_result["errors"], m,
+                                                 build_result.get("diagnostics")),
+                    lambda r: bool(r.get("changes")),
+                )
+                new_changes = fix.get("changes", [])
+                if not new_changes:
+                    print(f"{prefix}LLM returned no fix changes, stopping build retries.")
+                    break
+                changes = await _write_changes_async(new_changes, ios_context, locks, task)
+                result = dict(fix, changes=changes)
+                build_result = await _build_check_async(locks, changes)
+        _log_run_step("fixes", label=label or "Build", attempt=retry_count, models=models, result=result)
+        _log_run_step("builds", label=label or "Build", attempt=retry_count, result=build_result)
+
+        if not build_result.get("can_build") and tier < len(fix_models) - 1:
+            escalation = tier + 1
+            print(f"{prefix}Fix from {fix_models[tier]} did not compile; escalating to {fix_models[escalation]}")
+            Tracer.count(escalations=1)
 
     return build_result, result, changes
 
@@ -957,26 +4418,86 @@ def process_task(task_path: Path, ios_context: dict) -> dict:
     Phase 2: Build check + retry loop (up to MAX_BUILD_RETRIES)
     Phase 3: Design review + fix loop (up to MAX_DESIGN_RETRIES)
     """
+    return asyncio.run(process_task_async(task_path, ios_context))
+
+
+async def process_task_async(task_path: Path, ios_context: dict,
+                             locks: Optional[PipelineLocks] = None,
+                             generated: Optional[dict] = None) -> dict:
+    """Async implementation of :func:`process_task`.
+
+    *locks* is shared between tasks running concurrently; a private set is
+    created when the task runs on its own.  *generated* is a Phase 1 result
+    obtained ahead of time (batch mode), used instead of calling the LLM.
+    The result includes a per-phase ``telemetry`` summary of the task's trace.
+    """
+    tracer = _get_tracer()
+    record = {"run": tracer.run_id, "task_name": task_path.name, "time": time.time()}
+    token = _run_record.set(record)
+    try:
+        with tracer.span("task", task=task_path.name) as span:
+            outcome = await _process_task_async(task_path, ios_context, locks or PipelineLocks(), generated)
+        outcome["telemetry"] = tracer.summary(span["id"])
+        record["outcome"] = outcome
+        return outcome
+    except BaseException as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        _run_record.reset(token)
+        _append_run_record(record)
+
+
+async def _process_task_async(task_path: Path, ios_context: dict, locks: PipelineLocks,
+                              generated: Optional[dict] = None) -> dict:
+    tracer = _get_tracer()
     task = load_task(task_path)
     print(f"\n{'='*60}")
     print(f"Processing task: {task_path.name}")
     print(f"Task type: {task.get('type', 'unknown')}")
 
-    model_name = task.get("model", DEFAULT_MODEL)
-    print(f"Using model: {model_name}")
+    print("Using models: " + " | ".join(f"{phase}: {' -> '.join(phase_models(task, phase))}"
+                                         for phase in PIPELINE_PHASES))
 
     # ── Phase 1: Initial Generation ──────────────────────────────
     print(f"\n--- Phase 1: Initial Generation ---")
-    result = call_llm(task, ios_context, model_name)
+    # Full-content files are prepared as soon as they finish streaming (diffs
+    # applied, merges with concurrent edits resolved) but nothing reaches the
+    # tree until the whole response is in, so a retried or escalated attempt
+    # leaves no files behind.  Patches and deletes wait for the response too.
+    staged: List[tuple] = []  # (streamed change, asyncio.Task preparing it)
+    resolved: Dict[str, tuple] = {}
+    started = time.monotonic()
+
+    async def stage_streamed(change: dict):
+        if change.get("action") not in ("create", "update") or not change.get("path"):
+            return
+        if any(change == ch for ch, _ in staged):
+            return
+        if not staged:
+            print(f"  Time to first file: {time.monotonic() - started:.1f}s ({change['path']})")
+        staged.append((change, asyncio.create_task(_prepare_changes([change], ios_context, task, resolved))))
+
+    if generated is not None:
+        print("  Using the batch generation result")
+        result = generated
+    else:
+        try:
+            with tracer.span("generation", profile=True, stream=STREAM_GENERATION):
+                result = await _with_escalation(
+                    phase_models(task, "generation"),
+                    lambda m: call_llm_async(task, ios_context, m,
+                                             on_change=stage_streamed if STREAM_GENERATION else None),
+                    lambda r: bool(r.get("changes")),
+                )
+        except BaseException:
+            await _discard_staged([prep for _, prep in staged])
+            raise
 
-    # Save raw model output for debugging
-    output_file = REPO_ROOT / "agent" / "output.json"
-    enhanced_output = {
-        "task": task,
-        "ios_context": ios_context,
-        "model_result": result
-    }
-    output_file.write_text(json.dumps(enhanced_output, indent=2), encoding="utf-8")
+    # Keep the raw model output in the run log for debugging
+    record = _run_record.get()
+    if record is not None:
+        record.update(task=task, model_result=result)
 
     title = result.get("title", "ios-agent-update")
     summary = result.get("summary", "")
@@ -1008,14 +4529,29 @@ def process_task(task_path: Path, ios_context: dict) -> dict:
 
         summary = summary or "iOS Agent: synthesized iOS-specific files for deliverables."
 
-    write_changes(changes, ios_context)
+    # Swap in the prepared version of every change that streamed; staged
+    # changes the final response doesn't contain came from abandoned attempts.
+    to_write = []
+    for ch in changes:
+        prep = next((prep for streamed, prep in staged if streamed == ch), None)
+        to_write.extend(await prep if prep is not None else [ch])
+    await _discard_staged([prep for streamed, prep in staged if streamed not in changes])
+    # Later prompts get the files as written: a diff the model sent for a
+    # pre-existing file becomes its full contents, as for any other update.
+    changes = await _write_changes_async(to_write, ios_context, locks, task, resolved)
+    result = dict(result, changes=changes)
+
+    # Every file written by this task so far; design review covers all of them
+    task_changes = list(changes)
 
     # ── Phase 2: Build Retry Loop ────────────────────────────────
     print(f"\n--- Phase 2: Build Check (max {MAX_BUILD_RETRIES} retries) ---")
-    build_result, result, changes = _run_build_retry_loop(
-        task, ios_context, result, changes, model_name,
-        max_retries=MAX_BUILD_RETRIES, label="Build"
-    )
+    with tracer.span("build_loop", profile=True, label="Build"):
+        build_result, result, changes = await _run_build_retry_loop(
+            task, ios_context, result, changes,
+            max_retries=MAX_BUILD_RETRIES, locks=locks, label="Build"
+        )
+    task_changes += changes
     print(f"Build Check: {'PASS' if build_result.get('can_build') else 'FAIL'}")
 
     # ── Phase 3: Design Review Loop (only if build passed) ──────
@@ -1027,7 +4563,10 @@ def process_task(task_path: Path, ios_context: dict) -> dict:
         for design_iteration in range(MAX_DESIGN_RETRIES):
             print(f"\nDesign Review iteration {design_iteration + 1}/{MAX_DESIGN_RETRIES}")
 
-            design_review_result = design_review(task, ios_context, changes, model_name)
+            review_changes = list({ch["path"]: ch for ch in task_changes}.values())
+            with tracer.span("design_review", profile=True, iteration=design_iteration + 1):
+                design_review_result = await design_review_async(task, ios_context, review_changes)
+            _log_run_step("design_reviews", iteration=design_iteration + 1, result=design_review_result)
 
             score = design_review_result.get("score", 0)
             passes = design_review_result.get("passes", False)
@@ -1048,24 +4587,30 @@ def process_task(task_path: Path, ios_context: dict) -> dict:
 
             # Ask LLM to fix design
             print("  Requesting design improvements from LLM...")
-            result = call_llm_design_fix(
-                task, ios_context, result, design_review_result, model_name
-            )
+            with tracer.span("design_fix", profile=True, iteration=design_iteration + 1):
+                result = await _with_escalation(
+                    phase_models(task, "design_fix"),
+                    lambda m: call_llm_design_fix_async(task, ios_context, result, design_review_result, m),
+                )
+            _log_run_step("design_fixes", iteration=design_iteration + 1, result=result)
             new_changes = result.get("changes", [])
 
             if not new_changes:
                 print("  LLM returned no design fix changes, stopping design retries.")
                 break
 
-            write_changes(new_changes, ios_context)
-            changes = new_changes
+            changes = await _write_changes_async(new_changes, ios_context, locks, task)
+            result = dict(result, changes=changes)
+            task_changes += changes
 
             # Re-build after design changes (they may break compilation)
             print(f"  Post-design build check (max {MAX_POST_DESIGN_BUILD_RETRIES} retries)...")
-            build_result, result, changes = _run_build_retry_loop(
-                task, ios_context, result, changes, model_name,
-                max_retries=MAX_POST_DESIGN_BUILD_RETRIES, label="Post-Design"
-            )
+            with tracer.span("build_loop", profile=True, label="Post-Design"):
+                build_result, result, changes = await _run_build_retry_loop(
+                    task, ios_context, result, changes,
+                    max_retries=MAX_POST_DESIGN_BUILD_RETRIES, locks=locks, label="Post-Design"
+                )
+            task_changes += changes
 
             if not build_result.get("can_build"):
                 print("  Build failed after design fixes. Stopping design iterations.")
@@ -1097,34 +4642,412 @@ def process_task(task_path: Path, ios_context: dict) -> dict:
     }
 
 
+async def run_task_queue(task_paths: List[Path], concurrency: int = MAX_CONCURRENT_TASKS,
+                         generated: Optional[Dict[str, dict]] = None,
+                         merge_bases: Optional[Dict[str, dict]] = None) -> List[dict]:
+    """Process queued tasks with up to *concurrency* pipelines in flight.
+
+    Tasks start as soon as the tasks they depend on have finished (see
+    :func:`task_dependencies`), so independent tasks run in parallel waves
+    while dependent or conflicting ones keep their serial order.  Each
+    task re-analyzes the project when it starts so it sees the files
+    written before it.  *generated* maps task file names to Phase 1
+    results obtained ahead of time, and *merge_bases* to the file versions
+    their prompts showed.  Results are returned in queue order.
+    """
+    tasks = [load_task(p) for p in task_paths]
+    order, deps = task_dependencies(tasks, [p.name for p in task_paths])
+    waves = plan_waves(order, deps)
+    if len(task_paths) > 1:
+        print(f"Schedule: {len(task_paths)} task(s) in {len(waves)} wave(s)")
+        for n, wave in enumerate(waves, 1):
+            print(f"  Wave {n}: {', '.join(task_paths[i].name for i in wave)}")
+
+    locks = PipelineLocks()
+    slots = asyncio.Semaphore(max(1, concurrency))
+    done = [asyncio.Event() for _ in task_paths]
+    generated = generated or {}
+    merge_bases = merge_bases or {}
+
+    async def run(i: int) -> dict:
+        try:
+            for j in deps[i]:
+                await done[j].wait()
+            name = task_paths[i].name
+            return await _run_queued_task(task_paths[i], locks, slots, generated=generated.get(name),
+                                          merge_bases=merge_bases.get(name))
+        finally:
+            done[i].set()
+
+    return list(await asyncio.gather(*(run(i) for i in range(len(task_paths)))))
+
+
+async def _run_queued_task(task_path: Path, locks: PipelineLocks, slots: "asyncio.Semaphore",
+                           submitted: Optional[float] = None, generated: Optional[dict] = None,
+                           merge_bases: Optional[dict] = None) -> dict:
+    # Runs in its own asyncio task, so this only affects this task's writes.
+    _merge_bases.set({} if merge_bases is None else merge_bases)
+    # Claim the write set before taking a slot so a task blocked on a
+    # shared file never holds a slot that an independent task could use.
+    async with locks.claim(_task_conflict_set(load_task(task_path))):
+        async with slots:
+            if submitted is not None:
+                print(f"Queue-to-start for {task_path.name}: {(time.monotonic() - submitted) * 1000:.0f} ms")
+            async with locks.tree:
+                with _get_tracer().span("analyze", task=task_path.name):
+                    ios_context = await asyncio.to_thread(analyze_ios_project)
+            edits = {}
+            _task_edits.set(edits)
+            with locks.track(edits):
+                return await process_task_async(task_path, ios_context, locks, generated)
+
+
 # ---------------------------------------------------------------------------
-# Main entry point
+# Batch generation — Phase 1 of a whole backlog as one offline job
 # ---------------------------------------------------------------------------
 
-def main():
-    print("Starting iOS Agent...")
-    print(f"Build retries: {MAX_BUILD_RETRIES} | Design iterations: {MAX_DESIGN_RETRIES} | Post-design build retries: {MAX_POST_DESIGN_BUILD_RETRIES}")
+_BATCH_TERMINAL = {"completed", "failed", "expired", "cancelled"}
 
-    ios_context = analyze_ios_project()
-    print(f"iOS Context: {json.dumps(ios_context, indent=2)}")
 
-    queued = sorted(glob.glob(str(QUEUED_DIR / "*.json")))
-    if not queued:
-        print("No tasks found in queued/")
-        return
+class LocalBatchClient:
+    """In-process stand-in for the OpenAI Files and Batches endpoints.
+
+    Implements the subset batch mode uses (``files.create``,
+    ``files.content``, ``batches.create``, ``batches.retrieve``) with the
+    same JSONL formats, running each request through *chat_client* on a
+    background thread.  Files live under *root*.
+    """
+
+    def __init__(self, chat_client, root: Path = BATCH_DIR):
+        self.chat_client = chat_client
+        self.root = root
+        self._batches: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self.files = types.SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = types.SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    def _write_file(self, data: bytes) -> str:
+        file_id = f"file-local-{os.urandom(6).hex()}"
+        self.root.mkdir(parents=True, exist_ok=True)
+        (self.root / f"{file_id}.jsonl").write_bytes(data)
+        return file_id
+
+    def _create_file(self, file, purpose: str = "batch"):
+        data = file[1] if isinstance(file, tuple) else file
+        data = data.read() if hasattr(data, "read") else data
+        return types.SimpleNamespace(id=self._write_file(data if isinstance(data, bytes) else data.encode("utf-8")),
+                                     purpose=purpose)
+
+    def _file_content(self, file_id: str):
+        return types.SimpleNamespace(text=(self.root / f"{file_id}.jsonl").read_text(encoding="utf-8"))
+
+    def _create_batch(self, input_file_id: str, endpoint: str, completion_window: str = "24h", metadata=None):
+        batch_id = f"batch-local-{os.urandom(6).hex()}"
+        with self._lock:
+            self._batches[batch_id] = {"id": batch_id, "status": "validating", "endpoint": endpoint,
+                                       "input_file_id": input_file_id, "output_file_id": None,
+                                       "error_file_id": None, "request_counts": {"total": 0, "completed": 0, "failed": 0}}
+        threading.Thread(target=self._execute, args=(batch_id,), name=batch_id, daemon=True).start()
+        return self._retrieve_batch(batch_id)
+
+    def _retrieve_batch(self, batch_id: str):
+        with self._lock:
+            batch = dict(self._batches[batch_id])
+        batch["request_counts"] = types.SimpleNamespace(**batch["request_counts"])
+        return types.SimpleNamespace(**batch)
+
+    def _execute(self, batch_id: str):
+        with self._lock:
+            batch = self._batches[batch_id]
+            input_file_id = batch["input_file_id"]
+        lines = [json.loads(l) for l in self._file_content(input_file_id).text.splitlines() if l.strip()]
+        with self._lock:
+            batch["status"] = "in_progress"
+            batch["request_counts"]["total"] = len(lines)
+        outputs, errors = [], []
+        for line in lines:
+            try:
+                resp = self.chat_client.chat.completions.create(**line["body"])
+                usage = getattr(resp, "usage", None)
+                body = {
+                    "object": "chat.completion", "model": line["body"].get("model"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": resp.choices[0].message.content}}],
+                    "usage": {k: getattr(usage, k, 0) for k in ("prompt_tokens", "completion_tokens", "total_tokens")} if usage else None,
+                }
+                outputs.append({"custom_id": line["custom_id"], "response": {"status_code": 200, "body": body}, "error": None})
+                key = "completed"
+            except Exception as e:
+                errors.append({"custom_id": line["custom_id"], "response": None,
+                               "error": {"code": type(e).__name__, "message": str(e)}})
+                key = "failed"
+            with self._lock:
+                batch["request_counts"][key] += 1
+        output_id = self._write_file("".join(json.dumps(o) + "\n" for o in outputs).encode("utf-8")) if outputs else None
+        error_id = self._write_file("".join(json.dumps(e) + "\n" for e in errors).encode("utf-8")) if errors else None
+        with self._lock:
+            batch.update(status="completed", output_file_id=output_id, error_file_id=error_id)
+
+
+def _get_batch_client(mode: str):
+    if mode == "local":
+        return LocalBatchClient(_get_client())
+    return _get_client()
+
+
+def run_generation_batch(requests: Dict[str, dict], client, poll_s: float = BATCH_POLL_S,
+                         timeout_s: float = BATCH_TIMEOUT_S) -> Dict[str, dict]:
+    """Run chat-completion *requests* (custom_id -> kwargs) as one batch job and wait for it.
+
+    Responses already in the LLM cache are not resubmitted, and new ones
+    are cached.  Returns custom_id -> parsed JSON response; requests that
+    failed or returned invalid JSON are left out so the caller can run
+    them interactively.
+    """
+    results: Dict[str, dict] = {}
+    keys: Dict[str, Optional[str]] = {}
+    for custom_id, request in requests.items():
+        keys[custom_id], cached = _cache_lookup(request)
+        if cached is not None:
+            results[custom_id] = cached
+            Tracer.count(cache_hits=1)
+    pending = {cid: req for cid, req in requests.items() if cid not in results}
+    if not pending:
+        return results
+
+    payload = "".join(
+        json.dumps({"custom_id": cid, "method": "POST", "url": "/v1/chat/completions", "body": req}) + "\n"
+        for cid, req in pending.items()
+    )
+    input_file = client.files.create(file=("generation.jsonl", payload.encode("utf-8")), purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                  completion_window="24h")
+    print(f"Submitted batch {batch.id} with {len(pending)} generation request(s)")
+
+    deadline = time.monotonic() + timeout_s
+    delay = min(1.0, poll_s)
+    while batch.status not in _BATCH_TERMINAL and time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(poll_s, delay * 2)
+        batch = client.batches.retrieve(batch.id)
+        counts = getattr(batch, "request_counts", None)
+        if counts is not None:
+            print(f"  Batch {batch.id}: {batch.status} ({counts.completed}/{counts.total} done, {counts.failed} failed)")
+    if batch.status != "completed":
+        print(f"  Batch {batch.id} ended as '{batch.status}'; unfinished requests will run interactively")
+
+    if getattr(batch, "output_file_id", None):
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            body = response.get("body") or {}
+            usage = body.get("usage") or {}
+            Tracer.count(prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0))
+            content = body["choices"][0]["message"]["content"]
+            try:
+                results[entry["custom_id"]] = json.loads(content)
+            except (ValueError, TypeError):
+                continue
+            _cache_store(keys.get(entry["custom_id"]), content)
+    missing = len(requests) - len(results)
+    if missing:
+        print(f"  {missing} batch request(s) failed; they will run interactively")
+    return results
+
+
+async def run_batch_queue(task_paths: List[Path], concurrency: int = MAX_CONCURRENT_TASKS,
+                          mode: str = BATCH_MODE) -> List[dict]:
+    """Process queued tasks with Phase 1 for the independent ones submitted as one batch job.
+
+    Generation requests are built from the project as it is before any
+    task runs, so tasks that wait for another task (see
+    :func:`task_dependencies`) are left out of the batch and generate
+    interactively once it has finished.  The build and design phases then
+    run as in :func:`run_task_queue`, each batched task starting from its
+    batch result.
+    """
+    tasks = [load_task(p) for p in task_paths]
+    _, deps = task_dependencies(tasks, [p.name for p in task_paths])
+    ios_context = await asyncio.to_thread(analyze_ios_project)
+    requests, bases = {}, {}
+    for path, task, after in zip(task_paths, tasks, deps):
+        if not after:
+            bases[path.name] = {}
+            token = _merge_bases.set(bases[path.name])
+            try:
+                requests[path.name] = _generation_request(task, ios_context, phase_models(task, "generation")[0])
+            finally:
+                _merge_bases.reset(token)
+
+    with _get_tracer().span("batch", requests=len(requests), mode=mode):
+        generated = await asyncio.to_thread(run_generation_batch, requests, _get_batch_client(mode))
+
+    generated = {name: r for name, r in generated.items() if r.get("changes")}
+    return await run_task_queue(task_paths, concurrency, generated,
+                                {name: b for name, b in bases.items() if name in generated})
 
-    print(f"Found {len(queued)} queued task(s)")
 
-    all_results = []
+# ---------------------------------------------------------------------------
+# Daemon mode — long-running worker that keeps caches warm between tasks
+# ---------------------------------------------------------------------------
+
+DAEMON_POLL_S = float(os.environ.get("AGENT_DAEMON_POLL", "0.25"))
+
+
+class TaskDaemon:
+    """Runs tasks as they arrive instead of once per process.
+
+    Tasks are picked up by polling QUEUED_DIR and/or submitted to a
+    localhost HTTP endpoint (``POST /tasks`` with a task JSON body,
+    ``GET /status``).  Everything process-wide stays warm between tasks:
+    the project index, LLM and review caches, API connection pools, the
+    build toolchain and DerivedData.  Each time the queue drains, the PR
+    body for the tasks completed since the last drain is written, as in a
+    one-shot run.
+    """
+
+    def __init__(self, concurrency: int = MAX_CONCURRENT_TASKS, watch: bool = True, port: Optional[int] = None):
+        self.concurrency = max(1, concurrency)
+        self.watch = watch
+        self.port = port
+        self.known: Dict[str, float] = {}   # task file name -> mtime when it was picked up
+        self.running: Dict[str, asyncio.Task] = {}
+        self.completed: List[dict] = []
+        self.batch: List[dict] = []
+
+    def submit(self, task_path: Path, submitted: Optional[float] = None):
+        """Start *task_path* unless it is already running or was tried in its current state."""
+        try:
+            mtime = task_path.stat().st_mtime
+        except OSError:
+            return
+        if task_path.name in self.running or self.known.get(task_path.name) == mtime:
+            return
+        self.known[task_path.name] = mtime
+        if not self.running:
+            _rescan_project_index()  # the tree may have changed while idle
+        self.running[task_path.name] = asyncio.ensure_future(
+            self._run(task_path, submitted if submitted is not None else time.monotonic())
+        )
+
+    async def _run(self, task_path: Path, submitted: float):
+        try:
+            with _get_tracer().span("run", tasks=1, daemon=True):
+                result = await _run_queued_task(task_path, self.locks, self.slots, submitted)
+            self.batch.append(result)
+            self.completed.append({
+                "task": result["task_name"], "title": result["title"],
+                "build": bool(result["build_result"].get("can_build")),
+                "design_score": (result.get("design_review") or {}).get("score"),
+            })
+            del self.completed[:-50]
+        except Exception as e:
+            print(f"Task {task_path.name} failed: {e}")
+            self.completed.append({"task": task_path.name, "error": str(e)})
+        finally:
+            self.running.pop(task_path.name, None)
+            if not self.running and self.batch:
+                batch, self.batch = self.batch, []
+                _write_run_outputs(batch)
+
+    async def _watch(self):
+        while True:
+            for path in sorted(QUEUED_DIR.glob("*.json")):
+                self.submit(path)
+            await asyncio.sleep(DAEMON_POLL_S)
+
+    def _status(self) -> dict:
+        return {"running": sorted(self.running), "completed": list(self.completed)}
+
+    def _start_http(self, loop: "asyncio.AbstractEventLoop"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status: int, payload: dict):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/status":
+                    async def snapshot():
+                        return daemon._status()
+                    self._reply(200, asyncio.run_coroutine_threadsafe(snapshot(), loop).result(5))
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                if self.path.rstrip("/") != "/tasks":
+                    return self._reply(404, {"error": "not found"})
+                submitted = time.monotonic()
+                try:
+                    task = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+                except ValueError as e:
+                    return self._reply(400, {"error": f"invalid JSON: {e}"})
+                if not isinstance(task, dict) or not isinstance(task.get("deliverables"), list):
+                    return self._reply(400, {"error": "task must be an object with a deliverables list"})
+                slug = re.sub(r'[^a-z0-9]+', '-', str(task.get("title", "task")).lower()).strip("-") or "task"
+                name = f"{time.strftime('%Y%m%d-%H%M%S')}-{slug[:40]}-{os.urandom(3).hex()}.json"
+                QUEUED_DIR.mkdir(parents=True, exist_ok=True)
+                tmp = QUEUED_DIR / f".{name}.tmp"
+                tmp.write_text(json.dumps(task, indent=2), encoding="utf-8")
+                os.replace(tmp, QUEUED_DIR / name)
+                loop.call_soon_threadsafe(daemon.submit, QUEUED_DIR / name, submitted)
+                self._reply(202, {"task": name})
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        threading.Thread(target=server.serve_forever, name="agent-http", daemon=True).start()
+        print(f"Accepting tasks at http://127.0.0.1:{server.server_address[1]}/tasks")
+        return server
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.locks = PipelineLocks()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            with contextlib.suppress(NotImplementedError, RuntimeError):  # e.g. not the main thread
+                loop.add_signal_handler(sig, stop.set)
+
+        # Warm up once: project index, build toolchain check, API client
+        await asyncio.to_thread(analyze_ios_project)
+        await asyncio.to_thread(_ensure_xcode_selected)
+        with contextlib.suppress(RuntimeError):
+            _get_async_client()
+
+        server = self._start_http(loop) if self.port is not None else None
+        watcher = asyncio.ensure_future(self._watch()) if self.watch else None
+        print(f"Agent daemon ready | Concurrency: {self.concurrency} | "
+              f"Watching: {QUEUED_DIR if self.watch else 'off'}")
+        try:
+            await stop.wait()
+        finally:
+            print("Stopping agent daemon; waiting for running tasks...")
+            if watcher is not None:
+                watcher.cancel()
+            if server is not None:
+                server.shutdown()
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+        return 0
 
-    for task_file in queued:
-        task_path = Path(task_file)
-        result = process_task(task_path, ios_context)
-        all_results.append(result)
 
-        # Re-analyze context so subsequent tasks see newly created files
-        ios_context = analyze_ios_project()
+# ---------------------------------------------------------------------------
+# Main entry point
+# ---------------------------------------------------------------------------
 
+def _write_run_outputs(all_results: List[dict]):
+    """Write the PR body and branch name for *all_results*, save caches and print stats."""
     # Generate PR body from all results
     pr_body_parts = ["### iOS Agent Tasks\n"]
     all_changes = []
@@ -1157,6 +5080,12 @@ def main():
     for ch in all_changes:
         pr_body_parts.append(f"- {ch['action'].title()}: `{ch['path']}`")
 
+    pr_body_parts.append("\n### Agent Telemetry\n")
+    for r in all_results:
+        pr_body_parts.append(f"**{r['task_name']}**\n")
+        pr_body_parts.append(format_trace_summary(r["telemetry"]))
+        pr_body_parts.append("")
+
     pr_body = '\n'.join(pr_body_parts)
     (REPO_ROOT / "agent" / "last_pr_body.txt").write_text(pr_body, encoding="utf-8")
     (REPO_ROOT / "agent" / "last_branch_name.txt").write_text(
@@ -1164,7 +5093,204 @@ def main():
         encoding="utf-8"
     )
 
+    if _project_index is not None:
+        _project_index.save()
+
+    cache = _get_llm_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print(f"LLM cache ({stats['mode']}): {stats['hits']} hit(s), {stats['misses']} miss(es)")
+
+    if _rate_limiter is not None:
+        stats = _rate_limiter.stats()
+        print(f"LLM rate limiter: {stats['rate_limited']} rate-limit error(s), {stats['throttled_s']}s throttled, "
+              f"limits rpm={stats['rpm'] or '?'} tpm={stats['tpm'] or '?'}, in-flight cap {stats['in_flight_limit']}")
+
+    tracer = _get_tracer()
+    if tracer.path is not None:
+        print(f"Trace written to {tracer.path} (run {tracer.run_id})")
+
+
+def _run_queue(task_paths: List[Path], batch: str = "off") -> List[dict]:
+    """Run *task_paths* through the pipeline and write the run outputs."""
+    ios_context = analyze_ios_project()
+    print(f"iOS Context: {json.dumps(ios_context, indent=2)}")
+    print(f"Found {len(task_paths)} queued task(s) | Concurrency: {MAX_CONCURRENT_TASKS}")
+
+    with _get_tracer().span("run", tasks=len(task_paths), concurrency=MAX_CONCURRENT_TASKS, batch=batch):
+        if batch != "off":
+            all_results = asyncio.run(run_batch_queue(task_paths, MAX_CONCURRENT_TASKS, batch))
+        else:
+            all_results = asyncio.run(run_task_queue(task_paths, MAX_CONCURRENT_TASKS))
+
+    _write_run_outputs(all_results)
     print(f"\nAgent completed. Processed {len(all_results)} task(s).")
+    return all_results
+
+
+def _cmd_run(args) -> Optional[int]:
+    print("Starting iOS Agent...")
+    print(f"Build retries: {MAX_BUILD_RETRIES} | Design iterations: {MAX_DESIGN_RETRIES} | Post-design build retries: {MAX_POST_DESIGN_BUILD_RETRIES}")
+
+    if args.daemon:
+        return asyncio.run(TaskDaemon(MAX_CONCURRENT_TASKS, watch=not args.no_watch, port=args.port).run())
+
+    queued = sorted(glob.glob(str(QUEUED_DIR / "*.json")))
+    if not queued:
+        print("No tasks found in queued/")
+        return None
+    _run_queue([Path(q) for q in queued], args.batch)
+    return None
+
+
+def _cmd_replay(args) -> Optional[int]:
+    global LLM_CACHE_MODE, _llm_cache
+    task_paths = []
+    for name in args.tasks or [Path(q).name for q in sorted(glob.glob(str(QUEUED_DIR / "*.json")))]:
+        candidates = [Path(name), QUEUED_DIR / name, PROCESSED_DIR / name, PROCESSED_DIR / f"{name}.json"]
+        found = next((c for c in candidates if c.is_file()), None)
+        if found is None:
+            print(f"Task not found: {name}")
+            return 1
+        task_paths.append(found)
+    if not task_paths:
+        print("No tasks to replay")
+        return None
+    if not args.apply:
+        return _replay_in_copy(task_paths)
+    print(f"Replaying {len(task_paths)} task(s) from the LLM cache (no API calls)")
+    # A fresh read-only cache for the replay; whatever else runs in this
+    # process (bench, tests calling main()) gets its own mode and cache back.
+    saved = LLM_CACHE_MODE, _llm_cache
+    LLM_CACHE_MODE, _llm_cache = "replay", None
+    try:
+        _run_queue(task_paths)
+    finally:
+        LLM_CACHE_MODE, _llm_cache = saved
+    return None
+
+
+def _replay_in_copy(task_paths: List[Path]) -> Optional[int]:
+    """Replay *task_paths* in a throwaway copy of the repo.
+
+    The copy's pipeline reads the real LLM cache (read-only in replay
+    mode); the repo, its task queue and the run log are left untouched.
+    """
+    with tempfile.TemporaryDirectory(prefix="agent-replay-") as tmp:
+        copy = Path(tmp) / REPO_ROOT.name
+        shutil.copytree(REPO_ROOT, copy, symlinks=True, ignore=shutil.ignore_patterns(".git", ".cache"))
+        queued = copy / QUEUED_DIR.relative_to(REPO_ROOT)
+        queued.mkdir(parents=True, exist_ok=True)
+        for path in task_paths:
+            shutil.copyfile(path, queued / path.name)
+        env = {k: v for k, v in os.environ.items() if k != "AGENT_RUN_LOG"}
+        env["AGENT_LLM_CACHE_PATH"] = str(LLM_CACHE_PATH)
+        print("Replaying in a scratch copy of the repo (use --apply to replay in place)")
+        proc = subprocess.run([sys.executable, str(copy / "agent" / "cli.py"), "replay", "--apply",
+                               *(path.name for path in task_paths)], env=env)
+    return proc.returncode or None
+
+
+def _cmd_analyze(args) -> Optional[int]:
+    print(json.dumps(analyze_ios_project(), indent=2))
+    return None
+
+
+def _cmd_apply_patch(args) -> Optional[int]:
+    patches = json.loads(args.patches.read_text(encoding="utf-8") if args.patches else sys.stdin.read())
+    if isinstance(patches, dict):
+        patches = patches.get("patches", [])
+    workspace = Workspace(args.file.resolve().parent)
+    success, errors, diff = apply_patches(args.file.resolve(), patches, workspace)
+    for err in errors:
+        print(f"Patch error: {err}", file=sys.stderr)
+    if diff:
+        print(diff, end="")
+    if success and not args.dry_run:
+        workspace.commit()
+    return 0 if success else 1
+
+
+def _cmd_build_check(args) -> Optional[int]:
+    problems = preflight_check(args.paths) if args.paths else []
+    if problems:
+        result = {"can_build": False, "errors": problems[:20], "stage": "preflight"}
+    else:
+        result = run_ios_build_check(args.paths or None)
+    print(json.dumps(result, indent=2, default=str))
+    return 0 if result.get("can_build") else 1
+
+
+def _cmd_bench(args) -> Optional[int]:
+    spec = importlib.util.spec_from_file_location("agent_bench", Path(__file__).with_name("bench.py"))
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+    return bench.main(args.bench_args)
+
+
+def _cmd_show_run(args) -> Optional[int]:
+    run_log = _get_run_log()
+    record = run_log.latest(args.task) if run_log is not None else None
+    if record is None:
+        print(f"No run-log record for {args.task}")
+        return 1
+    print(json.dumps(record, indent=2, default=str))
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="iOS agent. Without a command, runs the queued tasks.")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+
+    run = commands.add_parser("run", help="process the tasks in agent/tasks/queued (the default)")
+    run.add_argument("--daemon", action="store_true",
+                     help="keep running and process tasks as they arrive, with caches kept warm")
+    run.add_argument("--port", type=int,
+                     help="with --daemon, also accept tasks via POST http://127.0.0.1:PORT/tasks")
+    run.add_argument("--no-watch", action="store_true",
+                     help="with --daemon, don't poll agent/tasks/queued for new task files")
+    run.add_argument("--batch", choices=["off", "openai", "local"], default=BATCH_MODE,
+                     help="submit Phase 1 for all queued tasks as one offline batch job")
+    run.set_defaults(handler=_cmd_run)
+
+    replay = commands.add_parser("replay", help="re-run tasks from cached LLM responses only (no API calls)")
+    replay.add_argument("tasks", nargs="*", help="task files or names in queued/ or processed/ (default: queued)")
+    replay.add_argument("--apply", action="store_true",
+                        help="replay in the repo itself: write the files, move the tasks to processed/ and "
+                             "log the run (by default a scratch copy is used and nothing is changed)")
+    replay.set_defaults(handler=_cmd_replay)
+
+    analyze = commands.add_parser("analyze", help="print the iOS project context as JSON")
+    analyze.set_defaults(handler=_cmd_analyze)
+
+    apply_patch = commands.add_parser("apply-patch", help="apply find/replace patches to a file")
+    apply_patch.add_argument("file", type=Path)
+    apply_patch.add_argument("patches", type=Path, nargs="?",
+                             help='JSON list of {"find", "replace"} patches (default: stdin)')
+    apply_patch.add_argument("--dry-run", action="store_true", help="print the diff without writing the file")
+    apply_patch.set_defaults(handler=_cmd_apply_patch)
+
+    build_check = commands.add_parser("build-check", help="run the pre-flight and Xcode build checks")
+    build_check.add_argument("paths", nargs="*", help="changed files (repo-relative) to type-check first")
+    build_check.set_defaults(handler=_cmd_build_check)
+
+    bench = commands.add_parser("bench", help="run the offline benchmarks (agent/bench.py; see bench --help)",
+                                add_help=False)
+    bench.set_defaults(handler=_cmd_bench)
+
+    show_run = commands.add_parser("show-run", help="print the latest run-log record for a task")
+    show_run.add_argument("task", help="task file name")
+    show_run.set_defaults(handler=_cmd_show_run)
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or (argv[0] not in commands.choices and argv[0] not in ("-h", "--help")):
+        argv.insert(0, "run")  # bare invocation (and its flags) as before
+    args, extra = parser.parse_known_args(argv)
+    if args.command == "bench":
+        args.bench_args = extra  # options belong to bench.py's own parser
+    elif extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    return args.handler(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,17 @@
+"""Command-line entry point for the iOS agent.
+
+    python agent/cli.py analyze
+    python agent/cli.py apply-patch FILE PATCHES.json
+    python agent/cli.py run             # same as python agent/bot.py
+
+A thin launcher: Python only caches bytecode for imported modules, so
+running bot.py directly recompiles all of it on every start.  See
+``python agent/cli.py --help`` for the commands.
+"""
+import os
+import sys
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    sys.exit(bot.main())
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# bot.py is a script, not a package: import it from agent/
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
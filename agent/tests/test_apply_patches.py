@@ -0,0 +1,102 @@
+"""apply_patches / plan_patches: find-and-replace edits located against the original file."""
+import pytest
+
+import bot
+
+VIEW = """import SwiftUI
+
+struct GoalsView: View {
+    @State private var goals: [String] = []
+
+    var body: some View {
+        VStack {
+            Text("Goals")
+                .font(.title)
+            Text("Streak")
+                .font(.title)
+        }
+    }
+}
+"""
+
+
+@pytest.fixture
+def view(tmp_path):
+    path = tmp_path / "GoalsView.swift"
+    path.write_bytes(VIEW.encode())
+    return path
+
+
+def test_several_patches_apply_in_one_pass(view):
+    patches = [
+        {"find": 'Text("Goals")', "replace": 'Text("My Goals")'},
+        {"find": "import SwiftUI\n", "replace": "import SwiftUI\nimport Charts\n"},
+        # Found in the original text, so an earlier patch's replacement can't be matched
+        {"find": 'Text("My Goals")', "replace": "never"},
+    ]
+    ok, errors, diff = bot.apply_patches(view, patches[:2])
+    assert (ok, errors) == (True, [])
+    assert view.read_text() == VIEW.replace('Text("Goals")', 'Text("My Goals")').replace(
+        "import SwiftUI\n", "import SwiftUI\nimport Charts\n")
+    assert "+import Charts\n" in diff and '-            Text("Goals")\n' in diff
+    assert diff.startswith("--- a/GoalsView.swift\n+++ b/GoalsView.swift\n")
+
+    _, errors, _ = bot.plan_patches(VIEW, patches)
+    assert errors == ["Patch 2: could not find target string in file"]
+
+
+def test_overlapping_patch_is_an_error(view):
+    patches = [
+        {"find": 'Text("Goals")\n                .font(.title)', "replace": 'Text("Goals").bold()'},
+        {"find": 'Text("Goals")', "replace": 'Text("Aims")'},
+    ]
+    ok, errors, diff = bot.apply_patches(view, patches)
+    assert ok is False and diff == ""
+    assert errors == ["Patch 1: target at line 8 overlaps an earlier patch in GoalsView.swift"]
+
+
+def test_repeated_find_takes_next_unused_occurrence():
+    patches = [{"find": ".font(.title)", "replace": ".font(.largeTitle)"},
+               {"find": ".font(.title)", "replace": ".font(.headline)"}]
+    new, errors, notes = bot.plan_patches(VIEW, patches)
+    assert errors == []
+    assert new == VIEW.replace(".font(.title)", ".font(.largeTitle)", 1).replace(".font(.title)", ".font(.headline)")
+    assert notes == ["Patch 0: multiple exact matches, applied at line 9",
+                     "Patch 1: multiple exact matches, applied at line 11"]
+
+
+def test_whitespace_normalized_match():
+    patch = {"find": 'Text("Streak")\n    .font(.title)', "replace": '            Text("Streak")\n                .font(.caption)'}
+    new, errors, notes = bot.plan_patches(VIEW, [patch])
+    assert errors == []
+    assert new == VIEW.replace('Text("Streak")\n                .font(.title)', 'Text("Streak")\n                .font(.caption)')
+    assert notes == ["Patch 0: applied via normalized match"]
+
+
+@pytest.mark.parametrize("patches", [
+    [{"find": 'Text("Goals")', "replace": 'Text("Aims")'}, {"find": "no such code", "replace": "x"}],
+    [{"find": 'Text("Goals")', "replace": 'Text("Aims")'}, {"find": "", "replace": "x"}],
+    [{"find": "struct GoalsView", "replace": "struct AimsView"}, {"find": "struct GoalsView: View", "replace": "x"}],
+])
+def test_failure_leaves_file_unchanged(view, patches):
+    before = view.stat()
+    ok, errors, diff = bot.apply_patches(view, patches)
+    assert ok is False and len(errors) == 1 and diff == ""
+    assert view.read_bytes() == VIEW.encode()
+    assert view.stat().st_ino == before.st_ino and view.stat().st_mtime_ns == before.st_mtime_ns
+
+
+def test_staged_in_workspace_until_commit(view):
+    ws = bot.Workspace(view.parent)
+    ok, _, _ = bot.apply_patches(view, [{"find": 'Text("Goals")', "replace": 'Text("Aims")'}], ws)
+    assert ok
+    assert view.read_text() == VIEW
+    assert 'Text("Aims")' in ws.read_text(view)
+    ws.commit()
+    assert view.read_text() == VIEW.replace('Text("Goals")', 'Text("Aims")')
+
+
+def test_missing_file(tmp_path):
+    ok, errors, diff = bot.apply_patches(tmp_path / "Nope.swift", [{"find": "a", "replace": "b"}])
+    assert (ok, diff) == (False, "")
+    assert errors == [f"File not found: {tmp_path / 'Nope.swift'}"]
@@ -0,0 +1,73 @@
+"""apply_unified_diff: placing hunks whose line numbers or context have drifted."""
+import bot
+
+CONTENT = "".join(f"line {i}\n" for i in range(1, 21))
+
+
+def test_exact_hunk():
+    diff = "@@ -4,3 +4,3 @@\n line 4\n-line 5\n+line five\n line 6\n"
+    new, errors, notes = bot.apply_unified_diff(CONTENT, diff)
+    assert errors == [] and notes == []
+    assert new == CONTENT.replace("line 5\n", "line five\n")
+
+
+def test_drifted_line_numbers_are_noted():
+    diff = "@@ -1,3 +1,3 @@\n line 14\n-line 15\n+line fifteen\n line 16\n"
+    new, errors, notes = bot.apply_unified_diff(CONTENT, diff)
+    assert errors == []
+    assert new == CONTENT.replace("line 15\n", "line fifteen\n")
+    assert notes and "offset +13 lines" in notes[0]
+
+
+def test_nearest_match_to_header_wins():
+    content = "a\nx\nb\n" * 3
+    diff = "@@ -7,3 +7,3 @@\n a\n-x\n+y\n b\n"
+    new, errors, _ = bot.apply_unified_diff(content, diff)
+    assert errors == []
+    assert new == "a\nx\nb\n" * 2 + "a\ny\nb\n"
+
+
+def test_indentation_drift_is_normalized():
+    content = "    func f() {\n        let a = 1\n        let b = 2\n    }\n"
+    diff = "@@ -1,4 +1,4 @@\n func f() {\n     let a = 1\n-    let b = 2\n+    let b = 3\n }\n"
+    new, errors, notes = bot.apply_unified_diff(content, diff)
+    assert errors == []
+    assert new == "    func f() {\n        let a = 1\n        let b = 3\n    }\n"
+    assert notes and "normalized match" in notes[0]
+
+
+def test_stale_context_is_fuzzed():
+    diff = "@@ -9,5 +9,5 @@\n line nine\n line 10\n-line 11\n+line eleven\n line 12\n line thirteen\n"
+    new, errors, notes = bot.apply_unified_diff(CONTENT, diff)
+    assert errors == []
+    assert new == CONTENT.replace("line 11\n", "line eleven\n")
+    assert notes and "fuzz" in notes[0]
+
+
+def test_pure_deletion_takes_its_line_break():
+    diff = "@@ -2,3 +2,2 @@\n line 2\n-line 3\n line 4\n"
+    new, errors, _ = bot.apply_unified_diff(CONTENT, diff)
+    assert errors == []
+    assert new == CONTENT.replace("line 3\n", "")
+
+
+def test_multiple_hunks_apply_against_the_original():
+    diff = ("@@ -1,2 +1,3 @@\n line 1\n+inserted\n line 2\n"
+            "@@ -19,2 +20,2 @@\n line 19\n-line 20\n+line twenty\n")
+    new, errors, _ = bot.apply_unified_diff(CONTENT, diff)
+    assert errors == []
+    assert new == CONTENT.replace("line 1\n", "line 1\ninserted\n", 1).replace("line 20\n", "line twenty\n")
+
+
+def test_unplaceable_hunk_is_reported_and_skipped():
+    diff = ("@@ -1,2 +1,2 @@\n-line 1\n+line one\n line 2\n"
+            "@@ -10,2 +10,2 @@\n nothing\n-like this\n+here\n")
+    new, errors, _ = bot.apply_unified_diff(CONTENT, diff, "A.swift")
+    assert errors == ["Hunk 1: its context does not match A.swift"]
+    assert new == CONTENT.replace("line 1\n", "line one\n", 1)
+
+
+def test_no_hunks():
+    new, errors, _ = bot.apply_unified_diff(CONTENT, "just prose", "A.swift")
+    assert new == CONTENT
+    assert errors == ["No hunks in the diff for A.swift"]
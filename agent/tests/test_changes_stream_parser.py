@@ -0,0 +1,58 @@
+"""ChangesStreamParser: changes[] entries come out as soon as they are complete."""
+import json
+
+import pytest
+
+import bot
+
+RESPONSE = json.dumps({
+    "summary": "Adds {braces} and \"changes\": [ in strings",
+    "changes": [
+        {"path": "A.swift", "action": "create", "content": "struct A { let s = \"}]\\\\\" }\n"},
+        {"path": "B.swift", "action": "update", "diff": "@@ -1 +1 @@\n-{\n+[\n"},
+    ],
+    "notes": [{"changes": [{"path": "not an entry"}]}],
+}, indent=1)
+ENTRIES = json.loads(RESPONSE)["changes"]
+
+
+class ChangesStreamParserWithLog(bot.ChangesStreamParser):
+    """Records the entries returned and how much text had arrived for each."""
+
+    def __init__(self):
+        super().__init__()
+        self.entries, self.returned_at = [], []
+
+    def feed(self, chunk):
+        done = super().feed(chunk)
+        self.entries += done
+        self.returned_at += [len(self._text) - 1] * len(done)
+        return done
+
+
+def test_whole_response():
+    assert bot.ChangesStreamParser().feed(RESPONSE) == ENTRIES
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 64])
+def test_chunked(size):
+    parser = ChangesStreamParserWithLog()
+    for i in range(0, len(RESPONSE), size):
+        parser.feed(RESPONSE[i:i + size])
+    assert parser.entries == ENTRIES
+    # Each entry is returned before any of the text after it has arrived
+    assert parser.returned_at[0] < RESPONSE.index('"B.swift"') + size
+    assert parser.returned_at[1] < RESPONSE.index('"notes"') + size
+
+
+def test_entries_are_not_repeated():
+    parser = bot.ChangesStreamParser()
+    half = RESPONSE.index('"B.swift"')
+    assert parser.feed(RESPONSE[:half]) == ENTRIES[:1]
+    assert parser.feed(RESPONSE[half:]) == ENTRIES[1:]
+    assert parser.feed("") == []
+
+
+def test_non_object_entries_skipped():
+    assert bot.ChangesStreamParser().feed('{"changes": ["text", 1, {"path": "C.swift"}]}') == [{"path": "C.swift"}]
+
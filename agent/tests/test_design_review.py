@@ -0,0 +1,43 @@
+"""_merge_design_reviews: one verdict for a task from its per-file reviews."""
+import bot
+
+CONTENT_VIEW = "ios/PT-Helper/PT-Helper/ContentView.swift"
+NEW_VIEW = "ios/PT-Helper/PT-Helper/Views/GoalsView.swift"
+
+
+def review(passes, score, *issues):
+    return {"passes": passes, "score": score, "issues": list(issues), "summary": f"score {score}"}
+
+
+def test_every_file_must_pass():
+    merged = bot._merge_design_reviews({CONTENT_VIEW: review(True, 8), NEW_VIEW: review(False, 3)},
+                                       {CONTENT_VIEW: 300, NEW_VIEW: 30})
+    # The weighted mean still rounds to 8; it is only reported
+    assert merged["score"] == 8
+    assert merged["passes"] is False
+
+
+def test_file_below_pass_score_fails_even_if_marked_passing():
+    merged = bot._merge_design_reviews({CONTENT_VIEW: review(True, 9),
+                                        NEW_VIEW: review(True, bot.DESIGN_PASS_SCORE - 1)})
+    assert merged["passes"] is False
+
+
+def test_all_files_passing():
+    merged = bot._merge_design_reviews({CONTENT_VIEW: review(True, 9),
+                                        NEW_VIEW: review(True, bot.DESIGN_PASS_SCORE)})
+    assert merged["passes"] is True
+    assert merged["score"] == 8
+    assert merged["summary"] == "ContentView.swift: score 9 GoalsView.swift: score 7"
+
+
+def test_high_severity_issue_fails_and_issues_are_tagged():
+    issue = {"severity": "High", "issue": "text unreadable in dark mode"}
+    merged = bot._merge_design_reviews({CONTENT_VIEW: review(True, 9), NEW_VIEW: review(True, 8, issue)})
+    assert merged["passes"] is False
+    assert merged["issues"] == [{"file": NEW_VIEW, **issue}]
+
+
+def test_malformed_review_fails():
+    merged = bot._merge_design_reviews({CONTENT_VIEW: review(True, 9), NEW_VIEW: {"score": 9}})
+    assert merged["passes"] is False
@@ -0,0 +1,105 @@
+"""_fuzzy_replace against the full SequenceMatcher scan it replaced."""
+import difflib
+import random
+
+import pytest
+
+import bot
+
+SWIFT_DIR = bot.REPO_ROOT / "ios" / "PT-Helper" / "PT-Helper"
+THRESHOLDS = [0.0, 0.3, 0.5, 0.7, 0.85, 0.9, 0.95, 1.0]
+
+
+def reference_fuzzy_replace(content, find_str, replace_str, threshold=0.85):
+    """Every window is scored with a full ratio(); the first best one wins."""
+    content_lines = content.split('\n')
+    find_lines = find_str.rstrip('\n').split('\n')
+    n = len(find_lines)
+    if n > len(content_lines):
+        return None
+    best_ratio = 0.0
+    best_idx = -1
+    for i in range(len(content_lines) - n + 1):
+        window = '\n'.join(content_lines[i:i + n])
+        ratio = difflib.SequenceMatcher(None, window, find_str.rstrip('\n')).ratio()
+        if ratio > best_ratio:
+            best_ratio = ratio
+            best_idx = i
+    if best_ratio >= threshold and best_idx >= 0:
+        replace_lines = replace_str.rstrip('\n').split('\n')
+        return '\n'.join(content_lines[:best_idx] + replace_lines + content_lines[best_idx + n:])
+    return None
+
+
+def _boilerplate(rng):
+    """Views that repeat the same modifiers, so many windows score almost alike."""
+    blocks = []
+    for i in range(rng.randint(2, 5)):
+        blocks.append(
+            f"struct Row{i}: View {{\n"
+            f"    var body: some View {{\n"
+            f"        HStack {{\n"
+            f"            Text(\"Row {i}\")\n"
+            f"                .font(.body)\n"
+            f"                .padding(.horizontal, {rng.choice([8, 12, 16])})\n"
+            f"        }}\n"
+            f"        .background(Color(.systemBackground))\n"
+            f"        .cornerRadius(14)\n"
+            f"    }}\n"
+            f"}}\n"
+        )
+    return "\n".join(blocks)
+
+
+def _corpus():
+    files = [p.read_text(encoding="utf-8") for p in sorted(SWIFT_DIR.rglob("*.swift"))]
+    # Small files keep the full-scan reference fast enough for hundreds of cases
+    return [text for text in files if 10 < text.count("\n") < 80]
+
+
+def _mutate(text, rng):
+    chars = list(text)
+    for _ in range(rng.randint(0, max(1, len(chars) // 15))):
+        if not chars:
+            chars.append(rng.choice("abc"))
+            continue
+        pos = rng.randrange(len(chars))
+        op = rng.random()
+        if op < 0.4:
+            chars[pos] = rng.choice("abcdefxyz (){}.\n ")
+        elif op < 0.7:
+            chars.insert(pos, rng.choice("abc ."))
+        elif len(chars) > 1:
+            del chars[pos]
+    return "".join(chars)
+
+
+def _cases(count=400, seed=20240605):
+    rng = random.Random(seed)
+    corpus = _corpus()
+    for k in range(count):
+        content = _boilerplate(rng) if not corpus or rng.random() < 0.4 else rng.choice(corpus)
+        lines = content.split("\n")
+        n = rng.randint(1, min(6, len(lines)))
+        start = rng.randrange(len(lines) - n + 1)
+        find = "\n".join(lines[start:start + n])
+        if rng.random() < 0.8:
+            find = _mutate(find, rng)
+        if rng.random() < 0.3:
+            find += "\n"
+        yield pytest.param(content, find, f"// replaced {k}", rng.choice(THRESHOLDS), id=f"case{k}")
+
+
+@pytest.mark.parametrize("content,find,replace,threshold", list(_cases()))
+def test_matches_full_scan(content, find, replace, threshold):
+    assert bot._fuzzy_replace(content, find, replace, threshold) == \
+        reference_fuzzy_replace(content, find, replace, threshold)
+
+
+def test_first_of_equal_windows_wins():
+    content = "a\nfoo()\nb\nfoo()\nc"
+    assert bot._fuzzy_replace(content, "fooo()", "bar()", 0.5) == "a\nbar()\nb\nfoo()\nc"
+
+
+def test_below_threshold_is_none():
+    assert bot._fuzzy_replace("let x = 1\nlet y = 2", "completely different", "z", 0.85) is None
@@ -0,0 +1,54 @@
+"""merge3: three-way merge of a task's write with concurrent edits."""
+import bot
+
+BASE = "import SwiftUI\n\nstruct A {\n    var x = 1\n    var y = 2\n    var z = 3\n}\n"
+
+
+def test_unchanged_sides_take_the_other():
+    edited = BASE.replace("x = 1", "x = 10")
+    assert bot.merge3(BASE, BASE, edited) == (edited, 0)
+    assert bot.merge3(BASE, edited, BASE) == (edited, 0)
+    assert bot.merge3(BASE, edited, edited) == (edited, 0)
+
+
+def test_non_overlapping_edits_combine():
+    current = BASE.replace("x = 1", "x = 10")
+    incoming = BASE.replace("z = 3", "z = 30")
+    merged, conflicts = bot.merge3(BASE, current, incoming)
+    assert conflicts == 0
+    assert merged == BASE.replace("x = 1", "x = 10").replace("z = 3", "z = 30")
+
+
+def test_identical_edits_taken_once():
+    current = BASE.replace("y = 2", "y = 20") + "// end\n"
+    incoming = BASE.replace("y = 2", "y = 20")
+    merged, conflicts = bot.merge3(BASE, current, incoming)
+    assert conflicts == 0
+    assert merged == current
+
+
+def test_insertions_at_same_point_keep_both_current_first():
+    current = BASE.replace("}\n", "    var a = 0\n}\n")
+    incoming = BASE.replace("}\n", "    var b = 0\n}\n")
+    merged, conflicts = bot.merge3(BASE, current, incoming)
+    assert conflicts == 0
+    assert merged == BASE.replace("}\n", "    var a = 0\n    var b = 0\n}\n")
+
+
+def test_overlapping_edits_are_marked():
+    current = BASE.replace("y = 2", "y = 20")
+    incoming = BASE.replace("y = 2", "y = 200")
+    merged, conflicts = bot.merge3(BASE, current, incoming)
+    assert conflicts == 1
+    assert ("<<<<<<< current\n    var y = 20\n=======\n    var y = 200\n>>>>>>> task\n") in merged
+    assert merged.startswith("import SwiftUI\n\nstruct A {\n    var x = 1\n")
+    assert merged.endswith("    var z = 3\n}\n")
+
+
+def test_missing_final_newline_follows_incoming():
+    base = BASE.rstrip("\n")
+    current = base.replace("x = 1", "x = 10")
+    incoming = base.replace("z = 3", "z = 30")
+    merged, conflicts = bot.merge3(base, current, incoming)
+    assert conflicts == 0
+    assert merged == base.replace("x = 1", "x = 10").replace("z = 3", "z = 30")
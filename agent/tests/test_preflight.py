@@ -0,0 +1,114 @@
+"""preflight_check: static checks of changed Swift files before xcodebuild."""
+import os
+import shutil
+
+import pytest
+
+import bot
+
+APP = "ios/App/App/"
+OTHER = "ios/Other/Other/"
+
+CLEAN = """import SwiftUI
+
+struct HomeView: View {
+    @State private var name = "{not a brace"
+
+    var body: some View {
+        Text("Hello, \\(name)")  // a } in a comment
+    }
+}
+"""
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """A tiny repo with two targets; ``check`` writes files, indexes them and runs the pre-flight."""
+    (tmp_path / "ios/App/App.xcodeproj").mkdir(parents=True)
+    (tmp_path / "ios/Other/Other.xcodeproj").mkdir(parents=True)
+    monkeypatch.setattr(bot, "REPO_ROOT", tmp_path)
+
+    def check(files, changed=None, root=None):
+        for rel, text in files.items():
+            path = tmp_path / rel
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(text)
+        monkeypatch.setattr(bot, "_project_index", bot.ProjectIndex(tmp_path / "ios", repo_root=tmp_path))
+        return bot.preflight_check(list(files) if changed is None else changed, root or tmp_path)
+
+    check.root = tmp_path
+    return check
+
+
+def messages(diagnostics):
+    return [d.split(": error: ", 1)[1] for d in diagnostics]
+
+
+def test_clean_file(repo):
+    assert repo({APP + "HomeView.swift": CLEAN}) == []
+
+
+def test_unbalanced_and_unterminated(repo):
+    text = 'import SwiftUI\n\nstruct A {\n    let s = "open\n    func f() {\n'
+    diagnostics = repo({APP + "A.swift": text})
+    assert messages(diagnostics) == ["unterminated string literal", "'{' is never closed", "'{' is never closed"]
+    assert diagnostics[0].startswith(f"{repo.root / APP / 'A.swift'}:4:13: error:")
+
+
+def test_mismatched_closer(repo):
+    assert messages(repo({APP + "A.swift": "let a = [1, 2)\n"})) == [
+        "expected closing for '[' before ')'", "'[' is never closed"]
+
+
+def test_redeclaration_within_target_only(repo):
+    files = {APP + "HomeView.swift": CLEAN, OTHER + "HomeView.swift": CLEAN,
+             APP + "Dup.swift": "import SwiftUI\n\nstruct HomeView: View {\n    var body: some View { EmptyView() }\n}\n",
+             APP + "Private.swift": "private struct HomeView {}\n"}
+    diagnostics = repo(files, changed=[APP + "Dup.swift", APP + "Private.swift"])
+    assert messages(diagnostics) == [f"invalid redeclaration of 'HomeView' (also declared in {APP}HomeView.swift)"]
+
+
+def test_missing_imports(repo):
+    text = "struct A: View {\n    var body: some View { Chart { BarMark(x: .value(\"x\", 1)) } }\n}\n"
+    assert messages(repo({APP + "A.swift": text})) == [
+        "cannot find 'View' in scope (missing 'import SwiftUI')",
+        "cannot find 'Chart' in scope (missing 'import Charts')",
+    ]
+
+
+def test_project_type_shadows_framework_symbol(repo):
+    files = {APP + "Auth.swift": "final class Auth {\n    static func auth() -> Auth { Auth() }\n}\n",
+             APP + "Login.swift": "func login() { _ = Auth.auth() }\n"}
+    assert repo(files, changed=[APP + "Login.swift"]) == []
+
+
+def test_patch_leftovers(repo):
+    text = ("import SwiftUI\n```swift\nstruct A {}\n<<<<<<< current\n=======\n>>>>>>> task\n"
+            "// ... rest of file unchanged\n")
+    assert messages(repo({APP + "A.swift": text})) == [
+        "stray text '```' left in file",
+        "stray text '<<<<<<<' left in file",
+        "stray text '=======' left in file",
+        "stray text '>>>>>>>' left in file",
+        "placeholder comment left in file instead of real code",
+    ]
+
+
+def test_unindexed_and_non_swift_paths_skipped(repo):
+    assert repo({APP + "Notes.md": "{"}) == []
+    assert bot.preflight_check([APP + "Missing.swift"], repo.root) == []
+
+
+def test_isolated_snapshot(repo, tmp_path):
+    files = {APP + "HomeView.swift": CLEAN, APP + "Gone.swift": "struct Settings {}\n",
+             APP + "Linked.swift": "struct Linked {}\n"}
+    repo(files, changed=[])
+    snapshot = tmp_path / "snapshot"
+    shutil.copytree(tmp_path / "ios", snapshot / "ios", copy_function=os.link)
+    # The snapshot's HomeView.swift was rewritten and Gone.swift deleted; Linked.swift is still the repo's
+    (snapshot / APP / "HomeView.swift").unlink()
+    (snapshot / APP / "HomeView.swift").write_text("struct Profile {}\n")
+    (snapshot / APP / "Gone.swift").unlink()
+    (snapshot / APP / "New.swift").write_text("struct HomeView {}\nstruct Settings {}\nstruct Linked {}\n")
+    diagnostics = bot.preflight_check([APP + "New.swift"], snapshot)
+    assert messages(diagnostics) == [f"invalid redeclaration of 'Linked' (also declared in {APP}Linked.swift)"]
@@ -0,0 +1,146 @@
+"""RateLimiter: pacing, inferred limits after 429s, and recovery."""
+import json
+import types
+
+import pytest
+
+import bot
+
+
+class Clock:
+    """Stands in for the time module; sleeping advances it."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += max(seconds, 1e-3)  # a real clock always moves on, whatever the rounding
+
+
+class RateLimitError(Exception):
+    status_code = 429
+    response = types.SimpleNamespace(headers={"retry-after": "2"})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot, "time", clock)
+    return clock
+
+
+def send(limiter, n):
+    for _ in range(n):
+        limiter.release(limiter.acquire({}), True)
+
+
+def test_configured_rpm_is_enforced(clock):
+    limiter = bot.RateLimiter(rpm=3)
+    send(limiter, 3)
+    assert clock.sleeps == []
+    send(limiter, 1)
+    assert sum(clock.sleeps) == pytest.approx(bot.RateLimiter.WINDOW_S)
+
+
+def test_rate_limit_infers_rpm_and_recovers_to_ceiling(clock):
+    limiter = bot.RateLimiter(rpm=40)
+    send(limiter, 10)
+    wait = limiter.backoff(RateLimitError(), 0)
+    assert 2.0 <= wait <= 2.4
+    assert limiter.blocked_until == clock.now + wait
+    assert limiter.stats()["rpm"] == 9
+    assert limiter.in_flight_limit == 4
+    clock.now += limiter.WINDOW_S
+    assert limiter.stats()["rpm"] == 18
+    clock.now += limiter.WINDOW_S
+    assert limiter.stats()["rpm"] == 36
+    clock.now += limiter.WINDOW_S
+    assert limiter.stats()["rpm"] == 40
+    assert limiter._inferred is None
+
+
+def test_inferred_rpm_without_ceiling_is_lifted(clock):
+    limiter = bot.RateLimiter()
+    send(limiter, 5)
+    limiter.backoff(RateLimitError(), 0)
+    assert limiter.stats()["rpm"] == 4
+    clock.now += limiter.WINDOW_S * (bot.RateLimiter.INFERRED_WINDOWS - 0.5)
+    assert limiter.stats()["rpm"] > 4
+    clock.now += limiter.WINDOW_S
+    assert limiter.stats()["rpm"] == 0
+
+
+def test_later_rate_limit_lowers_the_inference(clock):
+    limiter = bot.RateLimiter()
+    send(limiter, 5)
+    limiter.backoff(RateLimitError(), 0)
+    clock.now += limiter.WINDOW_S
+    send(limiter, 3)
+    limiter.backoff(RateLimitError(), 1)
+    assert limiter.stats()["rpm"] == 2
+    # A second error from the same burst doesn't raise it again
+    limiter.backoff(RateLimitError(), 2)
+    assert limiter.stats()["rpm"] == 2
+
+
+def test_headers_replace_inferred_limits(clock):
+    limiter = bot.RateLimiter()
+    send(limiter, 5)
+    limiter.backoff(RateLimitError(), 0)
+    limiter.observe({"X-RateLimit-Limit-Requests": "500", "X-RateLimit-Limit-Tokens": "90000"})
+    assert limiter.stats()["rpm"] == 500
+    assert limiter.stats()["tpm"] == 90000
+    send(limiter, 20)
+    limiter.backoff(RateLimitError(), 0)
+    assert limiter.stats()["rpm"] == 500
+
+
+def test_exhausted_budget_waits_for_one_request_to_refill(clock):
+    limiter = bot.RateLimiter()
+    limiter.observe({"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "0",
+                     "x-ratelimit-reset-requests": "30s"})
+    assert limiter.blocked_until == pytest.approx(clock.now + 1.0)
+
+
+def test_in_flight_limit_halves_and_grows_back(clock):
+    limiter = bot.RateLimiter(max_in_flight=8)
+    limiter.backoff(RateLimitError(), 0)
+    limiter.backoff(RateLimitError(), 0)
+    assert limiter.in_flight_limit == 2
+    send(limiter, 2)
+    assert limiter.in_flight_limit == 3
+    send(limiter, 3 + 4 + 5 + 6 + 7)
+    assert limiter.in_flight_limit == 8
+
+
+def test_slot_released_before_retry_sleep(clock, monkeypatch):
+    limiter = bot.RateLimiter()
+    monkeypatch.setattr(bot, "_rate_limiter", limiter)
+    monkeypatch.setattr(bot, "_get_llm_cache", lambda: None)
+    in_flight_while_sleeping = []
+    sleep = clock.sleep
+
+    def watched_sleep(seconds):
+        in_flight_while_sleeping.append(limiter.in_flight)
+        sleep(seconds)
+
+    clock.sleep = watched_sleep
+    attempts = []
+
+    def create(**kwargs):
+        attempts.append(kwargs)
+        if len(attempts) == 1:
+            raise RateLimitError()
+        message = types.SimpleNamespace(content=json.dumps({"ok": True}))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+    assert bot._call_openai(client, 3, model="m", messages=[]) == {"ok": True}
+    assert len(attempts) == 2
+    assert in_flight_while_sleeping and set(in_flight_while_sleeping) == {0}
+    assert limiter.in_flight == 0
@@ -0,0 +1,97 @@
+"""task_dependencies / plan_waves: which queued tasks may run side by side."""
+import bot
+
+VIEWS = "ios/PT-Helper/PT-Helper/Views/"
+
+
+def task(*writes, reads=(), depends_on=(), id=None, type="update"):
+    t = {"deliverables": [{"path": p, "type": type} for p in writes], "context_files": list(reads)}
+    if depends_on:
+        t["depends_on"] = list(depends_on)
+    if id:
+        t["id"] = id
+    return t
+
+
+def schedule(tasks):
+    names = [f"task{i + 1}.json" for i in range(len(tasks))]
+    order, deps = bot.task_dependencies(tasks, names)
+    return order, deps, bot.plan_waves(order, deps)
+
+
+def test_independent_tasks_share_a_wave():
+    order, deps, waves = schedule([task("A.swift"), task("B.swift"), task("C.swift")])
+    assert order == [0, 1, 2]
+    assert deps == [set(), set(), set()]
+    assert waves == [[0, 1, 2]]
+
+
+def test_shared_write_waits_for_earlier_task():
+    _, deps, waves = schedule([task("A.swift"), task("B.swift"), task("A.swift", "C.swift")])
+    assert deps[2] == {0}
+    assert waves == [[0, 1], [2]]
+
+
+def test_read_write_overlap_orders_both_ways():
+    _, deps, waves = schedule([task("A.swift"), task("B.swift", reads=["A.swift"]),
+                               task("C.swift", reads=["D.swift"]), task("D.swift")])
+    assert deps[1] == {0}
+    assert deps[3] == {2}
+    assert waves == [[0, 2], [1, 3]]
+
+
+def test_merge_paths_do_not_serialize():
+    # Both create views, so both are expected to rewrite ContentView.swift
+    tasks = [task(VIEWS + "AView.swift", type="new"), task(VIEWS + "BView.swift", type="new")]
+    assert bot.CONTENT_VIEW_PATH in bot._task_write_set(tasks[0])
+    _, deps, waves = schedule(tasks)
+    assert deps == [set(), set()]
+    assert waves == [[0, 1]]
+
+
+def test_depends_on_by_id_or_name_reorders():
+    tasks = [task("A.swift", depends_on=["setup"]), task("B.swift", depends_on=["task3"]),
+             task("C.swift", id="setup")]
+    order, deps, waves = schedule(tasks)
+    assert order == [2, 0, 1]
+    assert deps[0] == {2}
+    assert deps[1] == {2}
+    assert waves == [[2], [0, 1]]
+
+
+def test_unknown_dependency_is_ignored(capsys):
+    _, deps, _ = schedule([task("A.swift", depends_on=["nope"])])
+    assert deps == [set()]
+    assert "unknown task 'nope'" in capsys.readouterr().out
+
+
+def test_cycle_is_broken_in_queue_order(capsys):
+    tasks = [task("A.swift", depends_on=["task2"]), task("B.swift", depends_on=["task1"])]
+    order, deps, waves = schedule(tasks)
+    assert order == [0, 1]
+    assert deps == [set(), {0}]
+    assert waves == [[0], [1]]
+    assert "dependency cycle" in capsys.readouterr().out
+
+
+def test_waves_follow_longest_chain():
+    order = [0, 1, 2, 3]
+    deps = [set(), {0}, set(), {1, 2}]
+    assert bot.plan_waves(order, deps) == [[0, 2], [1], [3]]
+    assert bot.plan_waves([], []) == []
+
+
+def test_build_slots_and_other_tasks_edits():
+    locks = bot.PipelineLocks()
+    mine, theirs = {}, {"A.swift": ["", "x"]}
+    with locks.track(mine):
+        with locks.track(theirs):
+            assert locks.build_slot(mine) == 0
+            assert locks.build_slot(theirs) == 1
+            assert locks.others_in_flight(mine) == [theirs]
+            # A task that hasn't written anything yet needs no snapshot
+            assert locks.others_in_flight(theirs) == []
+        late = {}
+        with locks.track(late):
+            assert locks.build_slot(late) == 1
+    assert locks.in_flight == [None, None]
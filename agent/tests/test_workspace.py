@@ -0,0 +1,173 @@
+"""Workspace: a commit that fails part-way leaves the tree exactly as it was."""
+import os
+import pathlib
+import stat
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / "repo"
+    (root / "ios/App").mkdir(parents=True)
+    (root / "ios/App/A.swift").write_text("struct A {}\n")
+    (root / "ios/App/B.swift").write_text("struct B {}\n")
+    (root / "ios/App/Old.swift").write_text("struct Old {}\n")
+    (root / "ios/App/run.sh").write_text("#!/bin/sh\n")
+    os.chmod(root / "ios/App/run.sh", 0o755)
+    os.symlink("A.swift", root / "ios/App/Alias.swift")
+    return root
+
+
+def tree(root):
+    """Every entry under *root*, hidden temp and backup files included, with contents, mode and inode."""
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = pathlib.Path(dirpath) / name
+            st = path.lstat()
+            if stat.S_ISLNK(st.st_mode):
+                entries[path.relative_to(root).as_posix()] = ("link", os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                entries[path.relative_to(root).as_posix()] = ("dir",)
+            else:
+                entries[path.relative_to(root).as_posix()] = (path.read_bytes(), st.st_mode, st.st_ino)
+    return entries
+
+
+def stage(root):
+    """A workspace with an update, a new file in a new folder, a delete and a mode-keeping update."""
+    ws = bot.Workspace(root)
+    ws.write_text("ios/App/A.swift", "struct A { let x = 1 }\n")
+    ws.write_text("ios/App/New/Deeper/N.swift", "struct N {}\n")
+    ws.delete("ios/App/Old.swift")
+    ws.write_text("ios/App/run.sh", "#!/bin/sh\necho hi\n")
+    return ws
+
+
+def fail_nth(monkeypatch, module, name, root, nth, error=OSError):
+    """Make the *nth* call of ``module.name`` touching a path under *root* raise *error*; later calls work."""
+    real = getattr(module, name)
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        if any(str(a).startswith(str(root)) for a in args):
+            calls.append(args)
+            if len(calls) == nth:
+                raise error(f"injected failure in {name}")
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(module, name, wrapper)
+    return calls
+
+
+def test_commit(root):
+    ws = stage(root)
+    assert sorted(ws.commit()) == ["ios/App/A.swift", "ios/App/New/Deeper/N.swift", "ios/App/Old.swift", "ios/App/run.sh"]
+    after = tree(root)
+    assert after["ios/App/A.swift"][0] == b"struct A { let x = 1 }\n"
+    assert after["ios/App/New/Deeper/N.swift"][0] == b"struct N {}\n"
+    assert "ios/App/Old.swift" not in after
+    assert stat.S_IMODE(after["ios/App/run.sh"][1]) == 0o755
+    assert not [p for p in after if pathlib.Path(p).name.startswith(".")]
+    assert ws.pending == {}
+
+
+@pytest.mark.parametrize("nth", [1, 2, 3])
+def test_failed_rename_restores_tree(root, monkeypatch, nth):
+    before = tree(root)
+    ws = stage(root)
+    fail_nth(monkeypatch, os, "replace", root, nth)
+    with pytest.raises(OSError, match="injected"):
+        ws.commit()
+    monkeypatch.undo()
+    assert tree(root) == before
+
+
+@pytest.mark.parametrize("nth", [1, 2, 3])
+def test_failed_backup_link_restores_tree(root, monkeypatch, nth):
+    before = tree(root)
+    ws = stage(root)
+    fail_nth(monkeypatch, os, "link", root, nth)
+    with pytest.raises(OSError, match="injected"):
+        ws.commit()
+    monkeypatch.undo()
+    assert tree(root) == before
+
+
+def test_failed_delete_restores_tree(root, monkeypatch):
+    before = tree(root)
+    ws = stage(root)
+    real_unlink = pathlib.Path.unlink
+
+    def unlink(self, missing_ok=False):
+        if self.name == "Old.swift":
+            raise PermissionError("injected failure in unlink")
+        return real_unlink(self, missing_ok=missing_ok)
+
+    monkeypatch.setattr(pathlib.Path, "unlink", unlink)
+    with pytest.raises(PermissionError):
+        ws.commit()
+    monkeypatch.undo()
+    assert tree(root) == before
+
+
+def test_interrupt_mid_commit_restores_tree(root, monkeypatch):
+    before = tree(root)
+    ws = stage(root)
+    fail_nth(monkeypatch, os, "replace", root, 2, KeyboardInterrupt)
+    with pytest.raises(KeyboardInterrupt):
+        ws.commit()
+    monkeypatch.undo()
+    assert tree(root) == before
+
+
+def test_failure_while_staging_leaves_no_temp_files(root):
+    before = tree(root)
+    ws = stage(root)
+    ws.write_text("ios/App/B.swift", "struct B { let s = \"\ud800\" }\n")  # can't be encoded
+    with pytest.raises(UnicodeEncodeError):
+        ws.commit()
+    assert tree(root) == before
+
+
+def test_overlay_reads_and_rollback(root):
+    ws = stage(root)
+    assert ws.read_text(root / "ios/App/A.swift") == "struct A { let x = 1 }\n"
+    assert ws.exists("ios/App/New/Deeper/N.swift") and not ws.exists("ios/App/Old.swift")
+    with pytest.raises(FileNotFoundError):
+        ws.read_text("ios/App/Old.swift")
+    before = tree(root)
+    ws.rollback()
+    assert ws.pending == {} and tree(root) == before
+    assert ws.read_text("ios/App/A.swift") == "struct A {}\n"
+
+
+def test_snapshot(root, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "SNAPSHOT_DIR", tmp_path / "snapshots")
+    before = tree(root)
+    ws = stage(root)
+    ws.write_text("README.md", "outside the subtree\n")
+    snap = ws.snapshot(root / "ios")
+    assert tree(root) == before
+
+    copied = tree(snap)
+    # Unchanged files are hardlinks to the repo's copies, symlinks stay symlinks
+    assert copied["ios/App/B.swift"] == before["ios/App/B.swift"]
+    assert copied["ios/App/Alias.swift"] == ("link", "A.swift")
+    # Pending changes under the subtree are applied to the snapshot only
+    assert copied["ios/App/A.swift"][0] == b"struct A { let x = 1 }\n"
+    assert copied["ios/App/A.swift"][2] != before["ios/App/A.swift"][2]
+    assert copied["ios/App/New/Deeper/N.swift"][0] == b"struct N {}\n"
+    assert "ios/App/Old.swift" not in copied
+    assert "README.md" not in copied
+    assert ws.pending  # the source workspace is not committed
+
+    # Writing through a workspace on the snapshot replaces the link instead of editing the repo's file
+    overlay = bot.Workspace(snap)
+    overlay.write_text("ios/App/B.swift", "struct B { let y = 2 }\n")
+    overlay.commit()
+    assert tree(root) == before
+    assert (snap / "ios/App/B.swift").read_text() == "struct B { let y = 2 }\n"